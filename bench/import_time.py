@@ -0,0 +1,107 @@
+# Cold start benchmark: imports bot/bot.py in fresh interpreters with `python -X importtime` and reports the
+# total import time, the slowest modules and which of the heavy (lazily loaded) modules got imported anyway.
+#
+#   python bench/import_time.py --runs 5 --max-ms 500
+#
+# Exits with 1 if the median import time is above --max-ms or a lazy module is imported at startup.
+# Uses the config from config/ (or the one in BOT_CONFIG_DIR), a dummy config if there's none
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+import yaml
+
+ROOT_DIR = Path(__file__).parent.parent.resolve()
+
+# loaded on first use, so they must not show up when the module is imported
+# (pymongo and motor are, the database is needed before the bot starts polling anyway)
+LAZY_MODULES = [
+    "openai",
+    "aiohttp",
+    "aiohttp.web",
+    "tiktoken",
+    "PyPDF2",
+    "pydub",
+    "azure.cognitiveservices.speech",
+    "youtube_transcript_api",
+]
+
+
+def write_dummy_config(config_dir: Path):
+    with open(ROOT_DIR / "config" / "config.example.yml") as f:
+        config_yaml = yaml.safe_load(f)
+    config_yaml.update({"telegram_token": "123:import-time", "openai_api_key": "sk-import-time"})
+    with open(config_dir / "config.yml", "w") as f:
+        yaml.safe_dump(config_yaml, f)
+    with open(config_dir / "config.env", "w") as f:
+        f.write("MONGODB_HOST=localhost\nMONGODB_PORT=27017\n")
+    shutil.copy(ROOT_DIR / "config" / "chat_modes.yml", config_dir / "chat_modes.yml")
+
+
+def parse_importtime(stderr: str):
+    # returns {module: (self us, cumulative us)} from the "import time: self | cumulative | module" lines
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return modules
+
+
+def measure(env):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import bot"],
+        cwd=ROOT_DIR / "bot", env=env, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing the bot failed:\n{result.stderr[-2000:]}")
+    return parse_importtime(result.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure how long importing the bot takes")
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters, the first one also compiles .pyc files")
+    parser.add_argument("--top", type=int, default=15, help="slowest modules to print")
+    parser.add_argument("--max-ms", type=float, default=None, help="fail if the median import time is larger")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    config_dir = None
+    if "BOT_CONFIG_DIR" not in env and not (ROOT_DIR / "config" / "config.yml").exists():
+        config_dir = Path(tempfile.mkdtemp(prefix="bot-import-time-"))
+        write_dummy_config(config_dir)
+        env["BOT_CONFIG_DIR"] = str(config_dir)
+
+    try:
+        runs = [measure(env) for _ in range(args.runs)]
+    finally:
+        if config_dir is not None:
+            shutil.rmtree(config_dir)
+
+    totals = [modules["bot"][1] / 1000 for modules in runs]
+    print(f"import bot: median {statistics.median(totals):.1f} ms, min {min(totals):.1f} ms, first run {totals[0]:.1f} ms")
+
+    # the slowest modules of the last run (warm .pyc files), by their own import time
+    modules = runs[-1]
+    print(f"\n{'self ms':>9} {'cumulative ms':>14}  module")
+    for name, (self_us, cumulative_us) in sorted(modules.items(), key=lambda item: -item[1][0])[:args.top]:
+        print(f"{self_us / 1000:>9.1f} {cumulative_us / 1000:>14.1f}  {name}")
+
+    imported_lazy_modules = [name for name in LAZY_MODULES if name in modules]
+    print(f"\nlazy modules imported at startup: {', '.join(imported_lazy_modules) or 'none'}")
+
+    failed = len(imported_lazy_modules) > 0
+    if args.max_ms is not None and statistics.median(totals) > args.max_ms:
+        print(f"median import time is above {args.max_ms} ms")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,548 @@
+# End-to-end load test: runs the bot (build_application, polling) against a fake Telegram Bot API and a fake
+# OpenAI API, drives simulated users and reports latencies, throughput, Mongo operations and event loop lag.
+# Users send text, voice messages (Whisper, spoken answers) and documents (PDF and .md, summarized first):
+#
+#   python bench/load_test.py --users 200 --messages 5 --voice-share 0.2 --document-share 0.1
+#
+# Speech synthesis has no HTTP endpoint to fake, the Azure SDK call is replaced by a blocking sleep of --tts-delay.
+# The fakes run in their own thread and event loop, so they don't add to the bot's event loop lag.
+# Uses MongoDB from config/config.env (or an in-memory mongomock_motor database with --mongomock).
+# For every Database method it reports how long its calls keep the event loop busy: with Motor only the driver's
+# overhead, mongomock_motor runs the operations on the event loop like a synchronous driver does
+import argparse
+import asyncio
+import inspect
+import json
+import random
+import statistics
+import sys
+import threading
+import time
+from pathlib import Path
+
+from aiohttp import web
+
+ROOT_DIR = Path(__file__).parent.parent.resolve()
+sys.path.insert(0, str(ROOT_DIR / "bot"))
+sys.path.insert(0, str(ROOT_DIR / "tests"))
+
+import config  # noqa: E402
+from test_pdf import make_pdf  # noqa: E402
+
+TOKEN = "123456:load-test"
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Botty", "username": "botty_load_test_bot"}
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return float("nan")
+    values = sorted(values)
+    return values[min(int(round(p / 100 * (len(values) - 1))), len(values) - 1)]
+
+
+class FakeBotAPI:
+    # the Bot API methods the bot uses. Updates are handed out by getUpdates (long polling),
+    # sent and edited messages are reported to on_message(chat_id, text, time).
+    # Files added with add_file are served by getFile and the file download endpoint
+    def __init__(self, on_message):
+        self.on_message = on_message
+        self.files = {}  # file id -> bytes
+
+        self._updates = []
+        self._new_updates = None
+        self._next_message_id = 1_000_000
+
+        self.n_requests = {}
+
+    def add_update(self, update: dict):
+        # called in the fake's event loop
+        self._updates.append(update)
+        self._new_updates.set()
+
+    async def start(self, host: str = "127.0.0.1"):
+        self._new_updates = asyncio.Event()
+
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        app.router.add_get("/file/bot{token}/{file_path:.+}", self._handle_file)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, 0)
+        await site.start()
+        self.url = f"http://{host}:{self._runner.addresses[0][1]}/bot"
+        self.file_url = f"http://{host}:{self._runner.addresses[0][1]}/file/bot"
+
+    def add_file(self, file_id: str, data: bytes):
+        self.files[file_id] = data
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    async def _handle(self, request):
+        method = request.match_info["method"]
+        self.n_requests[method] = self.n_requests.get(method, 0) + 1
+
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = {key: value for key, value in (await request.post()).items()}
+
+        handler = getattr(self, f"_{method}", None)
+        result = True if handler is None else await handler(params)
+        return web.json_response({"ok": True, "result": result})
+
+    async def _getMe(self, params):
+        return BOT_USER
+
+    async def _getUpdates(self, params):
+        offset = int(params.get("offset") or 0)
+        self._updates = [update for update in self._updates if update["update_id"] >= offset]
+        if len(self._updates) == 0:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+
+        limit = int(params.get("limit") or 100)
+        return self._updates[:limit]
+
+    async def _getFile(self, params):
+        file_id = params["file_id"]
+        return {"file_id": file_id, "file_unique_id": file_id, "file_size": len(self.files[file_id]), "file_path": f"files/{file_id}"}
+
+    async def _handle_file(self, request):
+        self.n_requests["file"] = self.n_requests.get("file", 0) + 1
+        return web.Response(body=self.files[request.match_info["file_path"].split("/")[-1]])
+
+    def _message(self, params, message_id):
+        chat_id = int(params["chat_id"])
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": params.get("text", ""),
+        }
+
+    async def _sendMessage(self, params):
+        self._next_message_id += 1
+        self.on_message(int(params["chat_id"]), params.get("text", ""), time.perf_counter())
+        return self._message(params, self._next_message_id)
+
+    async def _editMessageText(self, params):
+        self.on_message(int(params["chat_id"]), params.get("text", ""), time.perf_counter())
+        return self._message(params, int(params["message_id"]))
+
+    async def _sendVoice(self, params):
+        self._next_message_id += 1
+        return self._message({"chat_id": params["chat_id"]}, self._next_message_id)
+
+
+class FakeOpenAI:
+    # chat/completions streaming a fixed answer, one word per chunk (summaries get it at once),
+    # audio/transcriptions answering with a fixed text after transcription_delay
+    def __init__(self, answer: str, first_token_delay: float, token_interval: float, transcription_delay: float = 0.5):
+        self.words = [word + " " for word in answer.split(" ")]
+        self.words[-1] = self.words[-1].rstrip()
+        self.first_token_delay = first_token_delay
+        self.token_interval = token_interval
+        self.transcription_delay = transcription_delay
+
+        self.n_requests = 0
+        self.n_summaries = 0
+        self.n_transcriptions = 0
+        self.n_running = 0
+        self.max_running = 0
+
+    async def start(self, host: str = "127.0.0.1"):
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self._handle_chat_completions)
+        app.router.add_post("/v1/audio/transcriptions", self._handle_transcriptions)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, 0)
+        await site.start()
+        self.url = f"http://{host}:{self._runner.addresses[0][1]}/v1"
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    def _chunk(self, delta, finish_reason=None):
+        return {
+            "id": "chatcmpl-load-test",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": "gpt-3.5-turbo",
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+
+    async def _handle_chat_completions(self, request):
+        body = await request.json()
+        self.n_requests += 1
+        self.n_running += 1
+        self.max_running = max(self.max_running, self.n_running)
+        try:
+            await asyncio.sleep(self.first_token_delay)
+            if not body.get("stream"):
+                self.n_summaries += 1
+                return web.json_response({
+                    "id": "chatcmpl-load-test",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": "gpt-3.5-turbo",
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(self.words)}, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": 0, "completion_tokens": len(self.words), "total_tokens": len(self.words)},
+                })
+
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await response.prepare(request)
+            await response.write(b"data: " + json.dumps(self._chunk({"role": "assistant"})).encode() + b"\n\n")
+            for i, word in enumerate(self.words):
+                if i > 0:
+                    await asyncio.sleep(self.token_interval)
+                await response.write(b"data: " + json.dumps(self._chunk({"content": word})).encode() + b"\n\n")
+            await response.write(b"data: " + json.dumps(self._chunk({}, "stop")).encode() + b"\n\n")
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+            return response
+        finally:
+            self.n_running -= 1
+
+    async def _handle_transcriptions(self, request):
+        await request.post()  # the uploaded audio
+        self.n_transcriptions += 1
+        await asyncio.sleep(self.transcription_delay)
+        return web.json_response({"text": "Question asked in a voice message"})
+
+
+class FakeServers:
+    # runs the fakes in a thread with its own event loop
+    def __init__(self, bot_api: FakeBotAPI, openai_api: FakeOpenAI):
+        self.bot_api = bot_api
+        self.openai_api = openai_api
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self.bot_api.start(), self.loop).result()
+        asyncio.run_coroutine_threadsafe(self.openai_api.start(), self.loop).result()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.bot_api.stop(), self.loop).result()
+        asyncio.run_coroutine_threadsafe(self.openai_api.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+    def add_update(self, update: dict):
+        self.loop.call_soon_threadsafe(self.bot_api.add_update, update)
+
+    def add_file(self, file_id: str, data: bytes):
+        self.loop.call_soon_threadsafe(self.bot_api.add_file, file_id, data)
+
+
+class StepTimer:
+    # awaits a coroutine step by step and adds up the time its steps run on the event loop, i.e. how long it keeps
+    # other tasks from running. A blocking call is one long step, an awaited network round trip isn't counted
+    def __init__(self, coro):
+        self.coro = coro
+        self.loop_time = 0.0
+
+    def __await__(self):
+        value, error = None, None
+        while True:
+            start_time = time.perf_counter()
+            try:
+                future = self.coro.send(value) if error is None else self.coro.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                self.loop_time += time.perf_counter() - start_time
+
+            try:
+                value, error = (yield future), None
+            except BaseException as e:
+                value, error = None, e
+
+
+class PendingMessage:
+    def __init__(self, sent_time: float):
+        self.sent_time = sent_time
+        self.first_token_time = None
+        self.outcome = None  # answered, rejected or failed
+        self.done = asyncio.get_running_loop().create_future()
+
+    def finish(self, outcome: str, timestamp: float):
+        if not self.done.done():
+            self.outcome = outcome
+            self.done.set_result(timestamp)
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.answer = " ".join(f"word{i}" for i in range(args.answer_words))
+        self.rng = random.Random(args.seed)
+
+        self.loop = None
+        self.servers = None
+        self._pending = {}  # chat id -> PendingMessage
+        self._next_update_id = 1
+        self._next_message_id = 1
+
+        self.first_token_times = []
+        self.final_edit_times = []
+        self.final_edit_times_by_kind = {"text": [], "voice": [], "pdf": [], "md": []}
+        self.n_timeouts = 0
+        self.n_rejected = 0
+        self.n_failed = 0
+        self.db_loop_times = {}  # Database method -> event loop time of its calls
+        self.loop_lags = []
+
+    def on_message(self, chat_id: int, text: str, timestamp: float):
+        # called in the fakes' thread
+        self.loop.call_soon_threadsafe(self._on_message, chat_id, text.strip(), timestamp)
+
+    def _on_message(self, chat_id: int, text: str, timestamp: float):
+        pending = self._pending.get(chat_id)
+        if pending is None or len(text) == 0:
+            return
+        if "<b>wait</b> for a reply" in text:  # the previous answer isn't done yet, e.g. it's still spoken
+            pending.finish("rejected", timestamp)
+            return
+        if text.startswith("Something went wrong"):
+            pending.finish("failed", timestamp)
+            return
+        if not self.answer.startswith(text):
+            return
+
+        if pending.first_token_time is None:
+            pending.first_token_time = timestamp
+        if text == self.answer:
+            pending.finish("answered", timestamp)
+
+    def _make_update(self, user_id: int, **content):
+        # content: text, voice or document of the message
+        update = {
+            "update_id": self._next_update_id,
+            "message": {
+                "message_id": self._next_message_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private", "first_name": f"User {user_id}"},
+                "from": {"id": user_id, "is_bot": False, "first_name": f"User {user_id}", "username": f"user{user_id}"},
+                **content,
+            },
+        }
+        self._next_update_id += 1
+        self._next_message_id += 1
+        return update
+
+    def _make_message(self, user_id: int, i: int):
+        # returns the kind and the update of the user's i-th message. Every document has other content,
+        # so its summary isn't cached
+        kind = "text"
+        x = self.rng.random()
+        if x < self.args.voice_share:
+            kind = "voice"
+        elif x < self.args.voice_share + self.args.document_share:
+            kind = self.rng.choice(["pdf", "md"])
+
+        if kind == "text":
+            return kind, self._make_update(user_id, text=f"Question {i} of user {user_id}")
+
+        file_id = f"{kind}-{user_id}-{i}"
+        if kind == "voice":
+            data = b"OggS" + bytes(self.args.voice_size)
+            self.servers.add_file(file_id, data)
+            voice = {"file_id": file_id, "file_unique_id": file_id, "duration": 5, "mime_type": "audio/ogg", "file_size": len(data)}
+            return kind, self._make_update(user_id, voice=voice)
+
+        page_texts = [f"Page {page} of document {file_id} " + " ".join(f"word{j}" for j in range(50)) for page in range(self.args.document_pages)]
+        if kind == "pdf":
+            data, file_name, mime_type = make_pdf(page_texts), f"{file_id}.pdf", "application/pdf"
+        else:
+            data, file_name, mime_type = "\n\n".join(page_texts).encode(), f"{file_id}.md", "text/markdown"
+        self.servers.add_file(file_id, data)
+        document = {"file_id": file_id, "file_unique_id": file_id, "file_name": file_name, "mime_type": mime_type, "file_size": len(data)}
+        return kind, self._make_update(user_id, document=document)
+
+    def _synthesize(self, text: str) -> bytes:
+        # replaces the Azure SDK call, blocks its thread like the SDK does
+        time.sleep(self.args.tts_delay)
+        return b"OggS" + bytes(1000)
+
+    async def _run_user(self, user_id: int, start_delay: float):
+        await asyncio.sleep(start_delay)
+        for i in range(self.args.messages):
+            kind, update = self._make_message(user_id, i)
+            pending = self._pending[user_id] = PendingMessage(time.perf_counter())
+            self.servers.add_update(update)
+            try:
+                final_time = await asyncio.wait_for(asyncio.shield(pending.done), self.args.timeout)
+            except asyncio.TimeoutError:
+                self.n_timeouts += 1
+                continue
+            finally:
+                del self._pending[user_id]
+
+            if pending.outcome != "answered":
+                if pending.outcome == "rejected":
+                    self.n_rejected += 1
+                else:
+                    self.n_failed += 1
+                await asyncio.sleep(self.args.think_time)
+                continue
+
+            self.first_token_times.append(pending.first_token_time - pending.sent_time)
+            self.final_edit_times.append(final_time - pending.sent_time)
+            self.final_edit_times_by_kind[kind].append(final_time - pending.sent_time)
+            await asyncio.sleep(self.args.think_time)
+
+    def _instrument_database(self, db):
+        # calls of Database methods made by other Database methods are counted for both
+        for name, method in inspect.getmembers(db, inspect.iscoroutinefunction):
+            if not name.startswith("_"):
+                setattr(db, name, self._time_database_method(name, method))
+
+    def _time_database_method(self, name, method):
+        async def timed_method(*args, **kwargs):
+            timer = StepTimer(method(*args, **kwargs))
+            try:
+                return await timer
+            finally:
+                self.db_loop_times.setdefault(name, []).append(timer.loop_time)
+        return timed_method
+
+    async def _monitor_loop_lag(self, interval: float = 0.01):
+        while True:
+            start_time = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.loop_lags.append(time.perf_counter() - start_time - interval)
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        bot_api = FakeBotAPI(self.on_message)
+        openai_api = FakeOpenAI(self.answer, self.args.first_token_delay, self.args.token_interval, self.args.transcription_delay)
+        self.servers = FakeServers(bot_api, openai_api)
+        self.servers.start()
+
+        # the bot reads these when its clients are created
+        config.telegram_token = TOKEN
+        config.telegram_base_url = bot_api.url
+        config.telegram_base_file_url = bot_api.file_url
+        config.openai_api_base = openai_api.url
+        config.openai_api_key = "sk-load-test"
+        config.metrics_port = None
+
+        import bot
+        import database
+
+        if self.args.mongomock:
+            import mongomock_motor
+
+            client = mongomock_motor.AsyncMongoMockClient()
+            database_class = database.Database
+            database.Database = lambda: database_class(client=client)
+
+        bot.speech_synthesizer._synthesize = self._synthesize
+
+        application = bot.build_application()
+        await application.initialize()
+        await application.post_init(application)
+        self._instrument_database(bot.db)
+        await application.updater.start_polling(poll_interval=0.0, timeout=1)
+        await application.start()
+        n_operations_before = bot.db.n_operations
+        n_edits_before = bot.edit_scheduler.n_edits
+
+        lag_monitor = asyncio.ensure_future(self._monitor_loop_lag())
+        start_time = time.perf_counter()
+        try:
+            await asyncio.gather(*[
+                self._run_user(1000 + i, self.args.ramp_up * i / self.args.users)
+                for i in range(self.args.users)
+            ])
+        finally:
+            duration = time.perf_counter() - start_time
+            lag_monitor.cancel()
+
+            await application.updater.stop()
+            await application.stop()
+            await application.post_shutdown(application)  # flushes the buffered usage
+            await application.shutdown()
+            self.servers.stop()
+
+        n_messages = len(self.final_edit_times)
+        self.report({
+            "duration": duration,
+            "n_messages": n_messages,
+            "n_operations": bot.db.n_operations - n_operations_before,
+            "n_edits": bot.edit_scheduler.n_edits - n_edits_before,
+            "n_openai_requests": openai_api.n_requests,
+            "n_openai_summaries": openai_api.n_summaries,
+            "n_openai_transcriptions": openai_api.n_transcriptions,
+            "max_openai_running": openai_api.max_running,
+            "telegram_requests": bot_api.n_requests,
+        })
+
+    def report(self, stats):
+        n_messages = max(stats["n_messages"], 1)
+        lines = [
+            f"users: {self.args.users}, messages per user: {self.args.messages}, answer: {self.args.answer_words} words",
+            f"answered: {stats['n_messages']}, timed out: {self.n_timeouts}, rejected: {self.n_rejected}, failed: {self.n_failed}, duration: {stats['duration']:.1f} s",
+            f"throughput: {stats['n_messages'] / stats['duration']:.1f} messages/s",
+        ]
+        for name, values in [("time to first token", self.first_token_times), ("time to final edit", self.final_edit_times)]:
+            lines.append(
+                f"{name}: p50 {percentile(values, 50) * 1000:.0f} ms, p95 {percentile(values, 95) * 1000:.0f} ms, "
+                f"p99 {percentile(values, 99) * 1000:.0f} ms, max {max(values, default=float('nan')) * 1000:.0f} ms"
+            )
+        for kind, values in self.final_edit_times_by_kind.items():
+            if len(values) > 0:
+                lines.append(f"  {kind} ({len(values)}): p50 {percentile(values, 50) * 1000:.0f} ms, p95 {percentile(values, 95) * 1000:.0f} ms")
+        lines += [
+            f"event loop lag: mean {statistics.fmean(self.loop_lags or [0]) * 1000:.1f} ms, "
+            f"p99 {percentile(self.loop_lags, 99) * 1000:.1f} ms, max {max(self.loop_lags, default=0) * 1000:.1f} ms",
+            f"mongo operations per message: {stats['n_operations'] / n_messages:.2f}",
+            "event loop time per database call:",
+        ]
+        for name, values in sorted(self.db_loop_times.items()):
+            lines.append(
+                f"  {name} ({len(values)}): p50 {percentile(values, 50) * 1000:.3f} ms, "
+                f"p99 {percentile(values, 99) * 1000:.3f} ms, max {max(values) * 1000:.3f} ms"
+            )
+        lines += [
+            f"telegram sends + edits per message: {stats['n_edits'] / n_messages:.2f}",
+            f"openai requests: {stats['n_openai_requests']} (summaries: {stats['n_openai_summaries']}), "
+            f"transcriptions: {stats['n_openai_transcriptions']}, max in flight: {stats['max_openai_running']}",
+            f"telegram requests: {json.dumps(stats['telegram_requests'], sort_keys=True)}",
+        ]
+        print("\n".join(lines))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the bot against fake Telegram and OpenAI servers")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=3, help="messages per user, sent one after another")
+    parser.add_argument("--ramp-up", type=float, default=1.0, help="seconds until all users are active")
+    parser.add_argument("--think-time", type=float, default=0.0, help="seconds between a user's messages")
+    parser.add_argument("--answer-words", type=int, default=100)
+    parser.add_argument("--first-token-delay", type=float, default=0.3, help="seconds until the fake OpenAI streams")
+    parser.add_argument("--token-interval", type=float, default=0.02, help="seconds between streamed words")
+    parser.add_argument("--timeout", type=float, default=60.0, help="seconds to wait for an answer")
+    parser.add_argument("--voice-share", type=float, default=0.0, help="share of messages sent as voice messages")
+    parser.add_argument("--document-share", type=float, default=0.0, help="share of messages sent as PDF or .md documents")
+    parser.add_argument("--document-pages", type=int, default=200, help="pages (paragraphs of .md files) per document")
+    parser.add_argument("--voice-size", type=int, default=20_000, help="bytes per voice message")
+    parser.add_argument("--transcription-delay", type=float, default=0.5, help="seconds the fake Whisper takes")
+    parser.add_argument("--tts-delay", type=float, default=0.3, help="seconds a spoken clip takes to synthesize")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the message mix")
+    parser.add_argument("--mongomock", action="store_true", help="use an in-memory database instead of MongoDB")
+    args = parser.parse_args()
+
+    asyncio.run(LoadTest(args).run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+# Benchmark of the pooled OpenAI HTTP session: streams chat completions from the fake OpenAI API of load_test.py
+# with ChatGPT's pooled session and with a new session per request (openai's default without aiosession), and
+# reports the latency saved per request. The fake is plain HTTP on localhost, so only the TCP handshake is saved
+# here, against api.openai.com the TLS handshake and DNS lookup are saved as well.
+#
+#   python bench/openai_session.py --requests 200 --concurrency 10
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.resolve()))
+
+from load_test import FakeBotAPI, FakeOpenAI, FakeServers, percentile  # noqa: E402
+
+import config  # noqa: E402
+import openai_utils  # noqa: E402
+
+
+async def stream_completion(openai):
+    # returns the time to the first chunk and to the end of the stream
+    start_time = time.perf_counter()
+    first_chunk_time = None
+    r_gen = await openai.ChatCompletion.acreate(
+        model=openai_utils.model,
+        messages=[{"role": "user", "content": "Hello"}],
+        stream=True,
+        request_timeout=config.openai_request_timeout
+    )
+    async for r_item in r_gen:
+        if first_chunk_time is None:
+            first_chunk_time = time.perf_counter()
+    return first_chunk_time - start_time, time.perf_counter() - start_time
+
+
+async def measure(chatgpt, openai, n_requests, concurrency, pooled):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def request():
+        async with semaphore:
+            if pooled:
+                chatgpt._use_session()
+            else:
+                openai.aiosession.set(None)
+            return await stream_completion(openai)
+
+    # every request runs in its own task, so the session context variable is set per request
+    return await asyncio.gather(*[asyncio.ensure_future(request()) for _ in range(n_requests)])
+
+
+async def run(args):
+    openai_api = FakeOpenAI("Hi there", args.first_token_delay, token_interval=0.0)
+    servers = FakeServers(FakeBotAPI(lambda *args: None), openai_api)
+    servers.start()
+
+    config.openai_api_base = openai_api.url
+    config.openai_api_key = "sk-bench"
+    openai = openai_utils.load_openai()
+    chatgpt = openai_utils.ChatGPT()
+    await chatgpt.open()
+
+    try:
+        results = {}
+        for pooled in (False, True, False, True):  # alternated, so neither profits from a warmer machine
+            name = "pooled" if pooled else "per request"
+            results.setdefault(name, []).extend(await measure(chatgpt, openai, args.requests, args.concurrency, pooled))
+    finally:
+        await chatgpt.close()
+        servers.stop()
+
+    print(f"requests: {2 * args.requests} per variant, concurrency: {args.concurrency}")
+    medians = {}
+    for name, times in results.items():
+        first_chunk_times = [first_chunk_time for first_chunk_time, total_time in times]
+        total_times = [total_time for first_chunk_time, total_time in times]
+        medians[name] = statistics.median(total_times)
+        print(
+            f"{name:>12}: first chunk p50 {percentile(first_chunk_times, 50) * 1000:.2f} ms, "
+            f"p95 {percentile(first_chunk_times, 95) * 1000:.2f} ms, "
+            f"whole stream p50 {percentile(total_times, 50) * 1000:.2f} ms, p95 {percentile(total_times, 95) * 1000:.2f} ms"
+        )
+    print(f"saved per request (p50 of the whole stream): {(medians['per request'] - medians['pooled']) * 1000:.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the pooled OpenAI session with a session per request")
+    parser.add_argument("--requests", type=int, default=200, help="requests per variant and round")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--first-token-delay", type=float, default=0.0, help="seconds until the fake OpenAI streams")
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
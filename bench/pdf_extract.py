@@ -0,0 +1,96 @@
+# Benchmark of PDF text extraction on synthetic documents of several hundred pages: pages per second with the
+# worker processes of pdf.py, and how much the extraction blocks the event loop compared to extracting the
+# pages in the event loop's thread, as the bot did before.
+#
+#   python bench/pdf_extract.py --pages 200 500 --runs 3
+import argparse
+import asyncio
+import io
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).parent.parent.resolve()
+sys.path.insert(0, str(ROOT_DIR / "bot"))
+sys.path.insert(0, str(ROOT_DIR / "tests"))
+
+import config  # noqa: E402
+import pdf  # noqa: E402
+from test_pdf import make_pdf  # noqa: E402
+
+
+def make_document(n_pages, n_words):
+    return make_pdf([f"Page {page} " + " ".join(f"word{i}" for i in range(n_words)) for page in range(n_pages)])
+
+
+def extract_in_loop_thread(data):
+    import PyPDF2
+
+    read_pdf = PyPDF2.PdfReader(io.BytesIO(data))
+    return "".join(page.extract_text() for page in read_pdf.pages[:config.pdf_max_pages])
+
+
+async def measure(extract, data, interval=0.005):
+    # returns the duration of extract() and the largest delay of a timer during it
+    lags = []
+
+    async def monitor():
+        while True:
+            start_time = time.perf_counter()
+            await asyncio.sleep(interval)
+            lags.append(time.perf_counter() - start_time - interval)
+
+    monitor_task = asyncio.ensure_future(monitor())
+    await asyncio.sleep(0)
+    start_time = time.perf_counter()
+    try:
+        await extract(data)
+        duration = time.perf_counter() - start_time
+        await asyncio.sleep(2 * interval)  # a timer delayed by the extraction fires now
+    finally:
+        monitor_task.cancel()
+    return duration, max(lags, default=0.0)
+
+
+async def extract_with_workers(data):
+    return await pdf.extract_text(data)
+
+
+async def extract_blocking(data):
+    return extract_in_loop_thread(data)
+
+
+async def run(args):
+    config.pdf_max_pages = max(config.pdf_max_pages, max(args.pages))
+    config.pdf_timeout = max(config.pdf_timeout, 600)
+
+    # the first extraction starts the workers
+    await pdf.extract_text(make_document(10, 10))
+
+    print(f"workers: {config.pdf_max_workers or os.cpu_count()}, pages per task: {config.pdf_pages_per_task}")
+    print(f"{'pages':>6} {'extraction':>12} {'pages/s':>9} {'max loop lag ms':>16}")
+    for n_pages in args.pages:
+        data = make_document(n_pages, args.words)
+        for name, extract in [("workers", extract_with_workers), ("event loop", extract_blocking)]:
+            results = [await measure(extract, data) for _ in range(args.runs)]
+            duration = statistics.median(duration for duration, max_lag in results)
+            max_lag = statistics.median(max_lag for duration, max_lag in results)
+            print(f"{n_pages:>6} {name:>12} {n_pages / duration:>9.0f} {max_lag * 1000:>16.1f}")
+
+    pdf.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure PDF extraction throughput and event loop blocking")
+    parser.add_argument("--pages", type=int, nargs="+", default=[200, 500])
+    parser.add_argument("--words", type=int, default=200, help="words per page")
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+# Benchmark of the CPU time of streaming a ~4k token answer: the deltas go through MessageStream to a message whose
+# sends and edits do nothing, compared with the loop the bot had before, which accumulated the whole answer on
+# every token and sliced it to the Telegram limit. CPU time (not wall time) is measured, the rate limiter's
+# waits don't count.
+#
+#   python bench/stream_cpu.py --tokens 4000 --runs 20
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.resolve() / "bot"))
+
+import streaming  # noqa: E402
+
+
+class NoOpMessage:
+    chat_id = 1
+
+    async def reply_text(self, text, parse_mode=None):
+        return self
+
+    async def edit_text(self, text, parse_mode=None):
+        pass
+
+
+async def stream_deltas(deltas):
+    for i, delta in enumerate(deltas):
+        if i % 10 == 0:  # chunks arrive from the network in batches, other tasks run in between
+            await asyncio.sleep(0)
+        yield delta
+
+
+async def stream_accumulated(deltas):
+    # what send_message_stream yielded before: the whole answer so far
+    answer = ""
+    for i, delta in enumerate(deltas):
+        if i % 10 == 0:
+            await asyncio.sleep(0)
+        answer += delta
+        yield answer
+
+
+async def run_baseline(deltas, scheduler):
+    # only receives the deltas, the cost both loops share
+    async for delta in stream_deltas(deltas):
+        pass
+
+
+async def run_message_stream(deltas, scheduler):
+    stream = scheduler.stream(NoOpMessage(), "HTML")
+    parts = []
+    async for delta in stream_deltas(deltas):
+        parts.append(delta)
+        stream.append(delta)
+    await stream.finish("".join(parts))
+
+
+async def run_accumulate_and_slice(deltas, scheduler):
+    # the loop of the bot before: slice on every token, edit after 100 new characters
+    message = NoOpMessage()
+    prev_answer = ""
+    async for answer in stream_accumulated(deltas):
+        answer = answer[:streaming.TELEGRAM_MESSAGE_LIMIT]
+        if abs(len(answer) - len(prev_answer)) < 100:
+            continue
+        await message.edit_text(answer)
+        prev_answer = answer
+
+
+async def measure(run, deltas, scheduler, n_runs):
+    times = []
+    for _ in range(n_runs):
+        start_time = time.process_time()
+        await run(deltas, scheduler)
+        times.append(time.process_time() - start_time)
+    return statistics.median(times)
+
+
+async def main_async(args):
+    deltas = [f" word{i}" for i in range(args.tokens)]
+    scheduler = streaming.EditScheduler(args.edits_per_second_per_chat, edits_per_second=1000)
+
+    print(f"answer: {args.tokens} deltas, {len(''.join(deltas))} characters")
+    baseline_cpu_time = await measure(run_baseline, deltas, scheduler, args.runs)
+    print(f"{'receiving the deltas':>22}: {baseline_cpu_time * 1000:.2f} ms CPU per answer")
+    for name, run in [("accumulate and slice", run_accumulate_and_slice), ("MessageStream", run_message_stream)]:
+        cpu_time = await measure(run, deltas, scheduler, args.runs)
+        print(f"{name:>22}: {cpu_time * 1000:.2f} ms CPU per answer, {(cpu_time - baseline_cpu_time) * 1000:.2f} ms on top of receiving")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the CPU time of streaming an answer")
+    parser.add_argument("--tokens", type=int, default=4000, help="deltas per answer")
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--edits-per-second-per-chat", type=float, default=20.0)
+    args = parser.parse_args()
+
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+# Microbenchmark of the token accounting of an answer: fitting the dialog into the context window, the scheduler's
+# token estimate and the used tokens, for dialogs of 10, 100 and 1000 turns. Drives ChatGPT.send_message_stream
+# against an instant fake OpenAI stream, so the time is spent on tokenizing and counting.
+# "stored" dialog messages carry their token counts (n_user_tokens, n_bot_tokens), "recounted" ones are older
+# dialog messages without them, which are tokenized on every request
+#
+#   python bench/token_count.py --turns 10 100 1000
+import argparse
+import asyncio
+import random
+import statistics
+import sys
+import time
+import types
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.resolve() / "bot"))
+
+import config  # noqa: E402
+import openai_utils  # noqa: E402
+import tokenizer  # noqa: E402
+
+WORDS = "the bot answers questions about documents videos and links with short clear sentences".split()
+
+
+class Delta(dict):
+    def __getattr__(self, key):
+        return self[key]
+
+
+def make_text(rng, n_words):
+    return " ".join(rng.choice(WORDS) for _ in range(n_words))
+
+
+def make_dialog(rng, n_turns, model, stored):
+    dialog_messages = []
+    for _ in range(n_turns):
+        dialog_message = {"user": make_text(rng, 40), "bot": make_text(rng, 150)}
+        if stored:
+            dialog_message["n_user_tokens"] = tokenizer.count_tokens(dialog_message["user"], model)
+            dialog_message["n_bot_tokens"] = tokenizer.count_tokens(dialog_message["bot"], model)
+        dialog_messages.append(dialog_message)
+    return dialog_messages
+
+
+async def measure(chatgpt, message, dialog_messages, min_time):
+    # returns the median time of a request, the tokenizations per request and the last item of the stream
+    n_tokenized = 0
+    count_tokens = tokenizer.count_tokens
+
+    def counting_count_tokens(text, model=None):
+        nonlocal n_tokenized
+        n_tokenized += 1
+        return count_tokens(text, model)
+
+    tokenizer.count_tokens = counting_count_tokens
+    times = []
+    try:
+        start_time = time.perf_counter()
+        while time.perf_counter() - start_time < min_time or len(times) < 5:
+            request_start_time = time.perf_counter()
+            gen = chatgpt.send_message_stream(message, dialog_messages=dialog_messages, chat_mode=config.default_chat_mode)
+            async for item in gen:
+                pass
+            times.append(time.perf_counter() - request_start_time)
+    finally:
+        tokenizer.count_tokens = count_tokens
+
+    return statistics.median(times), n_tokenized / len(times), item
+
+
+async def run(args):
+    rng = random.Random(0)
+    openai = openai_utils.load_openai()
+    answer_deltas = [f" {word}" for word in make_text(rng, args.answer_words).split()]
+
+    async def acreate(**kwargs):
+        async def gen():
+            for delta in answer_deltas:
+                yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=Delta(content=delta))])
+        return gen()
+
+    openai.ChatCompletion.acreate = acreate
+    openai_utils.scheduler = openai_utils.Scheduler(max_concurrency=1)  # without budgets, nothing waits
+    chatgpt = openai_utils.ChatGPT()
+    tokenizer.preload([chatgpt.model])
+    message = make_text(rng, 40)
+
+    print(f"{'turns':>6} {'dialog messages':>16} {'ms/request':>11} {'tokenizations':>14} {'kept turns':>11}")
+    for n_turns in args.turns:
+        for stored in (False, True):
+            dialog_messages = make_dialog(rng, n_turns, chatgpt.model, stored)
+            median_time, n_tokenized, item = await measure(chatgpt, message, dialog_messages, args.min_time)
+            n_kept = n_turns - item[3]
+            print(f"{n_turns:>6} {'stored' if stored else 'recounted':>16} {median_time * 1000:>11.3f} {n_tokenized:>14.1f} {n_kept:>11}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the token accounting of a request for dialogs of several lengths")
+    parser.add_argument("--turns", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--answer-words", type=int, default=300)
+    parser.add_argument("--min-time", type=float, default=1.0, help="seconds to repeat each measurement")
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
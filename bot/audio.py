@@ -0,0 +1,163 @@
+import asyncio
+import concurrent.futures
+import io
+import re
+import threading
+
+import config
+import metrics
+
+
+class SpeechSynthesizer:
+    # Azure TTS. The SDK blocks until the synthesis is done, so it runs in a bounded thread pool
+    # with one SDK synthesizer per thread. The SDK is only loaded with the first synthesis
+    def __init__(self, key: str, region: str, voice: str = None, max_workers: int = 4):
+        self.key = key
+        self.region = region
+        self.voice = voice
+        self.max_workers = max_workers
+
+        self.executor = None
+        self.speech_config = None
+        self._speech_config_lock = threading.Lock()
+        self._local = threading.local()
+
+    def _get_speech_config(self):
+        with self._speech_config_lock:
+            if self.speech_config is None:
+                import azure.cognitiveservices.speech as speechsdk
+
+                speech_config = speechsdk.SpeechConfig(subscription=self.key, region=self.region)
+                speech_config.speech_synthesis_voice_name = self.voice
+                speech_config.set_speech_synthesis_output_format(speechsdk.SpeechSynthesisOutputFormat.Ogg16Khz16BitMonoOpus)
+                self.speech_config = speech_config
+            return self.speech_config
+
+    def _get_synthesizer(self):
+        if not hasattr(self._local, "synthesizer"):
+            import azure.cognitiveservices.speech as speechsdk
+
+            # audio_config=None: keep the audio in memory instead of playing it
+            self._local.synthesizer = speechsdk.SpeechSynthesizer(speech_config=self._get_speech_config(), audio_config=None)
+        return self._local.synthesizer
+
+    def _synthesize(self, text: str) -> bytes:
+        import azure.cognitiveservices.speech as speechsdk
+
+        result = self._get_synthesizer().speak_text_async(text).get()
+        if result.reason == speechsdk.ResultReason.Canceled:
+            raise ValueError(f"Speech synthesis failed: {result.cancellation_details.error_details}")
+        return result.audio_data
+
+    async def synthesize(self, text: str) -> bytes:
+        # returns OGG/Opus audio
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="tts")
+
+        loop = asyncio.get_running_loop()
+        with metrics.stage_seconds.labels("tts").time():
+            return await loop.run_in_executor(self.executor, self._synthesize, text)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+
+_ffmpeg_semaphore = None
+
+
+async def convert_audio(data: bytes, format: str = "mp3") -> bytes:
+    # transcodes with an ffmpeg subprocess through pipes, at most ffmpeg_max_concurrency at a time
+    global _ffmpeg_semaphore
+    if _ffmpeg_semaphore is None:
+        _ffmpeg_semaphore = asyncio.Semaphore(config.ffmpeg_max_concurrency)
+
+    async with _ffmpeg_semaphore:
+        process = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-loglevel", "error", "-i", "pipe:0", "-f", format, "pipe:1",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await process.communicate(data)
+
+    if process.returncode != 0:
+        raise ValueError(f"Audio conversion failed: {stderr.decode(errors='replace')}")
+    return stdout
+
+
+async def prepare_for_transcription(data: bytes):
+    # Whisper accepts Telegram's OGG voice messages as they are, re-encoding to mp3 is optional
+    if config.whisper_convert_to_mp3:
+        audio_file = io.BytesIO(await convert_audio(data, format="mp3"))
+        audio_file.name = "voice.mp3"
+    else:
+        audio_file = io.BytesIO(data)
+        audio_file.name = "voice.ogg"  # openai uses the name to tell Whisper the format
+
+    return audio_file
+
+
+# whitespace after the end of a sentence or line
+SENTENCE_END_PATTERN = re.compile(r"(?<=[.!?…:;])\s+|\n+")
+
+
+class SpeechStream:
+    # speaks an answer while it's still being generated: the text is cut at sentence ends into clips of
+    # at least min_chars characters, clips are synthesized concurrently and sent in order
+    def __init__(self, synthesizer: SpeechSynthesizer, send_voice, min_chars: int = 200):
+        self.synthesizer = synthesizer
+        self.send_voice = send_voice  # async callable getting the audio bytes
+        self.min_chars = min_chars
+
+        self._text = ""  # not yet synthesized
+        self._clips = asyncio.Queue()  # synthesis tasks in answer order, None at the end
+        self._sender_task = None
+
+    def append(self, delta: str):
+        self._text += delta
+        if len(self._text) < self.min_chars:
+            return
+
+        # cut after the last complete sentence. Earlier text had no sentence end past min_chars,
+        # so only the new text needs to be scanned
+        end = None
+        scan_start = max(self.min_chars, len(self._text) - len(delta)) - 1
+        for match in SENTENCE_END_PATTERN.finditer(self._text, scan_start):
+            end = match.end()
+        if end is not None:
+            text, self._text = self._text[:end], self._text[end:]
+            self._add_clip(text)
+
+    def _add_clip(self, text: str):
+        if len(text.strip()) == 0:
+            return
+
+        self._clips.put_nowait(asyncio.ensure_future(self.synthesizer.synthesize(text)))
+        if self._sender_task is None:
+            self._sender_task = asyncio.ensure_future(self._send_clips())
+
+    async def _send_clips(self):
+        while True:
+            clip = await self._clips.get()
+            if clip is None:
+                break
+            await self.send_voice(await clip)
+
+    async def finish(self):
+        # speaks the rest and waits until every clip is sent
+        self._add_clip(self._text)
+        self._text = ""
+
+        if self._sender_task is not None:
+            self._clips.put_nowait(None)
+            await self._sender_task
+
+    def cancel(self):
+        if self._sender_task is not None:
+            self._sender_task.cancel()
+
+        while not self._clips.empty():
+            clip = self._clips.get_nowait()
+            if clip is not None:
+                clip.cancel()
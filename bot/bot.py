@@ -1,17 +1,15 @@
 import os
+import io
 import logging
 import asyncio
+import contextlib
+import time
+import signal
 import traceback
 import html
 import json
-import tempfile
-import pydub
 import tools
-from pathlib import Path
 from datetime import datetime
-import azure.cognitiveservices.speech as speechsdk
-
-import PyPDF2
 
 
 import telegram
@@ -29,27 +27,55 @@ from telegram.ext import (
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
-    AIORateLimiter,
     filters
 )
 from telegram.constants import ParseMode, ChatAction
 
+import audio
 import config
 import database
+import downloader
+import locks
+import metrics
 import openai_utils
-
-
-# setup
-db = database.Database()
+import pdf
+import streaming
+import summary_cache
+import tokenizer
+import usage
+
+
+# setup. Clients are created in post_init, so importing this module stays cheap
+db = None
+usage_accountant = None
+chatgpt_instance = None
+summaries = None
+user_leases = None
+http_downloader = downloader.Downloader(config.download_max_connections, config.download_timeout, config.download_head_timeout)
+edit_scheduler = streaming.EditScheduler(config.telegram_edits_per_second_per_chat, config.telegram_edits_per_second)
+telegram_rate_limiter = streaming.RetryCountingRateLimiter(max_retries=5)
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 logger.info('Start')
-user_semaphores = {}
-speech_config = speechsdk.SpeechConfig(subscription=config.azure_tts_key, region=config.azure_tts_region)
-speech_config.speech_synthesis_voice_name = config.azure_tts_voice
-speech_config.set_speech_synthesis_output_format(speechsdk.SpeechSynthesisOutputFormat.Ogg16Khz16BitMonoOpus)
-speech_synthesizer = speechsdk.SpeechSynthesizer(speech_config=speech_config)
+user_locks = locks.UserLockManager(max_queue_depth=config.user_queue_depth)
+speech_synthesizer = audio.SpeechSynthesizer(
+    config.azure_tts_key,
+    config.azure_tts_region,
+    voice=config.azure_tts_voice,
+    max_workers=config.tts_max_workers
+)
+metrics_server = metrics.MetricsServer(config.metrics_host, config.metrics_port) if config.metrics_port else None
+
+metrics.CallbackMetric("bot_user_lock_rejections_total", "Messages rejected because the user's previous message wasn't answered yet", lambda: user_locks.n_rejected, type="counter")
+metrics.CallbackMetric("bot_user_lock_waiting", "Messages waiting for the user's previous message", lambda: user_locks.n_waiting)
+metrics.CallbackMetric("bot_user_lock_wait_seconds_total", "Time messages waited for the user's previous message", lambda: user_locks.total_wait_time, type="counter")
+metrics.CallbackMetric("bot_user_lock_max_wait_seconds", "Longest time a message waited for the user's previous message", lambda: user_locks.max_wait_time)
+metrics.CallbackMetric("bot_openai_running", "OpenAI requests in flight", lambda: openai_utils.scheduler.n_running)
+metrics.CallbackMetric("bot_openai_queue_depth", "OpenAI requests waiting for the scheduler", lambda: openai_utils.scheduler.get_queue_depth())
+metrics.CallbackMetric("bot_openai_rate_limited_total", "Rate limit errors of OpenAI requests, they are retried after a backoff", lambda: openai_utils.scheduler.n_rate_limited, type="counter")
+metrics.CallbackMetric("bot_telegram_edits_total", "Sends and edits of streamed answers", lambda: edit_scheduler.n_edits, type="counter")
+metrics.CallbackMetric("bot_telegram_rate_limiter_retries_total", "Telegram requests retried after a RetryAfter error", lambda: telegram_rate_limiter.n_retries, type="counter")
 
 
 HELP_MESSAGE = """Commands:
@@ -66,41 +92,92 @@ def split_text_into_chunks(text, chunk_size):
     yield text[i:i + chunk_size]
 
 
-async def register_user_if_not_exists(update: Update, context: CallbackContext, user: User) -> int:
-  if not db.check_if_user_exists(user.id):
-    db.add_new_user(
-        user.id,
-        update.message.chat_id,
-        username=user.username,
-        first_name=user.first_name,
-        last_name=user.last_name
-    )
-    db.start_new_dialog(user.id)
+def make_progress_callback(status_message, action="Summarizing"):
+  # edits the "Analyzing ..." message (a streaming.StatusMessage) while a long document is processed,
+  # without waiting for the rate limited edit
+  async def progress_callback(n_done, n_total):
+    status_message.set(f"{action} {n_done}/{n_total}...")
+
+  return progress_callback
+
+
+async def download_attachment(update: Update):
+  # downloads the message's attachment into memory, every request gets its own buffer
+  attachment = update.message.effective_attachment
+  if attachment.file_size is not None and attachment.file_size > config.max_file_size:
+    raise ValueError(f"File is too large ({attachment.file_size} bytes), at most {config.max_file_size} bytes are supported")
+
+  new_file = await attachment.get_file()
+  buffer = io.BytesIO()
+  await new_file.download_to_memory(buffer)
+  if buffer.tell() > config.max_file_size:
+    raise ValueError(f"File is too large ({buffer.tell()} bytes), at most {config.max_file_size} bytes are supported")
 
-  if db.get_user_attribute(user.id, "current_dialog_id") is None:
-    db.start_new_dialog(user.id)
+  return buffer
 
-  if user.id not in user_semaphores:
-    user_semaphores[user.id] = asyncio.Semaphore(1)
-  db.set_user_attribute(user.id, "last_interaction", datetime.now())
-  return user.id
 
+def get_price_per_1000_tokens():
+  return config.chatgpt_price_per_1000_tokens if config.use_chatgpt_api else config.gpt_price_per_1000_tokens
 
-async def is_previous_message_not_answered_yet(update: Update, context: CallbackContext):
-  user_id = await register_user_if_not_exists(update, context, update.message.from_user)
 
-  if user_semaphores[user_id].locked():
-    text = "⏳ Please <b>wait</b> for a reply to the previous message"
-    await update.message.reply_text(text, reply_to_message_id=update.message.id, parse_mode=ParseMode.HTML)
+async def register_user_if_not_exists(update: Update, context: CallbackContext, user: User) -> dict:
+  # returns user's state as it was before this update (e.g. previous last_interaction)
+  user_dict = await db.register_user(
+      user.id,
+      update.message.chat_id,
+      username=user.username,
+      first_name=user.first_name,
+      last_name=user.last_name
+  )
+
+  usage_accountant.touch(user.id)
+
+  if user_dict["current_dialog_id"] is None:
+    user_dict["current_dialog_id"] = await db.start_new_dialog(user.id)
+
+  return user_dict
+
+
+async def reply_wait_for_previous_message(update: Update):
+  text = "⏳ Please <b>wait</b> for a reply to the previous message"
+  await update.message.reply_text(text, reply_to_message_id=update.message.id, parse_mode=ParseMode.HTML)
+
+
+async def is_previous_message_not_answered_yet(update: Update, context: CallbackContext, user_id: int):
+  if user_locks.is_full(user_id):
+    await reply_wait_for_previous_message(update)
     return True
   else:
     return False
 
 
+@contextlib.asynccontextmanager
+async def user_lease(user_id: int):
+  # holds the user's lease (distributed_locks) while a command changes the user's state, so it can't interleave
+  # with an answer of another replica. Yields False if another replica answers the user right now
+  if user_leases is None:
+    yield True
+    return
+
+  lease = await user_leases.acquire(user_id)
+  if lease is None:
+    yield False
+    return
+
+  try:
+    yield True
+  finally:
+    await lease.release()
+
+
 async def start_handle(update: Update, context: CallbackContext):
-  user_id = await register_user_if_not_exists(update, context, update.message.from_user)
+  user_id = (await register_user_if_not_exists(update, context, update.message.from_user))["_id"]
 
-  db.start_new_dialog(user_id)
+  async with user_lease(user_id) as acquired:
+    if not acquired:
+      await reply_wait_for_previous_message(update)
+      return
+    await db.start_new_dialog(user_id)
 
   reply_text = "Hi! Ich bin <b>Botty</b>  🤖\n\n"
   reply_text += HELP_MESSAGE
@@ -111,100 +188,88 @@ async def start_handle(update: Update, context: CallbackContext):
 
 
 async def help_handle(update: Update, context: CallbackContext):
-  user_id = await register_user_if_not_exists(update, context, update.message.from_user)
+  await register_user_if_not_exists(update, context, update.message.from_user)
 
   await update.message.reply_text(HELP_MESSAGE, parse_mode=ParseMode.HTML)
 
 
 async def speek_handle(update: Update, context: CallbackContext):
-  user_id = await register_user_if_not_exists(update, context, update.message.from_user)
-  if await is_previous_message_not_answered_yet(update, context):
+  user_dict = await register_user_if_not_exists(update, context, update.message.from_user)
+  user_id = user_dict["_id"]
+  if await is_previous_message_not_answered_yet(update, context, user_id):
     return
 
-  dialog_messages = db.get_dialog_messages(user_id, dialog_id=None)
+  dialog_messages = await db.get_dialog_messages(user_id, dialog_id=user_dict["current_dialog_id"])
   if len(dialog_messages) == 0:
     await update.message.reply_text("No message to retry 🤷‍♂️")
     return
 
   last_dialog_message = dialog_messages.pop()
   logger.info(last_dialog_message)
-  result = speech_synthesizer.speak_text_async(last_dialog_message["bot"]).get()
-  await update.message.reply_voice(result.audio_data)
+  audio_data = await speech_synthesizer.synthesize(last_dialog_message["bot"])
+  await update.message.reply_voice(audio_data)
 
 
 async def retry_handle(update: Update, context: CallbackContext):
-  user_id = await register_user_if_not_exists(update, context, update.message.from_user)
-  if await is_previous_message_not_answered_yet(update, context):
+  user_dict = await register_user_if_not_exists(update, context, update.message.from_user)
+  user_id = user_dict["_id"]
+  if await is_previous_message_not_answered_yet(update, context, user_id):
     return
 
-  dialog_messages = db.get_dialog_messages(user_id, dialog_id=None)
-  if len(dialog_messages) == 0:
-    await update.message.reply_text("No message to retry 🤷‍♂️")
-    return
+  # the last message is removed from the context under the user's lock and lease
+  await message_handle(update, context, use_new_dialog_timeout=False, user_dict=user_dict, retry=True)
 
-  last_dialog_message = dialog_messages.pop()
-  db.set_dialog_messages(user_id, dialog_messages, dialog_id=None)  # last message was removed from the context
-
-  await message_handle(update, context, message=last_dialog_message["user"], use_new_dialog_timeout=False)
-
-
-async def stream_response(gen, update: Update, context: CallbackContext, parse_mode):
-   # send message to user
-  prev_answer = ""
-  i = -1
-  async for gen_item in gen:
-    i += 1
-
-    status = gen_item[0]
-    if status == "not_finished":
-      status, answer = gen_item
-    elif status == "finished":
-      status, answer, n_used_tokens, n_first_dialog_messages_removed = gen_item
-    else:
-      raise ValueError(f"Streaming status {status} is unknown")
-
-    answer = answer[:4096]  # telegram message limit
-    if i == 0:  # send first message (then it'll be edited if message streaming is enabled)
-      try:
-        sent_message = await update.message.reply_text(answer, parse_mode=parse_mode)
-      except telegram.error.BadRequest as e:
-        if str(e).startswith("Message must be non-empty"):  # first answer chunk from openai was empty
-          i = -1  # try again to send first message
-          continue
-        elif len(answer) <= 0:
-          i = -1
-          continue
-        else:
-          sent_message = await update.message.reply_text(answer)
-    else:  # edit sent message
-      # update only when 100 new symbols are ready
-      if abs(len(answer) - len(prev_answer)) < 100 and status != "finished":
-        continue
-
-      try:
-        await context.bot.edit_message_text(answer, chat_id=sent_message.chat_id, message_id=sent_message.message_id, parse_mode=parse_mode)
-      except telegram.error.BadRequest as e:
-        if str(e).startswith("Message is not modified"):
-          continue
-        else:
-          await context.bot.edit_message_text(answer, chat_id=sent_message.chat_id, message_id=sent_message.message_id)
 
-      await asyncio.sleep(0.01)  # wait a bit to avoid flooding
+async def stream_response(gen, update: Update, context: CallbackContext, parse_mode, speech_stream=None, lease=None):
+  # send message to user (and speak it if speech_stream is given).
+  # Stops with LeaseLost when the user's lease is lost, another replica may answer the user then
+  message_stream = edit_scheduler.stream(update.message, parse_mode)
+  start_time = time.perf_counter()
+  first_token_time = None
+  try:
+    async for gen_item in gen:
+      status = gen_item[0]
+      if status == "not_finished":
+        status, delta = gen_item
+        if lease is not None:
+          lease.check()
+        if first_token_time is None:
+          first_token_time = time.perf_counter()
+          metrics.stage_seconds.labels("first_token").observe(first_token_time - start_time)
+        message_stream.append(delta)
+        if speech_stream is not None:
+          speech_stream.append(delta)
+      elif status == "finished":
+        status, answer, n_used_tokens, n_first_dialog_messages_removed, n_message_tokens, n_answer_tokens = gen_item
+      else:
+        raise ValueError(f"Streaming status {status} is unknown")
 
-    prev_answer = answer
+    await message_stream.finish(answer)
+    metrics.stage_seconds.labels("stream").observe(time.perf_counter() - (first_token_time or start_time))
+    if speech_stream is not None:
+      await speech_stream.finish()
+  except BaseException:
+    message_stream.cancel()
+    if speech_stream is not None:
+      speech_stream.cancel()
+    raise
 
-  return answer, n_used_tokens, n_first_dialog_messages_removed
+  return answer, n_used_tokens, n_first_dialog_messages_removed, n_message_tokens, n_answer_tokens
 
 
 async def handle_yt(update: Update, context: CallbackContext,url):
-  await update.message.reply_text("Analyzing video...")
-  description, transcript = tools.yt(url)
+  cache_keys = [summary_cache.key_for_youtube_video(tools.get_youtube_video_id(url))]
+  cached_message = await summaries.get(*cache_keys)
+  if cached_message is not None:
+    return cached_message
+
+  status_message = edit_scheduler.status(await update.message.reply_text("Analyzing video..."))
+  description, transcript = await tools.yt(url, http_downloader)
   logger.info(description)
   logger.info(tools.tokens(description))
   logger.info(tools.tokens(transcript))
-  await reset_dialog_handle(update, context)
-  transcript = tools.summarize2(transcript, 10000)
-  return f'''{description}
+  transcript = await tools.summarize_map_reduce(transcript, 10000, chatgpt_instance, progress_callback=make_progress_callback(status_message), user_id=update.message.from_user.id)
+  message = f'''{description}
     Analysiere folgendes Video. Fasse die Beschreibung, oder das  Transscript falls es keine Beschreibung gibt,
     in einem Absatz mit maximal 40 Wörter zusammen.
 
@@ -218,110 +283,155 @@ async def handle_yt(update: Update, context: CallbackContext,url):
     {transcript}
     """
     '''
+  await summaries.set(cache_keys, message)
+  return message
 
 async def handle_txt(update: Update, context: CallbackContext):
-  await reset_dialog_handle(update, context)
-  await update.message.reply_text("Analyzing text...")
-  new_file = await update.message.effective_attachment.get_file()
-  await new_file.download_to_drive('tmp.txt')
-  with open('tmp.txt', 'r') as txt_file:
-    txt=txt_file.read()
-    txt = tools.summarize2(txt, 10000)
-    return f'''
-        Analysiere folgenden Text. Fasse es in einem Absatz mit maximal 40 Wörter zusammen.
-
-        """
-        {txt}
-        """
-        '''
-
-async def handle_url_pdf(url: str):
-  import requests
-  import tempfile
-  response = requests.get(url)
-  with tempfile.TemporaryFile('w+b') as f:
-    f.write(response.content)
-    return await handle_file_pdf(f)
+  cache_keys = [summary_cache.key_for_telegram_file(update.message.effective_attachment.file_unique_id)]
+  cached_message = await summaries.get(*cache_keys)
+  if cached_message is not None:
+    return cached_message
+
+  status_message = edit_scheduler.status(await update.message.reply_text("Analyzing text..."))
+  data = (await download_attachment(update)).getbuffer()
+
+  cache_keys.append(summary_cache.key_for_bytes(data))
+  cached_message = await summaries.get(cache_keys[-1])
+  if cached_message is not None:
+    await summaries.set(cache_keys[:-1], cached_message)
+    return cached_message
+
+  txt = await tools.summarize_map_reduce(str(data, "utf-8", errors="replace"), 10000, chatgpt_instance, progress_callback=make_progress_callback(status_message), user_id=update.message.from_user.id)
+  message = f'''
+      Analysiere folgenden Text. Fasse es in einem Absatz mit maximal 40 Wörter zusammen.
+
+      """
+      {txt}
+      """
+      '''
+  await summaries.set(cache_keys, message)
+  return message
+
+async def handle_url_pdf(update: Update, context: CallbackContext, url: str):
+  cache_keys = [summary_cache.key_for_url(url)]
+  cached_message = await summaries.get(*cache_keys)
+  if cached_message is not None:
+    return cached_message
+
+  status_message = edit_scheduler.status(await update.message.reply_text("Analyzing pdf..."))
+  data = await http_downloader.fetch(url)
+  return await handle_file_pdf(data, status_message, cache_keys, user_id=update.message.from_user.id)
 
 async def handle_doc_pdf(update: Update, context: CallbackContext):
-  await reset_dialog_handle(update, context)
-  await update.message.reply_text("Analyzing pdf...")
-  new_file = await update.message.effective_attachment.get_file()
-  await new_file.download_to_drive('file.pdf')
-  # await update.message.document.get_file().download_to_drive('file.pdf');
-  with open('file.pdf', 'rb') as pdf_file:
-    return await handle_file_pdf(pdf_file)
-
-async def handle_file_pdf(pdf_file):
-  read_pdf = PyPDF2.PdfReader(pdf_file)
-  text_file = ''
-  number_of_pages = len(read_pdf.pages)
-  for page_number in range(number_of_pages):   # use xrange in Py2
-    page = read_pdf.pages[page_number]
-    page_content = page.extract_text() 
-    text_file += page_content
-  text_file = tools.summarize2(text_file, 10000)
-  return f'''
+  cache_keys = [summary_cache.key_for_telegram_file(update.message.effective_attachment.file_unique_id)]
+  cached_message = await summaries.get(*cache_keys)
+  if cached_message is not None:
+    return cached_message
+
+  status_message = edit_scheduler.status(await update.message.reply_text("Analyzing pdf..."))
+  data = (await download_attachment(update)).getvalue()
+  return await handle_file_pdf(data, status_message, cache_keys, user_id=update.message.from_user.id)
+
+async def handle_file_pdf(data: bytes, status_message, cache_keys=(), user_id=None):
+  # cache_keys: keys known before the download, the content hash is added here
+  cache_keys = list(cache_keys) + [summary_cache.key_for_bytes(data)]
+  cached_message = await summaries.get(cache_keys[-1])
+  if cached_message is not None:
+    await summaries.set(cache_keys[:-1], cached_message)
+    return cached_message
+
+  text_file = await pdf.extract_text(data, progress_callback=make_progress_callback(status_message, action="Reading pages"))
+  text_file = await tools.summarize_map_reduce(text_file, 10000, chatgpt_instance, progress_callback=make_progress_callback(status_message), user_id=user_id)
+  message = f'''
       Analysiere folgendes PDF. Erstelle ein Inhaltsverzeichnus und eine Zusammenfassung .
 
       """
       {text_file}
       """
       '''
+  await summaries.set(cache_keys, message)
+  return message
 
 
 
 async def handle_doc_pd2(update: Update, context: CallbackContext):
-  text_file = ''
-  await reset_dialog_handle(update, context)
   await update.message.reply_text("Analyzing pdf...")
-  new_file = await update.message.effective_attachment.get_file()
-  await new_file.download_to_drive('file.pdf')
-  # await update.message.document.get_file().download_to_drive('file.pdf');
-  with open('file.pdf', 'rb') as pdf_file:
-    read_pdf = PyPDF2.PdfReader(pdf_file)
-
-    number_of_pages = len(read_pdf.pages)
-    for page_number in range(number_of_pages):   # use xrange in Py2
-      page = read_pdf.pages[page_number]
-      page_content = page.extract_text()
-      text_file += page_content
-    text_file = tools.summarize(text_file, 10000)
-    return f'''
-        Analysiere folgendes PDF. Fasse es in einem Absatz mit maximal 40 Wörter zusammen.
-
-        """
-        {text_file}
-        """
-        '''
-
-
-async def message_handle(update: Update, context: CallbackContext, message=None, use_new_dialog_timeout=True, tts=False):
-  logger.info(update)
+  data = (await download_attachment(update)).getvalue()
+  text_file = await pdf.extract_text(data)
+  text_file = tools.summarize(text_file, 10000)
+  return f'''
+      Analysiere folgendes PDF. Fasse es in einem Absatz mit maximal 40 Wörter zusammen.
+
+      """
+      {text_file}
+      """
+      '''
+
+
+async def message_handle(update: Update, context: CallbackContext, message=None, use_new_dialog_timeout=True, tts=False, user_dict=None, retry=False, reservation=None):
+  # user_dict is passed by handlers that already registered the user, it's the state before this update.
+  # With retry the last message of the dialog is answered again.
+  # reservation is passed by handlers that already hold the user's lock (see voice_message_handle)
+  logger.debug(update)
   # check if message is edited
   if update.edited_message is not None:
     await edited_message_handle(update, context)
     return
 
-  user_id = await register_user_if_not_exists(update, context, update.message.from_user)
-  if await is_previous_message_not_answered_yet(update, context):
+  if user_dict is None:
+    with metrics.stage_seconds.labels("register_user").time():
+      user_dict = await register_user_if_not_exists(update, context, update.message.from_user)
+  user_id = user_dict["_id"]
+  # reserve before any await, so concurrent messages of the user can't slip past the check
+  user_lock = reservation or user_locks.reserve(user_id)
+  if user_lock is None:
+    await reply_wait_for_previous_message(update)
     return
 
-  chat_mode = db.get_user_attribute(user_id, "current_chat_mode")
+  lease = None
+  async with contextlib.AsyncExitStack() as exit_stack:
+    if reservation is None:
+      await exit_stack.enter_async_context(user_lock)
+    if user_leases is not None:
+      lease = await user_leases.acquire(user_id)
+      if lease is None:  # another replica answers the user
+        await reply_wait_for_previous_message(update)
+        return
+      exit_stack.push_async_callback(lease.release)
+
+    # the user's state was read before the lock. The previous message may have changed the dialog or chat mode,
+    # and when the lease changed hands the state may come from a stale cache
+    if user_lock.waited or (user_leases is not None and lease.changed_hands):
+      user_dict.update(await db.get_user(user_id, ["current_chat_mode", "current_dialog_id"]))
+
+    chat_mode = user_dict["current_chat_mode"]
+    dialog_id = user_dict["current_dialog_id"]
+
+    if retry:
+      # last message is removed from the context
+      last_dialog_message = await db.pop_last_dialog_message(user_id, dialog_id=dialog_id)
+      if last_dialog_message is None:
+        await update.message.reply_text("No message to retry 🤷‍♂️")
+        return
+      message = last_dialog_message["user"]
+
+    with metrics.stage_seconds.labels("db_read").time():
+      dialog_messages = await db.get_dialog_messages(user_id, dialog_id=dialog_id)
 
-  async with user_semaphores[user_id]:
     # new dialog timeout
     if use_new_dialog_timeout:
-      if (datetime.now() - db.get_user_attribute(user_id, "last_interaction")).seconds > config.new_dialog_timeout and len(db.get_dialog_messages(user_id)) > 0:
-        db.start_new_dialog(user_id)
-        await update.message.reply_text(f"Starting new dialog due to timeout (<b>{openai_utils.CHAT_MODES[chat_mode]['name']}</b> mode) ✅", parse_mode=ParseMode.HTML)
+      if (datetime.now() - user_dict["last_interaction"]).total_seconds() > config.new_dialog_timeout and len(dialog_messages) > 0:
+        dialog_id = await db.start_new_dialog(user_id)
+        dialog_messages = []
+        await update.message.reply_text(f"Starting new dialog due to timeout (<b>{openai_utils.CHAT_MODES[chat_mode].name}</b> mode) ✅", parse_mode=ParseMode.HTML)
 
     # send typing action
     await update.message.chat.send_action(action="typing")
 
     try:
       if update.message.document is not None:
-        db.start_new_dialog(user_id)
+        dialog_id = await db.start_new_dialog(user_id)
+        dialog_messages = []
         fn = update.message.document.file_name
         if fn.endswith('.pdf'):
           message = await handle_doc_pdf(update, context)
@@ -334,46 +444,53 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
         message = message or update.message.text
         logger.info(message)
         if message.startswith('https://'):
-          db.start_new_dialog(user_id)
+          dialog_id = await db.start_new_dialog(user_id)
+          dialog_messages = []
           if message.startswith('https://www.youtube.com/watch?v=') or message.startswith('https://youtu.be/'):
             message = await handle_yt(update, context,message)
           elif message.startswith('https://') and message.endswith('.pdf'):
-            message = await handle_url_pdf(message)
-
-      dialog_messages = db.get_dialog_messages(user_id, dialog_id=None)
-      parse_mode = {
-          "html": ParseMode.HTML,
-          "markdown": ParseMode.MARKDOWN
-      }[openai_utils.CHAT_MODES[chat_mode]["parse_mode"]]
+            message = await handle_url_pdf(update, context, message)
 
-      chatgpt_instance = openai_utils.ChatGPT(use_chatgpt_api=config.use_chatgpt_api)
+      parse_mode = openai_utils.CHAT_MODES[chat_mode].parse_mode
 
-      gen = chatgpt_instance.send_message_stream(message, dialog_messages=dialog_messages, chat_mode=chat_mode)
-      answer, n_used_tokens, n_first_dialog_messages_removed = await stream_response(gen, update, context, parse_mode)
-
-      # TTS
-      if tts and len(answer) > 0:
+      # TTS starts with the first sentences while the rest of the answer is still generated
+      speech_stream = None
+      if tts:
         logger.info('TTS')
-        result = speech_synthesizer.speak_text_async(answer).get()
-        await update.message.reply_voice(result.audio_data)
+        speech_stream = audio.SpeechStream(speech_synthesizer, update.message.reply_voice, min_chars=config.tts_chunk_min_chars)
+
+      gen = chatgpt_instance.send_message_stream(message, dialog_messages=dialog_messages, chat_mode=chat_mode, user_id=user_id)
+      answer, n_used_tokens, n_first_dialog_messages_removed, n_message_tokens, n_answer_tokens = await stream_response(gen, update, context, parse_mode, speech_stream=speech_stream, lease=lease)
 
       # update user data
-      new_dialog_message = {"user": message, "bot": answer, "date": datetime.now()}
-      db.set_dialog_messages(
-          user_id,
-          db.get_dialog_messages(user_id, dialog_id=None) + [new_dialog_message],
-          dialog_id=None
-      )
-
-      db.set_user_attribute(user_id, "n_used_tokens", n_used_tokens + db.get_user_attribute(user_id, "n_used_tokens"))
+      new_dialog_message = {
+          "user": message,
+          "bot": answer,
+          "date": datetime.now(),
+          "n_user_tokens": n_message_tokens,
+          "n_bot_tokens": n_answer_tokens
+      }
+      if lease is not None:
+        lease.check()
+      await db.append_dialog_message(user_id, new_dialog_message, dialog_id=dialog_id)
+
+      n_spent_dollars = n_used_tokens * (get_price_per_1000_tokens() / 1000)
+      usage_accountant.add_usage(user_id, n_used_tokens, chatgpt_instance.model, chat_mode, n_spent_dollars)
+      metrics.tokens.labels(chatgpt_instance.model).inc(n_used_tokens)
+    except locks.LeaseLost:
+      logger.warning(f"Stopped answering user {user_id}, the lease was lost")
+      await update.message.reply_text("⚠️ The answer was interrupted, please send your message again")
+      return ""
     except Exception as e:
       print(e)
+      metrics.errors.inc()
       error_text = f"Something went wrong during completion. Reason: {e}"
       await update.message.reply_text(error_text)
       return ""
 
     # send message if some messages were removed from the context
     if n_first_dialog_messages_removed > 0:
+      metrics.context_trims.inc(n_first_dialog_messages_removed)
       if n_first_dialog_messages_removed == 1:
         text = "✍️ <i>Note:</i> Your current dialog is too long, so your <b>first message</b> was removed from the context.\n Send /new command to start new dialog"
       else:
@@ -382,95 +499,111 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
 
 
 async def voice_message_handle(update: Update, context: CallbackContext):
-  user_id = await register_user_if_not_exists(update, context, update.message.from_user)
-  if await is_previous_message_not_answered_yet(update, context):
+  user_dict = await register_user_if_not_exists(update, context, update.message.from_user)
+  user_id = user_dict["_id"]
+  # reserved before the (paid) transcription, so a voice message that would be rejected isn't transcribed
+  user_lock = user_locks.reserve(user_id)
+  if user_lock is None:
+    await reply_wait_for_previous_message(update)
     return
 
-  voice = update.message.voice
-  with tempfile.TemporaryDirectory() as tmp_dir:
-    tmp_dir = Path(tmp_dir)
-    voice_ogg_path = tmp_dir / "voice.ogg"
+  async with user_lock:
+    voice = update.message.voice
 
     # download
     voice_file = await context.bot.get_file(voice.file_id)
-    await voice_file.download_to_drive(voice_ogg_path)
-
-    # convert to mp3
-    voice_mp3_path = tmp_dir / "voice.mp3"
-    pydub.AudioSegment.from_file(voice_ogg_path).export(voice_mp3_path, format="mp3")
+    buffer = io.BytesIO()
+    await voice_file.download_to_memory(buffer)
 
     # transcribe
-    with open(voice_mp3_path, "rb") as f:
-      transcribed_text = await openai_utils.transcribe_audio(f)
+    with metrics.stage_seconds.labels("whisper").time():
+      audio_file = await audio.prepare_for_transcription(buffer.getvalue())
+      transcribed_text = await chatgpt_instance.transcribe_audio(audio_file, user_id=user_id)
 
-  text = f"🎤: <i>{transcribed_text}</i>"
-  await update.message.reply_text(text, parse_mode=ParseMode.HTML)
-  await message_handle(update, context, message=transcribed_text, tts=True)
-  # calculate spent dollars
-  n_spent_dollars = voice.duration * (config.whisper_price_per_1_min / 60)
+    # calculate spent dollars
+    n_spent_dollars = voice.duration * (config.whisper_price_per_1_min / 60)
 
-  # normalize dollars to tokens (it's very convenient to measure everything in a single unit)
-  price_per_1000_tokens = config.chatgpt_price_per_1000_tokens if config.use_chatgpt_api else config.gpt_price_per_1000_tokens
-  n_used_tokens = int(n_spent_dollars / (price_per_1000_tokens / 1000))
-  db.set_user_attribute(user_id, "n_used_tokens", n_used_tokens + db.get_user_attribute(user_id, "n_used_tokens"))
+    # normalize dollars to tokens (it's very convenient to measure everything in a single unit)
+    n_used_tokens = int(n_spent_dollars / (get_price_per_1000_tokens() / 1000))
+    usage_accountant.add_usage(user_id, n_used_tokens, "whisper-1", user_dict["current_chat_mode"], n_spent_dollars)
 
-
-async def reset_dialog_handle(update: Update, context: CallbackContext):
-  user_id = update.message.from_user.id
-  db.set_user_attribute(user_id, "last_interaction", datetime.now())
-  db.start_new_dialog(user_id)
+    text = f"🎤: <i>{transcribed_text}</i>"
+    await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+    await message_handle(update, context, message=transcribed_text, tts=True, user_dict=user_dict, reservation=user_lock)
 
 
 async def new_dialog_handle(update: Update, context: CallbackContext):
-  user_id = await register_user_if_not_exists(update, context, update.message.from_user)
-  if await is_previous_message_not_answered_yet(update, context):
+  user_dict = await register_user_if_not_exists(update, context, update.message.from_user)
+  user_id = user_dict["_id"]
+  if await is_previous_message_not_answered_yet(update, context, user_id):
     return
 
-  db.start_new_dialog(user_id)
+  async with user_lease(user_id) as acquired:
+    if not acquired:
+      await reply_wait_for_previous_message(update)
+      return
+    await db.start_new_dialog(user_id)
+    chat_mode = await db.get_user_attribute(user_id, "current_chat_mode")
   await update.message.reply_text("Starting new dialog ✅")
 
-  chat_mode = db.get_user_attribute(user_id, "current_chat_mode")
-  await update.message.reply_text(f"{openai_utils.CHAT_MODES[chat_mode]['welcome_message']}", parse_mode=ParseMode.HTML)
+  await update.message.reply_text(f"{openai_utils.CHAT_MODES[chat_mode].welcome_message}", parse_mode=ParseMode.HTML)
 
 
 async def show_chat_modes_handle(update: Update, context: CallbackContext):
-  user_id = await register_user_if_not_exists(update, context, update.message.from_user)
-  if await is_previous_message_not_answered_yet(update, context):
+  user_id = (await register_user_if_not_exists(update, context, update.message.from_user))["_id"]
+  if await is_previous_message_not_answered_yet(update, context, user_id):
     return
 
   keyboard = []
-  for chat_mode, chat_mode_dict in openai_utils.CHAT_MODES.items():
-    keyboard.append([InlineKeyboardButton(chat_mode_dict["name"], callback_data=f"set_chat_mode|{chat_mode}")])
+  for chat_mode in openai_utils.CHAT_MODES.values():
+    keyboard.append([InlineKeyboardButton(chat_mode.name, callback_data=f"set_chat_mode|{chat_mode.key}")])
   reply_markup = InlineKeyboardMarkup(keyboard)
 
   await update.message.reply_text("Select chat mode:", reply_markup=reply_markup)
 
 
 async def set_chat_mode_handle(update: Update, context: CallbackContext):
-  user_id = await register_user_if_not_exists(update.callback_query, context, update.callback_query.from_user)
+  user_id = (await register_user_if_not_exists(update.callback_query, context, update.callback_query.from_user))["_id"]
 
   query = update.callback_query
-  await query.answer()
-
   chat_mode = query.data.split("|")[1]
 
-  db.set_user_attribute(user_id, "current_chat_mode", chat_mode)
-  db.start_new_dialog(user_id)
+  async with user_lease(user_id) as acquired:
+    if not acquired:
+      await query.answer("⏳ Please wait for a reply to the previous message")
+      return
+    await query.answer()
+    await db.set_user_attribute(user_id, "current_chat_mode", chat_mode)
+    await db.start_new_dialog(user_id)
 
-  await query.edit_message_text(f"{openai_utils.CHAT_MODES[chat_mode]['welcome_message']}", parse_mode=ParseMode.HTML)
+  await query.edit_message_text(f"{openai_utils.CHAT_MODES[chat_mode].welcome_message}", parse_mode=ParseMode.HTML)
 
 
 async def show_balance_handle(update: Update, context: CallbackContext):
-  user_id = await register_user_if_not_exists(update, context, update.message.from_user)
+  user_dict = await register_user_if_not_exists(update, context, update.message.from_user)
+  user_id = user_dict["_id"]
 
-  n_used_tokens = db.get_user_attribute(user_id, "n_used_tokens")
+  n_used_tokens = user_dict["n_used_tokens"] + usage_accountant.get_pending_n_used_tokens(user_id)
 
-  price_per_1000_tokens = config.chatgpt_price_per_1000_tokens if config.use_chatgpt_api else config.gpt_price_per_1000_tokens
+  price_per_1000_tokens = get_price_per_1000_tokens()
   n_spent_dollars = n_used_tokens * (price_per_1000_tokens / 1000)
 
   text = f"You spent <b>{n_spent_dollars:.03f}$</b>\n"
   text += f"You used <b>{n_used_tokens}</b> tokens\n\n"
 
+  # per model and chat mode breakdown (including not yet flushed usage)
+  usage_dict = await db.get_usage(user_id)
+  for key, (n_tokens, n_dollars) in usage_accountant.get_pending_usage(user_id).items():
+    prev_n_tokens, prev_n_dollars = usage_dict.get(key, (0, 0.0))
+    usage_dict[key] = (prev_n_tokens + n_tokens, prev_n_dollars + n_dollars)
+
+  if len(usage_dict) > 0:
+    text += "📊 Details\n<i>"
+    for (model, chat_mode), (n_tokens, n_dollars) in sorted(usage_dict.items()):
+      chat_mode_name = openai_utils.CHAT_MODES[chat_mode].name if chat_mode in openai_utils.CHAT_MODES else chat_mode
+      text += f"- {model}, {chat_mode_name}: {n_tokens} tokens, {n_dollars:.03f}$\n"
+    text += "</i>\n"
+
   text += "🏷️ Prices\n"
   text += f"<i>- ChatGPT: {price_per_1000_tokens}$ per 1000 tokens\n"
   text += f"- Whisper (voice recognition): {config.whisper_price_per_1_min}$ per 1 minute</i>"
@@ -486,6 +619,7 @@ async def edited_message_handle(update: Update, context: CallbackContext):
 async def error_handle(update: Update, context: CallbackContext) -> None:
 
   logger.error(msg="Exception while handling an update:", exc_info=context.error)
+  metrics.errors.inc()
 
   try:
     # collect error message
@@ -511,6 +645,26 @@ async def error_handle(update: Update, context: CallbackContext) -> None:
 
 
 async def post_init(application: Application):
+  global db, usage_accountant, chatgpt_instance, summaries, user_leases
+  db = database.Database()
+  usage_accountant = usage.UsageAccountant(db, config.usage_flush_interval, config.usage_flush_max_pending)
+  summaries = summary_cache.SummaryCache(db, enabled=config.summary_cache_enabled, max_entries=config.summary_cache_max_entries)
+  metrics.CallbackMetric("bot_mongodb_operations_total", "MongoDB operations", lambda: db.n_operations, type="counter")
+  metrics.CallbackMetric("bot_summary_cache_hits_total", "Summaries found in the summary cache", lambda: summaries.hits, type="counter")
+  metrics.CallbackMetric("bot_summary_cache_misses_total", "Summaries not found in the summary cache", lambda: summaries.misses, type="counter")
+  if db.user_cache is not None:
+    metrics.CallbackMetric("bot_user_cache_hits_total", "User state read from the user cache", lambda: db.user_cache.hits, type="counter")
+    metrics.CallbackMetric("bot_user_cache_misses_total", "User state not found in the user cache", lambda: db.user_cache.misses, type="counter")
+  if config.distributed_locks:
+    user_leases = locks.UserLeases(db, config.replica_id, ttl=config.lease_ttl)
+    metrics.CallbackMetric("bot_user_lease_rejections_total", "Messages rejected because another replica answers the user", lambda: user_leases.n_rejected, type="counter")
+    metrics.CallbackMetric("bot_user_lease_handovers_total", "User leases taken over from another replica", lambda: user_leases.n_handovers, type="counter")
+    metrics.CallbackMetric("bot_user_leases_lost_total", "User leases that expired while answering", lambda: user_leases.n_lost, type="counter")
+
+  chatgpt_instance = openai_utils.ChatGPT(use_chatgpt_api=config.use_chatgpt_api)
+  await chatgpt_instance.open()
+  await http_downloader.open()
+
   await application.bot.set_my_commands([
       BotCommand("/new", "Start new dialog"),
       BotCommand("/mode", "Select chat mode"),
@@ -520,16 +674,41 @@ async def post_init(application: Application):
       BotCommand("/help", "Show help message"),
   ])
 
+  tokenizer.preload([openai_utils.model, "text-davinci-003"])
+  for chat_mode in openai_utils.CHAT_MODES:
+    openai_utils.count_prompt_start_tokens(chat_mode, chatgpt_instance.model)
+  await db.create_indexes()
+  usage_accountant.start()
+  if metrics_server is not None:
+    await metrics_server.start()
 
-def run_bot() -> None:
-  application = (
+
+async def post_shutdown(application: Application):
+  if metrics_server is not None:
+    await metrics_server.stop()
+  await usage_accountant.stop()
+  await chatgpt_instance.close()
+  await http_downloader.close()
+  pdf.shutdown()
+  speech_synthesizer.shutdown()
+
+
+def build_application() -> Application:
+  builder = (
       ApplicationBuilder()
       .token(config.telegram_token)
       .concurrent_updates(True)
-      .rate_limiter(AIORateLimiter(max_retries=5))
+      .rate_limiter(telegram_rate_limiter)
       .post_init(post_init)
-      .build()
+      .post_shutdown(post_shutdown)
   )
+  if config.telegram_base_url:
+    builder = builder.base_url(config.telegram_base_url)
+    if config.telegram_base_url.startswith("http://"):  # HTTP/2 is only negotiated over TLS
+      builder = builder.http_version("1.1").get_updates_http_version("1.1")
+  if config.telegram_base_file_url:
+    builder = builder.base_file_url(config.telegram_base_file_url)
+  application = builder.build()
 
   # add handlers
   user_filter = filters.ALL
@@ -559,8 +738,60 @@ def run_bot() -> None:
 
   application.add_error_handler(error_handle)
 
+  return application
+
+
+async def run_webhook(application: Application) -> None:
+  # run_webhook of python-telegram-bot processes updates with a single consumer, so the lifecycle is done here
+  import webhook  # aiohttp's server is only needed in webhook mode
+  stop_event = asyncio.Event()
+  loop = asyncio.get_running_loop()
+  for sig in (signal.SIGINT, signal.SIGTERM):
+    loop.add_signal_handler(sig, stop_event.set)
+
+  server = webhook.WebhookServer(
+      application,
+      config.webhook_listen,
+      config.webhook_port,
+      config.webhook_path,
+      secret_token=config.webhook_secret_token,
+      max_concurrency=config.webhook_max_concurrency,
+      max_pending=config.webhook_max_pending,
+      replica_id=config.replica_id,
+      replica_urls=config.replica_urls
+  )
+  metrics.CallbackMetric("bot_webhook_queue_depth", "Webhook updates accepted but not processed yet", lambda: server.queue_depth)
+
+  await application.initialize()
+  try:
+    await application.post_init(application)
+    await application.start()
+    await server.start()
+    await application.bot.set_webhook(
+        config.webhook_url,
+        secret_token=config.webhook_secret_token,
+        max_connections=config.webhook_max_connections,
+        allowed_updates=Update.ALL_TYPES
+    )
+    logger.info(f"Listening for updates on {config.webhook_listen}:{config.webhook_port}{config.webhook_path}")
+
+    await stop_event.wait()
+  finally:
+    await server.stop()
+    if application.running:
+      await application.stop()
+    await application.post_shutdown(application)
+    await application.shutdown()
+
+
+def run_bot() -> None:
+  application = build_application()
+
   # start the bot
-  application.run_polling()
+  if config.webhook_url:
+    asyncio.run(run_webhook(application))
+  else:
+    application.run_polling()
 
 
 if __name__ == "__main__":
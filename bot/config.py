@@ -1,8 +1,11 @@
+import os
+import socket
+
 import yaml
 import dotenv
 from pathlib import Path
 
-config_dir = Path(__file__).parent.parent.resolve() / "config"
+config_dir = Path(os.environ.get("BOT_CONFIG_DIR") or Path(__file__).parent.parent.resolve() / "config")
 
 # load yaml config
 with open(config_dir / "config.yml", 'r') as f:
@@ -13,19 +16,93 @@ config_env = dotenv.dotenv_values(config_dir / "config.env")
 
 # config parameters
 telegram_token = config_yaml["telegram_token"]
+telegram_base_url = config_yaml.get("telegram_base_url")  # e.g. a local Bot API server or a fake one for load tests
+telegram_base_file_url = config_yaml.get("telegram_base_file_url")
+
+# webhook mode (the bot polls for updates when webhook_url isn't set)
+webhook_url = config_yaml.get("webhook_url")
+webhook_listen = config_yaml.get("webhook_listen", "0.0.0.0")
+webhook_port = config_yaml.get("webhook_port", 8443)
+webhook_path = config_yaml.get("webhook_path", "/telegram")
+webhook_secret_token = config_yaml.get("webhook_secret_token") or None  # required in webhook mode
+webhook_max_concurrency = config_yaml.get("webhook_max_concurrency", 32)
+webhook_max_pending = config_yaml.get("webhook_max_pending", 1000)
+webhook_max_connections = config_yaml.get("webhook_max_connections", 40)
+telegram_edits_per_second_per_chat = config_yaml.get("telegram_edits_per_second_per_chat", 1)
+telegram_edits_per_second = config_yaml.get("telegram_edits_per_second", 25)
 openai_api_key = config_yaml["openai_api_key"]
+openai_api_base = config_yaml.get("openai_api_base")  # e.g. a proxy or a fake endpoint for load tests
+openai_max_connections = config_yaml.get("openai_max_connections", 100)
+openai_keepalive_timeout = config_yaml.get("openai_keepalive_timeout", 30)
+openai_request_timeout = config_yaml.get("openai_request_timeout", 600)
+
+# scheduling of OpenAI requests (budgets are unlimited when not set)
+openai_max_concurrency = config_yaml.get("openai_max_concurrency", 32)
+openai_requests_per_minute = config_yaml.get("openai_requests_per_minute")
+openai_tokens_per_minute = config_yaml.get("openai_tokens_per_minute")
+openai_max_retries = config_yaml.get("openai_max_retries", 3)  # retries after rate limit errors
+summarize_max_concurrency = config_yaml.get("summarize_max_concurrency", 4)
+
+# max size of uploaded documents (Telegram bots can't download more than 20 MB anyway)
+max_file_size = config_yaml.get("max_file_size", 20 * 1024 * 1024)
+
+# downloads of linked documents
+download_max_connections = config_yaml.get("download_max_connections", 20)
+download_timeout = config_yaml.get("download_timeout", 60)
+download_head_timeout = config_yaml.get("download_head_timeout", 5)
+
+# PDF text extraction
+pdf_max_workers = config_yaml.get("pdf_max_workers")  # None -> number of CPUs
+pdf_max_pages = config_yaml.get("pdf_max_pages", 500)
+pdf_pages_per_task = config_yaml.get("pdf_pages_per_task", 20)
+pdf_timeout = config_yaml.get("pdf_timeout", 120)
+
+# summaries of documents, PDF links and YouTube videos
+summary_cache_enabled = config_yaml.get("summary_cache_enabled", True)
+summary_cache_ttl = config_yaml.get("summary_cache_ttl", 7 * 24 * 60 * 60)
+summary_cache_max_entries = config_yaml.get("summary_cache_max_entries", 1000)
 use_chatgpt_api = config_yaml.get("use_chatgpt_api", True)
 allowed_telegram_usernames = config_yaml["allowed_telegram_usernames"]
 new_dialog_timeout = config_yaml["new_dialog_timeout"]
 mongodb_uri = f"mongodb://{config_env['MONGODB_HOST']}:{config_env['MONGODB_PORT']}"
+mongodb_max_pool_size = config_yaml.get("mongodb_max_pool_size", 100)
+
+# multiple replicas: per-user leases in MongoDB make sure only one replica answers a user at a time
+distributed_locks = config_yaml.get("distributed_locks", False)
+lease_ttl = config_yaml.get("lease_ttl", 60)  # seconds, leases are renewed while a message is answered
+replica_id = config_yaml.get("replica_id") or f"{socket.gethostname()}-{os.getpid()}"
+replica_urls = config_yaml.get("replica_urls", {})  # replica id -> webhook URL, to route users to a fixed replica
+
+# user cache (only use it with distributed_locks when running multiple replicas)
+user_cache_enabled = config_yaml.get("user_cache_enabled", True)
+user_cache_max_size = config_yaml.get("user_cache_max_size", 10000)
+user_cache_ttl = config_yaml.get("user_cache_ttl", 300)
+
+# usage accounting
+usage_flush_interval = config_yaml.get("usage_flush_interval", 10)
+usage_flush_max_pending = config_yaml.get("usage_flush_max_pending", 1000)
+
+# messages of a user waiting while the previous one is answered (0 rejects them)
+user_queue_depth = config_yaml.get("user_queue_depth", 0)
 
 azure_tts_region = config_yaml["azure_tts_region"]
 azure_tts_key = config_yaml["azure_tts_key"]
 azure_tts_voice = config_yaml.get("azure_tts_voice")
+tts_max_workers = config_yaml.get("tts_max_workers", 4)
+tts_chunk_min_chars = config_yaml.get("tts_chunk_min_chars", 200)
+
+# Prometheus metrics endpoint (disabled when no port is set)
+metrics_host = config_yaml.get("metrics_host", "127.0.0.1")
+metrics_port = config_yaml.get("metrics_port")
+
+# voice messages
+ffmpeg_max_concurrency = config_yaml.get("ffmpeg_max_concurrency", 2)
+whisper_convert_to_mp3 = config_yaml.get("whisper_convert_to_mp3", False)
 
 # chat_modes
 with open(config_dir / "chat_modes.yml", 'r') as f:
     chat_modes = yaml.safe_load(f)
+default_chat_mode = config_yaml.get("default_chat_mode") or next(iter(chat_modes))  # chat mode of new users
 
 # prices
 chatgpt_price_per_1000_tokens = config_yaml.get("chatgpt_price_per_1000_tokens", 0.002)
@@ -1,30 +1,110 @@
 from typing import Optional, Any
 
+import contextlib
+import contextvars
+import motor.motor_asyncio
 import pymongo
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
 
+import cache
 import config
 
 
-class Database:
+INDEX_OPTIONS_CONFLICT = 85  # MongoDB error code of creating an existing index with other options
+
+# counter of the operations made on behalf of the current request (see Database.track_operations)
+_operation_counter = contextvars.ContextVar("operation_counter", default=None)
+
+
+class OperationCounter:
     def __init__(self):
-        self.client = pymongo.MongoClient(config.mongodb_uri)
+        self.n_operations = 0
+
+
+class Database:
+    def __init__(self, client=None):
+        # client can be another Motor compatible client, e.g. mongomock_motor in tests
+        if client is None:
+            client = motor.motor_asyncio.AsyncIOMotorClient(config.mongodb_uri, maxPoolSize=config.mongodb_max_pool_size)
+        self.client = client
         self.db = self.client["chatgpt_telegram_bot"]
 
         self.user_collection = self.db["user"]
         self.dialog_collection = self.db["dialog"]
+        self.usage_collection = self.db["usage"]
+        self.summary_cache_collection = self.db["summary_cache"]
+        self.lease_collection = self.db["lease"]
 
-    def check_if_user_exists(self, user_id: int, raise_exception: bool = False):
-        if self.user_collection.count_documents({"_id": user_id}) > 0:
-            return True
-        else:
-            if raise_exception:
-                raise ValueError(f"User {user_id} does not exist")
-            else:
-                return False
-        
-    def add_new_user(
+        self.n_operations = 0
+
+        # write-through cache of user documents. Only valid while this process is the only writer, so with
+        # multiple replicas it needs distributed_locks (a user's entry is dropped when the lease changes hands)
+        self.user_cache = None
+        if config.user_cache_enabled:
+            self.user_cache = cache.TTLCache(config.user_cache_max_size, config.user_cache_ttl)
+
+    @contextlib.contextmanager
+    def track_operations(self):
+        counter = OperationCounter()
+        token = _operation_counter.set(counter)
+        try:
+            yield counter
+        finally:
+            _operation_counter.reset(token)
+
+    async def create_indexes(self):
+        self._count_operation()
+        await self.usage_collection.create_index("_id.user_id")
+
+        self._count_operation()
+        try:
+            await self.summary_cache_collection.create_index("created_at", expireAfterSeconds=config.summary_cache_ttl)
+        except pymongo.errors.OperationFailure as e:
+            if e.code != INDEX_OPTIONS_CONFLICT:
+                raise
+            # the index exists with another summary_cache_ttl, it's changed in place
+            self._count_operation()
+            await self.db.command(
+                "collMod",
+                self.summary_cache_collection.name,
+                index={"keyPattern": {"created_at": 1}, "expireAfterSeconds": config.summary_cache_ttl}
+            )
+
+        # released leases are kept for a day, so the next holder can tell who held it before
+        self._count_operation()
+        await self.lease_collection.create_index("expires_at", expireAfterSeconds=24 * 60 * 60)
+
+    def _count_operation(self):
+        self.n_operations += 1
+        counter = _operation_counter.get()
+        if counter is not None:
+            counter.n_operations += 1
+
+    def _get_cached_user(self, user_id: int):
+        if self.user_cache is None:
+            return None
+
+        user_dict = self.user_cache.get(user_id)
+        return None if user_dict is None else dict(user_dict)
+
+    def _cache_user(self, user_dict: dict):
+        if self.user_cache is not None:
+            self.user_cache.set(user_dict["_id"], dict(user_dict))
+
+    def _update_cached_user(self, user_id: int, key: str, value: Any):
+        if self.user_cache is None:
+            return
+
+        user_dict = self.user_cache.peek(user_id)
+        if user_dict is not None:
+            user_dict[key] = value
+
+    def invalidate_user(self, user_id: int):
+        if self.user_cache is not None:
+            self.user_cache.pop(user_id)
+
+    def _new_user_dict(
         self,
         user_id: int,
         chat_id: int,
@@ -32,7 +112,7 @@ class Database:
         first_name: str = "",
         last_name: str = "",
     ):
-        user_dict = {
+        return {
             "_id": user_id,
             "chat_id": chat_id,
 
@@ -44,66 +124,262 @@ class Database:
             "first_seen": datetime.now(),
             
             "current_dialog_id": None,
-            "current_chat_mode": "assistant",
+            "current_chat_mode": config.default_chat_mode,
 
             "n_used_tokens": 0
         }
 
-        if not self.check_if_user_exists(user_id):
-            self.user_collection.insert_one(user_dict)
+    async def register_user(
+        self,
+        user_id: int,
+        chat_id: int,
+        username: str = "",
+        first_name: str = "",
+        last_name: str = "",
+    ):
+        # inserts the user if needed and touches last_interaction in a single round trip.
+        # returns the user's state as it was *before* this interaction
+        user_dict = self._new_user_dict(user_id, chat_id, username, first_name, last_name)
+        last_interaction = user_dict.pop("last_interaction")
+
+        prev_user_dict = self._get_cached_user(user_id)
+        if prev_user_dict is not None:
+            # last_interaction of known users is persisted in batches by usage.UsageAccountant
+            self._update_cached_user(user_id, "last_interaction", last_interaction)
+            return prev_user_dict
+
+        self._count_operation()
+        prev_user_dict = await self.user_collection.find_one_and_update(
+            {"_id": user_id},
+            {"$set": {"last_interaction": last_interaction}, "$setOnInsert": user_dict},
+            upsert=True,
+            return_document=pymongo.ReturnDocument.BEFORE
+        )
+
+        if prev_user_dict is None:  # new user
+            user_dict["last_interaction"] = last_interaction
+            self._cache_user(user_dict)
+            return user_dict
 
-    def start_new_dialog(self, user_id: int):
-        self.check_if_user_exists(user_id, raise_exception=True)
+        self._cache_user({**prev_user_dict, "last_interaction": last_interaction})
+        return prev_user_dict
+
+    async def start_new_dialog(self, user_id: int):
+        # the dialog is inserted before the user points to it, so current_dialog_id never refers to a missing dialog
+        user_dict = self._get_cached_user(user_id)
+        if user_dict is None:
+            self._count_operation()
+            user_dict = await self.user_collection.find_one({"_id": user_id}, projection={"current_chat_mode": 1})
+            if user_dict is None:
+                raise ValueError(f"User {user_id} does not exist")
 
         dialog_id = str(uuid.uuid4())
         dialog_dict = {
             "_id": dialog_id,
             "user_id": user_id,
-            "chat_mode": self.get_user_attribute(user_id, "current_chat_mode"),
+            "chat_mode": user_dict["current_chat_mode"],
             "start_time": datetime.now(),
             "messages": []
         }
 
         # add new dialog
-        self.dialog_collection.insert_one(dialog_dict)
+        self._count_operation()
+        await self.dialog_collection.insert_one(dialog_dict)
 
         # update user's current dialog
-        self.user_collection.update_one(
-            {"_id": user_id},
-            {"$set": {"current_dialog_id": dialog_id}}
-        )
+        await self.set_user_attribute(user_id, "current_dialog_id", dialog_id)
 
         return dialog_id
 
-    def get_user_attribute(self, user_id: int, key: str):
-        self.check_if_user_exists(user_id, raise_exception=True)
-        user_dict = self.user_collection.find_one({"_id": user_id})
+    async def get_user(self, user_id: int, keys: Optional[list] = None):
+        user_dict = self._get_cached_user(user_id)
+        if user_dict is not None:
+            return user_dict
+
+        # the whole document is fetched when it can be cached
+        projection = None if (keys is None or self.user_cache is not None) else {key: 1 for key in keys}
+
+        self._count_operation()
+        user_dict = await self.user_collection.find_one({"_id": user_id}, projection=projection)
+        if user_dict is None:
+            raise ValueError(f"User {user_id} does not exist")
+
+        if projection is None:
+            self._cache_user(user_dict)
+        return user_dict
+
+    async def get_user_attribute(self, user_id: int, key: str):
+        user_dict = await self.get_user(user_id, keys=[key])
 
         if key not in user_dict:
             raise ValueError(f"User {user_id} does not have a value for {key}")
 
         return user_dict[key]
 
-    def set_user_attribute(self, user_id: int, key: str, value: Any):
-        self.check_if_user_exists(user_id, raise_exception=True)
-        self.user_collection.update_one({"_id": user_id}, {"$set": {key: value}})
+    async def set_user_attribute(self, user_id: int, key: str, value: Any):
+        self._count_operation()
+        result = await self.user_collection.update_one({"_id": user_id}, {"$set": {key: value}})
+        if result.matched_count == 0:
+            self.invalidate_user(user_id)
+            raise ValueError(f"User {user_id} does not exist")
 
-    def get_dialog_messages(self, user_id: int, dialog_id: Optional[str] = None):
-        self.check_if_user_exists(user_id, raise_exception=True)
+        self._update_cached_user(user_id, key, value)
 
+    async def get_dialog_messages(self, user_id: int, dialog_id: Optional[str] = None):
         if dialog_id is None:
-            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
+            dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
+
+        self._count_operation()
+        dialog_dict = await self.dialog_collection.find_one(
+            {"_id": dialog_id, "user_id": user_id},
+            projection={"messages": 1}
+        )
+        if dialog_dict is None:  # e.g. deleted by hand, answered like a new dialog
+            return []
 
-        dialog_dict = self.dialog_collection.find_one({"_id": dialog_id, "user_id": user_id})               
         return dialog_dict["messages"]
 
-    def set_dialog_messages(self, user_id: int, dialog_messages: list, dialog_id: Optional[str] = None):
-        self.check_if_user_exists(user_id, raise_exception=True)
+    async def append_dialog_message(self, user_id: int, dialog_message: dict, dialog_id: Optional[str] = None):
+        if dialog_id is None:
+            dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
 
+        self._count_operation()
+        await self.dialog_collection.update_one(
+            {"_id": dialog_id, "user_id": user_id},
+            {"$push": {"messages": dialog_message}}
+        )
+
+    async def pop_last_dialog_message(self, user_id: int, dialog_id: Optional[str] = None):
+        # removes the last message of the dialog and returns it (None if the dialog is empty)
         if dialog_id is None:
-            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
-        
-        self.dialog_collection.update_one(
+            dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
+
+        self._count_operation()
+        dialog_dict = await self.dialog_collection.find_one_and_update(
             {"_id": dialog_id, "user_id": user_id},
-            {"$set": {"messages": dialog_messages}}
+            {"$pop": {"messages": 1}},
+            projection={"messages": {"$slice": -1}},
+            return_document=pymongo.ReturnDocument.BEFORE
+        )
+        if dialog_dict is None or len(dialog_dict["messages"]) == 0:
+            return None
+
+        return dialog_dict["messages"][0]
+
+    async def apply_usage(self, last_interaction: dict, n_used_tokens: dict, usage: dict):
+        user_requests = []
+        for user_id in set(last_interaction) | set(n_used_tokens):
+            update = {}
+            if user_id in last_interaction:
+                update["$max"] = {"last_interaction": last_interaction[user_id]}
+            if user_id in n_used_tokens:
+                update["$inc"] = {"n_used_tokens": n_used_tokens[user_id]}
+            user_requests.append(pymongo.UpdateOne({"_id": user_id}, update))
+
+        usage_requests = [
+            pymongo.UpdateOne(
+                {"_id": {"user_id": user_id, "model": model, "chat_mode": chat_mode}},
+                {"$inc": {"n_used_tokens": n_tokens, "n_spent_dollars": n_spent_dollars}},
+                upsert=True
+            )
+            for (user_id, model, chat_mode), (n_tokens, n_spent_dollars) in usage.items()
+        ]
+
+        if len(user_requests) > 0:
+            # the tokens have already left UsageAccountant's buffer, so cached users get them before the write.
+            # cached users already have the new last_interaction
+            cached_users = {}
+            for user_id, value in n_used_tokens.items():
+                user_dict = self.user_cache.peek(user_id) if self.user_cache is not None else None
+                if user_dict is not None:
+                    user_dict["n_used_tokens"] = user_dict.get("n_used_tokens", 0) + value
+                    cached_users[user_id] = user_dict
+
+            self._count_operation()
+            try:
+                await self.user_collection.bulk_write(user_requests, ordered=False)
+            except Exception:
+                # the tokens go back to UsageAccountant's buffer
+                for user_id in n_used_tokens:
+                    self.invalidate_user(user_id)
+                raise
+
+            # users cached during the write may have been read before or after it
+            for user_id in n_used_tokens:
+                if self.user_cache is not None and self.user_cache.peek(user_id) is not cached_users.get(user_id):
+                    self.invalidate_user(user_id)
+
+        if len(usage_requests) > 0:
+            self._count_operation()
+            await self.usage_collection.bulk_write(usage_requests, ordered=False)
+
+    async def get_usage(self, user_id: int):
+        # returns {(model, chat_mode): (n_used_tokens, n_spent_dollars)}
+        self._count_operation()
+        usage = {}
+        async for usage_dict in self.usage_collection.find({"_id.user_id": user_id}):
+            key = (usage_dict["_id"]["model"], usage_dict["_id"]["chat_mode"])
+            usage[key] = (usage_dict["n_used_tokens"], usage_dict["n_spent_dollars"])
+        return usage
+
+    async def get_cached_summary(self, key: str):
+        self._count_operation()
+        summary_dict = await self.summary_cache_collection.find_one({"_id": key}, projection={"summary": 1})
+        return None if summary_dict is None else summary_dict["summary"]
+
+    async def set_cached_summary(self, key: str, summary: str):
+        self._count_operation()
+        await self.summary_cache_collection.update_one(
+            {"_id": key},
+            {"$set": {"summary": summary, "created_at": datetime.utcnow()}},  # TTL indexes compare with UTC
+            upsert=True
+        )
+
+    async def trim_cached_summaries(self, max_entries: int):
+        # deletes the oldest summaries above max_entries
+        self._count_operation()
+        n_entries = await self.summary_cache_collection.estimated_document_count()
+        if n_entries <= max_entries:
+            return
+
+        self._count_operation()
+        cursor = self.summary_cache_collection.find(projection={"_id": 1}).sort("created_at", pymongo.ASCENDING).limit(n_entries - max_entries)
+        ids = [summary_dict["_id"] async for summary_dict in cursor]
+
+        self._count_operation()
+        await self.summary_cache_collection.delete_many({"_id": {"$in": ids}})
+
+    async def acquire_lease(self, user_id: int, owner: str, token: str, ttl: float):
+        # takes the user's lease if it's free or expired.
+        # returns (True, previous owner or None) when acquired and (False, None) when someone else holds it
+        now = datetime.utcnow()
+
+        self._count_operation()
+        try:
+            prev_lease_dict = await self.lease_collection.find_one_and_update(
+                {"_id": user_id, "expires_at": {"$lte": now}},
+                {"$set": {"owner": owner, "token": token, "expires_at": now + timedelta(seconds=ttl)}},
+                upsert=True,
+                return_document=pymongo.ReturnDocument.BEFORE
+            )
+        except pymongo.errors.DuplicateKeyError:  # the lease isn't expired, so the upsert tried to insert it again
+            return False, None
+
+        return True, (None if prev_lease_dict is None else prev_lease_dict["owner"])
+
+    async def renew_lease(self, user_id: int, token: str, ttl: float):
+        # returns False if the lease was lost (expired and taken by someone else)
+        self._count_operation()
+        result = await self.lease_collection.update_one(
+            {"_id": user_id, "token": token},
+            {"$set": {"expires_at": datetime.utcnow() + timedelta(seconds=ttl)}}
+        )
+        return result.matched_count == 1
+
+    async def release_lease(self, user_id: int, token: str):
+        # expires the lease but keeps its owner for the next holder
+        self._count_operation()
+        await self.lease_collection.update_one(
+            {"_id": user_id, "token": token},
+            {"$set": {"expires_at": datetime.utcnow()}}
         )
@@ -0,0 +1,60 @@
+import asyncio
+
+import config
+
+
+class Downloader:
+    # shared HTTP client for downloading documents from links
+    def __init__(self, max_connections: int = 20, timeout: float = 60, head_timeout: float = 5):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.head_timeout = head_timeout
+
+        self.session = None
+
+    async def open(self):
+        import aiohttp  # slow to import, only needed once a document is downloaded
+
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _check_content_length(self, response, max_size):
+        content_length = response.headers.get("Content-Length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > max_size:
+            raise ValueError(f"File is too large ({content_length} bytes), at most {max_size} bytes are supported")
+
+    async def fetch(self, url: str, max_size: int = None) -> bytes:
+        # streams the response body and gives up as soon as it gets larger than max_size
+        import aiohttp
+
+        max_size = max_size or config.max_file_size
+        await self.open()
+
+        # cheap pre-check, servers which don't support HEAD (or are slow to answer it) are checked while streaming
+        try:
+            head_timeout = aiohttp.ClientTimeout(total=min(self.head_timeout, self.timeout))
+            async with self.session.head(url, allow_redirects=True, timeout=head_timeout) as response:
+                if response.status < 400:
+                    self._check_content_length(response, max_size)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass
+
+        async with self.session.get(url) as response:
+            response.raise_for_status()
+            self._check_content_length(response, max_size)
+
+            data = bytearray()
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                data += chunk
+                if len(data) > max_size:
+                    raise ValueError(f"File is too large, at most {max_size} bytes are supported")
+
+        return bytes(data)
@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class _UserLock:
+    __slots__ = ("lock", "n_pending")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.n_pending = 0  # holder + waiters
+
+
+class Reservation:
+    # place in a user's queue, the lock is acquired with "async with"
+    def __init__(self, manager, user_id: int, user_lock: _UserLock):
+        self.manager = manager
+        self.user_id = user_id
+        self.user_lock = user_lock
+        self.waited = False  # True if another message held the lock, i.e. state read before may be outdated
+
+    async def __aenter__(self):
+        start_time = time.monotonic()
+        self.waited = self.user_lock.lock.locked()
+        try:
+            await self.user_lock.lock.acquire()
+        except BaseException:
+            self.manager._release(self.user_id, self.user_lock)
+            raise
+
+        self.manager._record_wait(time.monotonic() - start_time)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.user_lock.lock.release()
+        self.manager._release(self.user_id, self.user_lock)
+
+
+class UserLockManager:
+    # serializes the messages of each user. While a message is answered, up to max_queue_depth more
+    # messages of the same user wait for their turn, further ones are rejected.
+    # A user's lock only exists while something holds or waits for it, so memory depends on the number
+    # of active users only
+    def __init__(self, max_queue_depth: int = 0):
+        self.max_queue_depth = max_queue_depth
+        self._locks = {}
+
+        self.n_acquired = 0
+        self.n_rejected = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def reserve(self, user_id: int):
+        # returns None if the user's queue is full. Checking and reserving doesn't await,
+        # so there's no race between concurrent updates of the same user
+        user_lock = self._locks.get(user_id)
+        if user_lock is None:
+            user_lock = self._locks[user_id] = _UserLock()
+
+        if user_lock.n_pending > self.max_queue_depth:
+            self.n_rejected += 1
+            return None
+
+        user_lock.n_pending += 1
+        return Reservation(self, user_id, user_lock)
+
+    def is_full(self, user_id: int):
+        user_lock = self._locks.get(user_id)
+        return user_lock is not None and user_lock.n_pending > self.max_queue_depth
+
+    def get_queue_depth(self, user_id: int):
+        user_lock = self._locks.get(user_id)
+        return 0 if user_lock is None else max(user_lock.n_pending - 1, 0)
+
+    @property
+    def n_active_users(self):
+        return len(self._locks)
+
+    @property
+    def n_waiting(self):
+        return sum(max(user_lock.n_pending - 1, 0) for user_lock in self._locks.values())
+
+    def _record_wait(self, wait_time: float):
+        self.n_acquired += 1
+        self.total_wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+
+    def _release(self, user_id: int, user_lock: _UserLock):
+        user_lock.n_pending -= 1
+        if user_lock.n_pending == 0 and self._locks.get(user_id) is user_lock:
+            del self._locks[user_id]
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class Lease:
+    # a user's lease in MongoDB, renewed in the background until it's released
+    def __init__(self, leases, user_id: int, token: str, previous_owner):
+        self.leases = leases
+        self.user_id = user_id
+        self.token = token
+        self.previous_owner = previous_owner
+        self.lost = False
+
+        self._heartbeat_task = asyncio.ensure_future(self._heartbeat())
+
+    @property
+    def changed_hands(self):
+        # True if another replica (or nobody known) held the lease before, i.e. cached user state may be stale
+        return self.previous_owner != self.leases.owner
+
+    def check(self):
+        # raises LeaseLost if another replica may have taken over the user, so the holder stops writing
+        if self.lost:
+            raise LeaseLost(f"Lost the lease of user {self.user_id}")
+
+    async def release(self):
+        self._heartbeat_task.cancel()
+        if not self.lost:
+            await self.leases.db.release_lease(self.user_id, self.token)
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.leases.ttl / 3)
+            try:
+                renewed = await self.leases.db.renew_lease(self.user_id, self.token, self.leases.ttl)
+            except Exception:
+                # can't tell whether it's still held, so it's treated as lost
+                logger.warning(f"Couldn't renew the lease of user {self.user_id}", exc_info=True)
+                renewed = False
+
+            if not renewed:
+                self.lost = True
+                self.leases.n_lost += 1
+                logger.warning(f"Lost the lease of user {self.user_id}")
+                return
+
+
+class UserLeases:
+    # per-user locks shared by all replicas, so no two replicas answer the same user at the same time.
+    # A lease expires after ttl seconds unless its holder renews it, so a crashed replica doesn't block users
+    def __init__(self, db, owner: str, ttl: float = 60):
+        self.db = db
+        self.owner = owner
+        self.ttl = ttl
+
+        self.n_acquired = 0
+        self.n_rejected = 0
+        self.n_handovers = 0
+        self.n_lost = 0
+
+    async def acquire(self, user_id: int):
+        # returns None if another replica holds the user's lease
+        token = uuid.uuid4().hex
+        acquired, previous_owner = await self.db.acquire_lease(user_id, self.owner, token, self.ttl)
+        if not acquired:
+            self.n_rejected += 1
+            return None
+
+        self.n_acquired += 1
+        lease = Lease(self, user_id, token, previous_owner)
+        if lease.changed_hands:
+            self.n_handovers += 1
+            self.db.invalidate_user(user_id)
+        return lease
@@ -0,0 +1,174 @@
+import bisect
+import contextlib
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+registry = []
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if len(pairs) == 0:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        if len(self.labelnames) == 0:
+            self.labels()  # exported as 0 before the first update
+        registry.append(self)
+
+    def labels(self, *labelvalues):
+        child = self._children.get(labelvalues)
+        if child is None:
+            if len(labelvalues) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            child = self._children[labelvalues] = self._new_child()
+        return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for labelvalues, child in self._children.items():
+            lines.extend(self._render_child(labelvalues, child))
+        return lines
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _render_child(self, labelvalues, child):
+        return [f"{self.name}{_format_labels(self.labelnames, labelvalues)} {child.value}"]
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)  # not cumulative, summed up when rendered
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    @contextlib.contextmanager
+    def time(self):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time)
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def _render_child(self, labelvalues, child):
+        lines = []
+        n = 0
+        for bucket, count in zip(self.buckets, child.counts):
+            n += count
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labelvalues, [('le', bucket)])} {n}")
+        lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labelvalues, [('le', '+Inf')])} {child.count}")
+        lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labelvalues)} {child.sum}")
+        lines.append(f"{self.name}_count{_format_labels(self.labelnames, labelvalues)} {child.count}")
+        return lines
+
+
+class CallbackMetric:
+    # exports a value that is already counted elsewhere (e.g. UserLockManager.n_rejected), read when scraped
+    def __init__(self, name: str, documentation: str, func, type="gauge"):
+        self.name = name
+        self.documentation = documentation
+        self.func = func
+        self.type = type
+        registry.append(self)
+
+    def render(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}", f"{self.name} {self.func()}"]
+
+
+def render() -> str:
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# hot path metrics
+stage_seconds = Histogram("bot_stage_seconds", "Duration of the stages of answering a message", ["stage"])
+telegram_request_seconds = Histogram("bot_telegram_request_seconds", "Latency of sending and editing streamed answers", ["method"])
+openai_queue_seconds = Histogram("bot_openai_queue_seconds", "Time OpenAI requests wait for the scheduler", ["lane"])
+tokens = Counter("bot_tokens_total", "Used OpenAI tokens", ["model"])
+context_trims = Counter("bot_context_trims_total", "Dialog messages removed from the context because it was too long")
+errors = Counter("bot_errors_total", "Errors while handling updates")
+
+
+class MetricsServer:
+    # serves /metrics in the Prometheus text format
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def start(self):
+        from aiohttp import web  # only imported if metrics are served
+
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle_metrics)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle_metrics(self, request):
+        from aiohttp import web
+
+        return web.Response(body=render().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
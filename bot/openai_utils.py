@@ -1,12 +1,64 @@
+import asyncio
+import collections
+import random
+import time
+from typing import Dict, NamedTuple
+
 import config
+import metrics
+import tokenizer
 
-import tiktoken
-import openai
-openai.api_key = config.openai_api_key
+openai = None  # imported by load_openai(), it's slow to import
 
 model='gpt-3.5-turbo-16k'
 
-CHAT_MODES = config.chat_modes
+def load_openai():
+    global openai
+    if openai is None:
+        import openai as openai_module
+        openai_module.api_key = config.openai_api_key
+        if config.openai_api_base:
+            openai_module.api_base = config.openai_api_base
+        openai = openai_module
+    return openai
+
+# values of telegram.constants.ParseMode
+PARSE_MODES = {
+    "html": "HTML",
+    "markdown": "Markdown"
+}
+
+class ChatMode(NamedTuple):
+    key: str
+    name: str
+    welcome_message: str
+    prompt_start: str
+    parse_mode: str  # as expected by telegram
+    n_prompt_start_tokens: Dict[str, int]  # per model, filled by count_prompt_start_tokens
+
+def compile_chat_modes(chat_modes_dict):
+    return {
+        key: ChatMode(
+            key=key,
+            name=chat_mode_dict["name"],
+            welcome_message=chat_mode_dict["welcome_message"],
+            prompt_start=chat_mode_dict["prompt_start"],
+            parse_mode=PARSE_MODES[chat_mode_dict["parse_mode"]],
+            n_prompt_start_tokens={}
+        )
+        for key, chat_mode_dict in chat_modes_dict.items()
+    }
+
+CHAT_MODES = compile_chat_modes(config.chat_modes)
+
+# max number of tokens (prompt + completion) each model accepts
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-16k": 16384,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "text-davinci-003": 4097,
+}
 
 OPENAI_COMPLETION_OPTIONS = {
     "temperature": 0.7,
@@ -16,53 +68,341 @@ OPENAI_COMPLETION_OPTIONS = {
     "presence_penalty": 0
 }
 
-#support optional parameter system_role
-def complete(prompt: str, system_role: str = None,max_tokens=1000) -> str:
-  m=[]
-  if system_role:
-    m.append({'role': 'system', 'content': system_role})
-  m.append({'role': 'user', 'content': prompt})
-  response = openai.ChatCompletion.create(
-      messages=m,
-      model=model,
-      temperature=0,
-      max_tokens=max_tokens
-  )
-  return response.choices[0]['message']['content']
+def get_context_window(model):
+    if model in MODEL_CONTEXT_WINDOWS:
+        return MODEL_CONTEXT_WINDOWS[model]
+
+    # e.g. dated snapshots like "gpt-4-0613"
+    for known_model in sorted(MODEL_CONTEXT_WINDOWS, key=len, reverse=True):
+        if model.startswith(known_model):
+            return MODEL_CONTEXT_WINDOWS[known_model]
+
+    return 4096
+
+def count_prompt_start_tokens(chat_mode, model):
+    n_prompt_start_tokens = CHAT_MODES[chat_mode].n_prompt_start_tokens
+    if model not in n_prompt_start_tokens:
+        n_prompt_start_tokens[model] = tokenizer.count_tokens(CHAT_MODES[chat_mode].prompt_start, model)
+    return n_prompt_start_tokens[model]
+
+# scheduler lanes, lower lanes are served first
+INTERACTIVE = 0
+BACKGROUND = 1
+LANE_NAMES = ("interactive", "background")
+
+class _Request:
+    # a request's place in the scheduler. "async with" waits for its turn and frees the slot afterwards
+    def __init__(self, scheduler, user_id, lane, n_tokens):
+        self.scheduler = scheduler
+        self.user_id = user_id
+        self.lane = lane
+        self.n_tokens = n_tokens
+        self.n_used_tokens = None  # set by the caller when the real number is known
+        self.future = None
+        self.enqueue_time = None
+        self.record = None
+
+    async def __aenter__(self):
+        await self.scheduler._acquire(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.scheduler._release(self, exc)
+
+class Scheduler:
+    # all OpenAI requests go through here. It limits the number of requests in flight and keeps them within
+    # the requests and tokens per minute budgets. Interactive requests are served before background ones
+    # (summarization) and within a lane users take turns, so one user's big PDF doesn't hold up everyone else.
+    # After a 429 no request is started until the backoff is over
+    window = 60.0
+    max_backoff = 60.0
+
+    def __init__(self, max_concurrency, requests_per_minute=None, tokens_per_minute=None, max_retries=3):
+        self.max_concurrency = max_concurrency
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+
+        self._queues = [collections.OrderedDict(), collections.OrderedDict()]  # per lane: user_id -> deque of requests
+        self._n_queued = [0, 0]
+        self._n_running = 0
+        self._history = collections.deque()  # [start time, n_tokens, in window] of the requests of the last minute
+        self._n_history_tokens = 0
+        self._paused_until = 0.0
+        self._n_consecutive_rate_limits = 0
+        self._timer = None
+
+        self.n_requests = 0
+        self.n_rate_limited = 0
+        self.total_wait_time = [0.0, 0.0]
+
+    def request(self, user_id=None, lane=INTERACTIVE, n_tokens=0):
+        return _Request(self, user_id, lane, n_tokens)
+
+    async def run(self, func, user_id=None, lane=INTERACTIVE, n_tokens=0, get_n_used_tokens=None):
+        # awaits func() in its turn and retries it after rate limit errors
+        n_retries = 0
+        while True:
+            try:
+                async with self.request(user_id, lane, n_tokens) as request:
+                    result = await func()
+                    if get_n_used_tokens is not None:
+                        request.n_used_tokens = get_n_used_tokens(result)
+                    return result
+            except openai.error.RateLimitError:
+                if n_retries >= self.max_retries:
+                    raise
+                n_retries += 1
+
+    def get_queue_depth(self, lane=None):
+        if lane is None:
+            return sum(self._n_queued)
+        return self._n_queued[lane]
+
+    @property
+    def n_running(self):
+        return self._n_running
+
+    async def _acquire(self, request):
+        request.future = asyncio.get_running_loop().create_future()
+        request.enqueue_time = time.monotonic()
+        self._queues[request.lane].setdefault(request.user_id, collections.deque()).append(request)
+        self._n_queued[request.lane] += 1
+        self._dispatch()
+
+        try:
+            await request.future
+        except asyncio.CancelledError:
+            if request.future.cancelled():  # still waiting
+                self._remove(request)
+            else:  # got its turn meanwhile
+                self._release(request, None)
+            raise
+
+        wait_time = time.monotonic() - request.enqueue_time
+        self.total_wait_time[request.lane] += wait_time
+        metrics.openai_queue_seconds.labels(LANE_NAMES[request.lane]).observe(wait_time)
+
+    def _remove(self, request):
+        queue = self._queues[request.lane]
+        requests = queue[request.user_id]
+        requests.remove(request)
+        if not requests:
+            del queue[request.user_id]
+        self._n_queued[request.lane] -= 1
+        self._dispatch()
+
+    def _release(self, request, exc):
+        self._n_running -= 1
+
+        if isinstance(exc, openai.error.RateLimitError):
+            self._on_rate_limited(exc)
+        elif exc is None:
+            self._n_consecutive_rate_limits = 0
+            if request.n_used_tokens is not None and request.record[2]:
+                self._n_history_tokens += request.n_used_tokens - request.record[1]
+                request.record[1] = request.n_used_tokens
+
+        self._dispatch()
+
+    def _on_rate_limited(self, error):
+        self.n_rate_limited += 1
+        self._n_consecutive_rate_limits += 1
+
+        delay = None
+        headers = getattr(error, "headers", None) or {}
+        try:
+            delay = float(headers.get("retry-after"))
+        except (TypeError, ValueError):
+            pass
+        if delay is None:
+            delay = min(2 ** self._n_consecutive_rate_limits, self.max_backoff) * random.uniform(0.5, 1)
+
+        self._paused_until = max(self._paused_until, time.monotonic() + delay)
+
+    def _dispatch(self):
+        now = time.monotonic()
+        while self._history and self._history[0][0] + self.window <= now:
+            record = self._history.popleft()
+            record[2] = False
+            self._n_history_tokens -= record[1]
+
+        while self._n_running < self.max_concurrency:
+            lane = next((lane for lane, n_queued in enumerate(self._n_queued) if n_queued > 0), None)
+            if lane is None:
+                return
+
+            queue = self._queues[lane]
+            user_id, requests = next(iter(queue.items()))
+            request = requests[0]
+
+            delay = max(self._paused_until - now, self._get_budget_delay(request.n_tokens, now))
+            if delay > 0:
+                self._schedule(delay)
+                return
+
+            # round robin: the user moves to the end of the lane
+            requests.popleft()
+            del queue[user_id]
+            if requests:
+                queue[user_id] = requests
+            self._n_queued[lane] -= 1
+
+            request.record = [now, request.n_tokens, True]
+            self._history.append(request.record)
+            self._n_history_tokens += request.n_tokens
+            self._n_running += 1
+            self.n_requests += 1
+            request.future.set_result(None)
+
+    def _get_budget_delay(self, n_tokens, now):
+        delay = 0.0
+        if self.requests_per_minute and len(self._history) >= self.requests_per_minute:
+            delay = self._history[-self.requests_per_minute][0] + self.window - now
+
+        if self.tokens_per_minute and self._history and self._n_history_tokens + n_tokens > self.tokens_per_minute:
+            # wait until enough tokens leave the window. A request larger than the whole budget waits for an empty window
+            n_tokens_to_free = self._n_history_tokens + n_tokens - self.tokens_per_minute
+            for record in self._history:
+                n_tokens_to_free -= record[1]
+                if n_tokens_to_free <= 0:
+                    break
+            delay = max(delay, record[0] + self.window - now)
+
+        return delay
+
+    def _schedule(self, delay):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._dispatch()
+
+scheduler = Scheduler(
+    config.openai_max_concurrency,
+    requests_per_minute=config.openai_requests_per_minute,
+    tokens_per_minute=config.openai_tokens_per_minute,
+    max_retries=config.openai_max_retries
+)
 
 class ChatGPT:
     def __init__(self, use_chatgpt_api=True):
+        load_openai()
         self.use_chatgpt_api = use_chatgpt_api
-    
-    async def send_message(self, message, dialog_messages=[], chat_mode="assistant"):
+        self.model = model if use_chatgpt_api else "text-davinci-003"
+
+        self.session = None
+
+    async def open(self):
+        # one pooled HTTP session for all requests, so connections (and TLS handshakes) are reused
+        if self.session is None or self.session.closed:
+            import aiohttp  # imported with openai anyway, not at startup
+
+            connector = aiohttp.TCPConnector(
+                limit=config.openai_max_connections,
+                keepalive_timeout=config.openai_keepalive_timeout
+            )
+            self.session = aiohttp.ClientSession(connector=connector)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _use_session(self):
+        # openai picks its aiohttp session from a context variable. It's set for the current task only,
+        # so it isn't reset afterwards (async generators may be finalized from another context)
+        if self.session is not None:
+            openai.aiosession.set(self.session)
+
+    #support optional parameter system_role
+    async def complete(self, prompt: str, system_role: str = None, max_tokens=1000, user_id=None) -> str:
+        # used for summarization, so it runs in the background lane
+        m = []
+        if system_role:
+            m.append({'role': 'system', 'content': system_role})
+        m.append({'role': 'user', 'content': prompt})
+
+        async def create():
+            self._use_session()
+            return await openai.ChatCompletion.acreate(
+                messages=m,
+                model=model,
+                temperature=0,
+                max_tokens=max_tokens,
+                request_timeout=config.openai_request_timeout
+            )
+
+        n_tokens = tokenizer.count_tokens(prompt, model) + tokenizer.count_tokens(system_role or "", model) + max_tokens
+        response = await scheduler.run(
+            create,
+            user_id=user_id,
+            lane=BACKGROUND,
+            n_tokens=n_tokens,
+            get_n_used_tokens=lambda response: response.usage.total_tokens
+        )
+        return response.choices[0]['message']['content']
+
+    async def transcribe_audio(self, audio_file, user_id=None):
+        async def transcribe():
+            audio_file.seek(0)
+            self._use_session()
+            return await openai.Audio.atranscribe("whisper-1", audio_file, request_timeout=config.openai_request_timeout)
+
+        r = await scheduler.run(transcribe, user_id=user_id)
+        return r["text"]
+
+    async def send_message(self, message, dialog_messages=[], chat_mode="assistant", user_id=None):
         if chat_mode not in CHAT_MODES.keys():
             raise ValueError(f"Chat mode {chat_mode} is not supported")
 
         n_dialog_messages_before = len(dialog_messages)
+        with metrics.stage_seconds.labels("prompt_build").time():
+            n_message_tokens = tokenizer.count_tokens(message, self.model)
+            dialog_messages = self._fit_dialog_messages(n_message_tokens, dialog_messages, chat_mode)
         answer = None
         while answer is None:
             try:
                 if self.use_chatgpt_api:
                     messages = self._generate_prompt_messages_for_chatgpt_api(message, dialog_messages, chat_mode)
-                    r = await openai.ChatCompletion.acreate(
-                        model=model,
-                        messages=messages,
-                        **OPENAI_COMPLETION_OPTIONS
-                    )
-                    answer = r.choices[0].message["content"]
+
+                    async def create():
+                        self._use_session()
+                        return await openai.ChatCompletion.acreate(
+                            model=model,
+                            messages=messages,
+                            request_timeout=config.openai_request_timeout,
+                            **OPENAI_COMPLETION_OPTIONS
+                        )
                 else:
                     prompt = self._generate_prompt(message, dialog_messages, chat_mode)
-                    r = await openai.Completion.acreate(
-                        engine="text-davinci-003",
-                        prompt=prompt,
-                        **OPENAI_COMPLETION_OPTIONS
-                    )
+
+                    async def create():
+                        self._use_session()
+                        return await openai.Completion.acreate(
+                            engine="text-davinci-003",
+                            prompt=prompt,
+                            request_timeout=config.openai_request_timeout,
+                            **OPENAI_COMPLETION_OPTIONS
+                        )
+
+                r = await scheduler.run(
+                    create,
+                    user_id=user_id,
+                    n_tokens=self._estimate_n_tokens(n_message_tokens, dialog_messages, chat_mode),
+                    get_n_used_tokens=lambda r: r.usage.total_tokens
+                )
+                if self.use_chatgpt_api:
+                    answer = r.choices[0].message["content"]
+                else:
                     answer = r.choices[0].text
 
                 answer = self._postprocess_answer(answer)
                 n_used_tokens = r.usage.total_tokens
                 
-            except openai.error.InvalidRequestError as e:  # too many tokens
+            except openai.error.InvalidRequestError as e:  # too many tokens, token estimate was off
                 if len(dialog_messages) == 0:
                     raise ValueError("Dialog messages is reduced to zero, but still has too many tokens to make completion") from e
 
@@ -73,50 +413,75 @@ class ChatGPT:
 
         return answer, n_used_tokens, n_first_dialog_messages_removed
 
-    async def send_message_stream(self, message, dialog_messages=[], chat_mode="assistant"):
+    async def send_message_stream(self, message, dialog_messages=[], chat_mode="assistant", user_id=None):
+        # yields ("not_finished", delta) for every new piece of the answer and
+        # ("finished", answer, n_used_tokens, n_first_dialog_messages_removed, n_message_tokens, n_answer_tokens)
+        # with the whole answer at the end. The message and the answer are tokenized once, their counts are stored
+        # with the dialog message
         if chat_mode not in CHAT_MODES.keys():
             raise ValueError(f"Chat mode {chat_mode} is not supported")
 
         n_dialog_messages_before = len(dialog_messages)
+        with metrics.stage_seconds.labels("prompt_build").time():
+            n_message_tokens = tokenizer.count_tokens(message, self.model)
+            dialog_messages = self._fit_dialog_messages(n_message_tokens, dialog_messages, chat_mode)
         answer = None
+        has_yielded = False
+        n_retries = 0
         while answer is None:
             try:
-                if self.use_chatgpt_api:
-                    messages = self._generate_prompt_messages_for_chatgpt_api(message, dialog_messages, chat_mode)
-                    r_gen = await openai.ChatCompletion.acreate(
-                        model=model,
-                        messages=messages,
-                        stream=True,
-                        **OPENAI_COMPLETION_OPTIONS
-                    )
-
-                    answer = ""
-                    async for r_item in r_gen:
-                        delta = r_item.choices[0].delta
-                        if "content" in delta:
-                            answer += delta.content
-                            yield "not_finished", answer
-
-                    n_used_tokens = self._count_tokens_for_chatgpt(messages, answer, model="gpt-3.5-turbo")
-                else:
-                    prompt = self._generate_prompt(message, dialog_messages, chat_mode)
-                    r_gen = await openai.Completion.acreate(
-                        engine="text-davinci-003",
-                        prompt=prompt,
-                        stream=True,
-                        **OPENAI_COMPLETION_OPTIONS
-                    )
+                n_tokens = self._estimate_n_tokens(n_message_tokens, dialog_messages, chat_mode)
+                async with scheduler.request(user_id, INTERACTIVE, n_tokens) as request:
+                    if self.use_chatgpt_api:
+                        messages = self._generate_prompt_messages_for_chatgpt_api(message, dialog_messages, chat_mode)
+                        self._use_session()
+                        r_gen = await openai.ChatCompletion.acreate(
+                            model=model,
+                            messages=messages,
+                            stream=True,
+                            request_timeout=config.openai_request_timeout,
+                            **OPENAI_COMPLETION_OPTIONS
+                        )
+
+                        answer_parts = []
+                        async for r_item in r_gen:
+                            delta = r_item.choices[0].delta
+                            if "content" in delta:
+                                answer_parts.append(delta.content)
+                                has_yielded = True
+                                yield "not_finished", delta.content
+
+                        answer = self._postprocess_answer("".join(answer_parts))
+                        n_answer_tokens = tokenizer.count_tokens(answer, self.model)
+                        n_used_tokens = self._count_tokens_for_chatgpt(n_message_tokens, dialog_messages, chat_mode, n_answer_tokens, model=model)
+                    else:
+                        prompt = self._generate_prompt(message, dialog_messages, chat_mode)
+                        self._use_session()
+                        r_gen = await openai.Completion.acreate(
+                            engine="text-davinci-003",
+                            prompt=prompt,
+                            stream=True,
+                            request_timeout=config.openai_request_timeout,
+                            **OPENAI_COMPLETION_OPTIONS
+                        )
                     
-                    answer = ""
-                    async for r_item in r_gen:
-                        answer += r_item.choices[0].text
-                        yield "not_finished", answer
-
-                    n_used_tokens = self._count_tokens_for_gpt(prompt, answer, model="text-davinci-003")
-
-                answer = self._postprocess_answer(answer)
-                
-            except openai.error.InvalidRequestError as e:  # too many tokens
+                        answer_parts = []
+                        async for r_item in r_gen:
+                            answer_parts.append(r_item.choices[0].text)
+                            has_yielded = True
+                            yield "not_finished", r_item.choices[0].text
+
+                        answer = self._postprocess_answer("".join(answer_parts))
+                        n_answer_tokens = tokenizer.count_tokens(answer, self.model)
+                        n_used_tokens = tokenizer.count_tokens(prompt, self.model) + n_answer_tokens + 1
+
+                    request.n_used_tokens = n_used_tokens
+
+            except openai.error.RateLimitError:  # the scheduler backs off before the retry
+                if has_yielded or n_retries >= scheduler.max_retries:
+                    raise
+                n_retries += 1
+            except openai.error.InvalidRequestError as e:  # too many tokens, token estimate was off
                 if len(dialog_messages) == 0:
                     raise ValueError("Dialog messages is reduced to zero, but still has too many tokens to make completion") from e
 
@@ -125,10 +490,38 @@ class ChatGPT:
 
         n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
 
-        yield "finished", answer, n_used_tokens, n_first_dialog_messages_removed  # sending final answer
+        yield "finished", answer, n_used_tokens, n_first_dialog_messages_removed, n_message_tokens, n_answer_tokens  # sending final answer
+
+    def _fit_dialog_messages(self, n_message_tokens, dialog_messages, chat_mode):
+        # returns the longest suffix of dialog_messages which fits into the model's context window
+        # together with the system prompt, the new message and the answer
+        n_tokens_per_message = 5  # see _count_tokens_for_chatgpt
+        n_tokens_budget = get_context_window(self.model) - OPENAI_COMPLETION_OPTIONS["max_tokens"]
+
+        n_tokens = 3 * n_tokens_per_message  # system prompt, new message and answer primer
+        n_tokens += count_prompt_start_tokens(chat_mode, self.model)
+        n_tokens += n_message_tokens
+        if n_tokens > n_tokens_budget:
+            raise ValueError("Dialog messages is reduced to zero, but still has too many tokens to make completion")
+
+        n_dialog_messages_kept = 0
+        for dialog_message in reversed(dialog_messages):
+            n_tokens += 2 * n_tokens_per_message
+            n_tokens += self._count_dialog_message_tokens(dialog_message, "user", self.model)
+            n_tokens += self._count_dialog_message_tokens(dialog_message, "bot", self.model)
+            if n_tokens > n_tokens_budget:
+                break
+            n_dialog_messages_kept += 1
+
+        return dialog_messages[len(dialog_messages) - n_dialog_messages_kept:]
+
+    def _estimate_n_tokens(self, n_message_tokens, dialog_messages, chat_mode):
+        # prompt plus the longest possible answer, reserved in the tokens per minute budget
+        n_tokens = self._count_tokens_for_chatgpt(n_message_tokens, dialog_messages, chat_mode, 0, model=self.model)
+        return n_tokens + OPENAI_COMPLETION_OPTIONS["max_tokens"]
 
     def _generate_prompt(self, message, dialog_messages, chat_mode):
-        prompt = CHAT_MODES[chat_mode]["prompt_start"]
+        prompt = CHAT_MODES[chat_mode].prompt_start
         prompt += "\n\n"
 
         # add chat context
@@ -145,7 +538,7 @@ class ChatGPT:
         return prompt
 
     def _generate_prompt_messages_for_chatgpt_api(self, message, dialog_messages, chat_mode):
-        prompt = CHAT_MODES[chat_mode]["prompt_start"]
+        prompt = CHAT_MODES[chat_mode].prompt_start
         
         messages = [{"role": "system", "content": prompt}]
         for dialog_message in dialog_messages:
@@ -159,30 +552,23 @@ class ChatGPT:
         answer = answer.strip()
         return answer
 
-    def _count_tokens_for_chatgpt(self, prompt_messages, answer, model="gpt-3.5-turbo"):
-        prompt_messages += [{"role": "assistant", "content": answer}]        
-
-        encoding = tiktoken.encoding_for_model(model)
-        n_tokens = 0
-        for message in prompt_messages:
-            n_tokens += 4  # every message follows "<im_start>{role/name}\n{content}<im_end>\n"
-            for key, value in message.items():            
-                if key == "role":
-                    n_tokens += 1
-                elif key == "content":
-                    n_tokens += len(encoding.encode(value))
-                else:
-                    raise ValueError(f"Unknown key in message: {key}")
-                    
-        n_tokens -= 1  # remove 1 "<im_end>" token          
+    def _count_dialog_message_tokens(self, dialog_message, key, model):
+        # dialog messages store their token counts ("n_user_tokens", "n_bot_tokens"), older ones are counted here
+        n_tokens = dialog_message.get(f"n_{key}_tokens")
+        if n_tokens is None:
+            n_tokens = tokenizer.count_tokens(dialog_message[key], model)
         return n_tokens
 
-    def _count_tokens_for_gpt(self, prompt, answer, model="text-davinci-003"):
-        encoding = tiktoken.encoding_for_model(model)
-        n_tokens = len(encoding.encode(prompt)) + len(encoding.encode(answer)) + 1
-        return n_tokens
+    def _count_tokens_for_chatgpt(self, n_message_tokens, dialog_messages, chat_mode, n_answer_tokens, model="gpt-3.5-turbo"):
+        # every message follows "<im_start>{role/name}\n{content}<im_end>\n", i.e. 4 + 1 (role) extra tokens
+        n_tokens_per_message = 5
 
+        n_tokens = n_tokens_per_message + count_prompt_start_tokens(chat_mode, model)
+        for dialog_message in dialog_messages:
+            n_tokens += n_tokens_per_message + self._count_dialog_message_tokens(dialog_message, "user", model)
+            n_tokens += n_tokens_per_message + self._count_dialog_message_tokens(dialog_message, "bot", model)
+        n_tokens += n_tokens_per_message + n_message_tokens
+        n_tokens += n_tokens_per_message + n_answer_tokens
 
-async def transcribe_audio(audio_file):
-    r = await openai.Audio.atranscribe("whisper-1", audio_file)
-    return r["text"]
\ No newline at end of file
+        n_tokens -= 1  # remove 1 "<im_end>" token
+        return n_tokens
@@ -0,0 +1,112 @@
+import asyncio
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import tempfile
+import uuid
+
+import config
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+
+# in worker processes: path -> PdfReader of the documents worked on recently, so every worker parses a document once
+_readers = {}
+_MAX_READERS = 2
+
+
+def get_executor():
+    # text extraction is CPU bound, so it runs in worker processes instead of the event loop's thread.
+    # Workers aren't forked from the running bot (its threads may hold locks), they start from a fresh interpreter
+    global _executor
+    if _executor is None:
+        start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        _executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=config.pdf_max_workers,
+            mp_context=multiprocessing.get_context(start_method)
+        )
+    return _executor
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+
+
+def _get_reader(path: str):
+    import PyPDF2
+
+    reader = _readers.get(path)
+    if reader is None:
+        if len(_readers) >= _MAX_READERS:
+            _readers.pop(next(iter(_readers)))
+        reader = _readers[path] = PyPDF2.PdfReader(path)  # reads the whole file, so it can be deleted afterwards
+    return reader
+
+
+def _count_pages(path: str) -> int:
+    return len(_get_reader(path).pages)
+
+
+def _extract_pages(path: str, start: int, end: int) -> str:
+    read_pdf = _get_reader(path)
+    return "".join(read_pdf.pages[page_number].extract_text() for page_number in range(start, end))
+
+
+def _write_temp_file(data: bytes) -> str:
+    # names are never reused, so a worker can't mistake a new document for one it has parsed before
+    with tempfile.NamedTemporaryFile(prefix=f"{uuid.uuid4().hex}-", suffix=".pdf", delete=False) as f:
+        f.write(data)
+    return f.name
+
+
+async def iter_page_texts(data: bytes, progress_callback=None):
+    # yields the text of consecutive page ranges (in order) as soon as they are extracted.
+    # Stops after pdf_max_pages pages or pdf_timeout seconds
+    loop = asyncio.get_running_loop()
+    executor = get_executor()
+    deadline = loop.time() + config.pdf_timeout
+
+    # workers get the document's path instead of a copy of it with every task
+    path = await loop.run_in_executor(None, _write_temp_file, data)
+    futures = []
+    try:
+        try:
+            n_pages = await asyncio.wait_for(loop.run_in_executor(executor, _count_pages, path), max(deadline - loop.time(), 0))
+        except asyncio.TimeoutError:
+            raise ValueError(f"PDF couldn't be read within {config.pdf_timeout} seconds")
+        if n_pages > config.pdf_max_pages:
+            logger.warning(f"PDF has {n_pages} pages, only first {config.pdf_max_pages} are extracted")
+            n_pages = config.pdf_max_pages
+
+        page_ranges = [
+            (start, min(start + config.pdf_pages_per_task, n_pages))
+            for start in range(0, n_pages, config.pdf_pages_per_task)
+        ]
+        futures = [loop.run_in_executor(executor, _extract_pages, path, start, end) for start, end in page_ranges]
+
+        for (start, end), future in zip(page_ranges, futures):
+            try:
+                text = await asyncio.wait_for(future, max(deadline - loop.time(), 0))
+            except asyncio.TimeoutError:
+                logger.warning(f"PDF extraction timed out, only first {start} pages are extracted")
+                return
+
+            yield text
+            if progress_callback is not None:
+                await progress_callback(end, n_pages)
+    finally:
+        for future in futures:
+            future.cancel()
+        os.unlink(path)
+
+
+async def extract_text(data: bytes, progress_callback=None):
+    page_texts = []
+    async for page_text in iter_page_texts(data, progress_callback=progress_callback):
+        page_texts.append(page_text)
+    return "".join(page_texts)
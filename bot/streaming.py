@@ -0,0 +1,193 @@
+import asyncio
+import time
+
+import telegram
+from telegram.ext import AIORateLimiter
+
+import cache
+import metrics
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+class RateLimiter:
+    # spaces operations at least 1 / rate seconds apart
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self._next_time = 0.0
+
+    async def acquire(self):
+        now = time.monotonic()
+        delay = self._next_time - now
+        self._next_time = max(now, self._next_time) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class EditScheduler:
+    # limits message sends/edits of streamed answers per chat and globally
+    def __init__(self, edits_per_second_per_chat: float = 1.0, edits_per_second: float = 25.0):
+        self.edits_per_second_per_chat = edits_per_second_per_chat
+        self.global_limiter = RateLimiter(edits_per_second)
+        self.chat_limiters = cache.TTLCache(max_size=10000, ttl=60)
+
+        self.n_edits = 0
+
+    async def acquire(self, chat_id: int):
+        limiter = self.chat_limiters.peek(chat_id)
+        if limiter is None:
+            limiter = RateLimiter(self.edits_per_second_per_chat)
+        self.chat_limiters.set(chat_id, limiter)  # refreshes ttl
+
+        await limiter.acquire()
+        await self.global_limiter.acquire()
+        self.n_edits += 1
+
+    def stream(self, message: telegram.Message, parse_mode):
+        return MessageStream(self, message, parse_mode)
+
+    def status(self, message: telegram.Message):
+        return StatusMessage(self, message)
+
+
+class RetryCountingRateLimiter(AIORateLimiter):
+    # AIORateLimiter that counts the requests it retries after Telegram's RetryAfter errors
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.n_retries = 0
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        n_calls = 0
+
+        async def counting_callback(*args, **kwargs):
+            nonlocal n_calls
+            n_calls += 1
+            if n_calls > 1:  # only RetryAfter errors are retried
+                self.n_retries += 1
+            return await callback(*args, **kwargs)
+
+        return await super().process_request(counting_callback, args, kwargs, endpoint, data, rate_limit_args)
+
+
+class StatusMessage:
+    # a message that shows the progress of a long task (e.g. "Summarizing 3/10..."). Edits go through the
+    # scheduler and texts set while an edit waits are coalesced, so only the latest one is sent
+    def __init__(self, scheduler: EditScheduler, message: telegram.Message):
+        self.scheduler = scheduler
+        self.message = message
+
+        self._text = message.text
+        self._sent_text = message.text
+        self._task = None
+
+    def set(self, text: str):
+        # doesn't wait for the edit
+        self._text = text
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while self._text != self._sent_text:
+            await self.scheduler.acquire(self.message.chat_id)
+            text = self._text
+            with metrics.telegram_request_seconds.labels("edit").time():
+                try:
+                    await self.message.edit_text(text)
+                except telegram.error.BadRequest:
+                    pass
+            self._sent_text = text
+
+
+class MessageStream:
+    # shows a growing answer as a reply to message. Intermediate texts are coalesced, so only the latest one
+    # is sent when the rate limit allows it. Texts longer than the Telegram limit continue in follow-up messages
+    def __init__(self, scheduler: EditScheduler, message: telegram.Message, parse_mode):
+        self.scheduler = scheduler
+        self.message = message
+        self.parse_mode = parse_mode
+
+        self.sent_messages = []
+        self.sent_texts = []
+
+        self._text = ""
+        self._deltas = []  # not yet joined into _text
+        self._finished = False
+        self._changed = asyncio.Event()
+        self._task = None
+
+    def append(self, delta: str):
+        # the answer is only materialized when it's actually sent
+        self._deltas.append(delta)
+        self._changed.set()
+
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def finish(self, text: str):
+        # waits for the pending edit and always sends the final text
+        self._text = text
+        self._deltas = []
+        self._finished = True
+        self._changed.set()
+
+        if self._task is not None:
+            await self._task
+
+        await self.scheduler.acquire(self.message.chat_id)
+        await self._flush()
+
+    def cancel(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self):
+        while not self._finished:
+            await self._changed.wait()
+            if self._finished:
+                break
+
+            # deltas arriving while we wait for the rate limiter are sent with a single edit
+            await self.scheduler.acquire(self.message.chat_id)
+            self._changed.clear()
+            if self._finished:
+                break
+
+            await self._flush()
+
+    async def _flush(self):
+        if len(self._deltas) > 0:
+            self._text += "".join(self._deltas)
+            self._deltas = []
+        text = self._text
+        chunks = [text[i:i + TELEGRAM_MESSAGE_LIMIT] for i in range(0, len(text), TELEGRAM_MESSAGE_LIMIT)]
+
+        for i, chunk in enumerate(chunks):
+            if len(chunk.strip()) == 0:  # telegram doesn't accept empty messages
+                continue
+
+            if i < len(self.sent_messages):
+                if self.sent_texts[i] == chunk:
+                    continue
+
+                await self._edit(self.sent_messages[i], chunk)
+                self.sent_texts[i] = chunk
+            else:
+                self.sent_messages.append(await self._send(chunk))
+                self.sent_texts.append(chunk)
+
+    async def _send(self, text):
+        with metrics.telegram_request_seconds.labels("send").time():
+            try:
+                return await self.message.reply_text(text, parse_mode=self.parse_mode)
+            except telegram.error.BadRequest:
+                # answer (maybe still incomplete) isn't valid markup, so it's sent without parse_mode
+                return await self.message.reply_text(text)
+
+    async def _edit(self, sent_message, text):
+        with metrics.telegram_request_seconds.labels("edit").time():
+            try:
+                await sent_message.edit_text(text, parse_mode=self.parse_mode)
+            except telegram.error.BadRequest as e:
+                if str(e).startswith("Message is not modified"):
+                    return
+                await sent_message.edit_text(text)
@@ -0,0 +1,59 @@
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def key_for_bytes(data: bytes):
+    return "sha256:" + hashlib.sha256(data).hexdigest()
+
+
+def key_for_telegram_file(file_unique_id: str):
+    # same for every copy (e.g. forward) of a file uploaded to Telegram, known before downloading
+    return f"telegram:{file_unique_id}"
+
+
+def key_for_url(url: str):
+    return f"url:{url}"
+
+
+def key_for_youtube_video(video_id: str):
+    return f"youtube:{video_id}"
+
+
+class SummaryCache:
+    # persistent cache of document summaries stored in Mongo. Entries expire after a TTL (Mongo TTL index)
+    # and the oldest ones are evicted when there are more than max_entries
+    def __init__(self, db, enabled: bool = True, max_entries: int = 1000):
+        self.db = db
+        self.enabled = enabled
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, *keys):
+        # returns the summary stored under the first known key
+        if not self.enabled:
+            return None
+
+        for key in keys:
+            summary = await self.db.get_cached_summary(key)
+            if summary is not None:
+                self.hits += 1
+                return summary
+
+        self.misses += 1
+        return None
+
+    async def set(self, keys, summary: str):
+        if not self.enabled:
+            return
+
+        for key in keys:
+            await self.db.set_cached_summary(key, summary)
+
+        try:
+            await self.db.trim_cached_summaries(self.max_entries)
+        except Exception:
+            logger.exception("Failed to evict old summaries")
@@ -0,0 +1,28 @@
+import functools
+from typing import Optional
+
+DEFAULT_ENCODING = "cl100k_base"
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: Optional[str] = None):
+    import tiktoken  # slow to import, loaded with the first encoding
+
+    if model is None:
+        return tiktoken.get_encoding(DEFAULT_ENCODING)
+
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:  # unknown model
+        return tiktoken.get_encoding(DEFAULT_ENCODING)
+
+
+def count_tokens(text: str, model: Optional[str] = None) -> int:
+    return len(get_encoding(model).encode(text))
+
+
+def preload(models=()):
+    # loading an encoding reads (and may download) its BPE ranks, so do it once at startup
+    get_encoding()
+    for model in models:
+        get_encoding(model)
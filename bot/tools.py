@@ -1,34 +1,70 @@
+import asyncio
+import cache
+import config
 import openai_utils
+import tokenizer
 import logging
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 def tokens(t):
-    import tiktoken
-    tokenizer = tiktoken.get_encoding("cl100k_base")
-    return len(tokenizer.encode(t))
+    return tokenizer.count_tokens(t)
 
-def yt(url):
-    import re
-    from bs4 import BeautifulSoup
-    import requests
+def get_youtube_video_id(url):
+    from urllib.parse import urlparse, parse_qs
+
+    parsed_url = urlparse(url)
+    if parsed_url.hostname == "youtu.be":
+        return parsed_url.path.lstrip("/")
+    return parse_qs(parsed_url.query).get("v", [""])[0]
+
+# (description, transcript) per video id
+yt_cache = cache.TTLCache(max_size=256, ttl=60 * 60)
 
-    soup = BeautifulSoup(requests.get(url).content,features="lxml")
-    patternTitle = re.compile('(?<=title":").*(?=","lengthSeconds)')
-    patternDec = re.compile('(?<=shortDescription":").*(?=","isCrawlable)')
-    title = patternTitle.findall(str(soup))[0].replace('\\n','\n')
-    description = patternDec.findall(str(soup))[0].replace('\\n','\n')
+def _find_json_string(pattern, page):
+    import json
 
+    match = pattern.search(page)
+    if match is None:
+        return ""
+    return json.loads(b'"' + match.group(1) + b'"')
+
+def _get_transcript(video_id, languages):
+    # blocking. youtube_transcript_api 1.2 replaced the get_transcript class method with fetch
     from youtube_transcript_api import YouTubeTranscriptApi
-    video_id = url.split("?v=")[-1] if "?v=" in url else url.split("/")[-1]
-    srt = YouTubeTranscriptApi.get_transcript(video_id, languages=['de','en'])
-    transcript = ""
-    for chunk in srt:
-        transcript = transcript + chunk["text"] + "\n"
-        
-    content= title + "\n\n" + description + "\n\n" + transcript
-    return description,transcript 
+
+    if hasattr(YouTubeTranscriptApi, "get_transcript"):
+        return YouTubeTranscriptApi.get_transcript(video_id, languages=languages)
+    return YouTubeTranscriptApi().fetch(video_id, languages=languages).to_raw_data()
+
+async def yt(url, downloader):
+    import re
+
+    video_id = get_youtube_video_id(url)
+    result = yt_cache.get(video_id)
+    if result is not None:
+        return result
+
+    # the transcript api is blocking, so it runs in a thread while the page is downloaded
+    loop = asyncio.get_running_loop()
+    page, srt = await asyncio.gather(
+        downloader.fetch(url),
+        loop.run_in_executor(None, _get_transcript, video_id, ['de','en'])
+    )
+
+    # title and description are JSON strings in the player response embedded into the page
+    patternTitle = re.compile(rb'"title":"((?:[^"\\]|\\.)*)","lengthSeconds"')
+    patternDec = re.compile(rb'"shortDescription":"((?:[^"\\]|\\.)*)","isCrawlable"')
+    title = _find_json_string(patternTitle, page)
+    description = _find_json_string(patternDec, page)
+    logger.info(f"analyzing video {title}")
+
+    transcript = "".join(chunk["text"] + "\n" for chunk in srt)
+
+    result = (description, transcript)
+    yt_cache.set(video_id, result)
+    return result
 
 def summarize(text,max_tokens):
     import math
@@ -43,34 +79,50 @@ def summarize(text,max_tokens):
         return " ".join(words[:firstWords]) 
     return text
 
-def summarize2(text,max_tokens):
-    import math
-    import textwrap
-    t=tokens(text)
+def split_into_token_chunks(text, chunk_tokens):
+    encoding = tokenizer.get_encoding()
+    token_ids = encoding.encode(text)
+    return [encoding.decode(token_ids[i:i + chunk_tokens]) for i in range(0, len(token_ids), chunk_tokens)]
+
+async def summarize_map_reduce(text, max_tokens, chatgpt, progress_callback=None, user_id=None):
+    # summarizes chunks of the text concurrently (map) and summarizes the joined summaries
+    # again (reduce) until the result fits into max_tokens.
+    # progress_callback(n_done, n_total) is awaited after every summarized chunk
+    t = tokens(text)
     logger.info(f"summarizing text with {t} tokens")
-    if t<max_tokens:
+    if t < max_tokens:
         return text
-    factor=t/max_tokens
 
-    chunkSize=math.ceil(len(text)/factor)
-    chunks = textwrap.wrap(text, chunkSize)
+    # a chunk and its summary have to fit into the model's context window
+    chunk_tokens = min(max_tokens, openai_utils.get_context_window(openai_utils.model) // 2)
+    chunks = split_into_token_chunks(text, chunk_tokens)
+
+    chunk_max_tokens = min(max(max_tokens // len(chunks), 100), chunk_tokens // 2)
+    chunk_word_count = int(chunk_max_tokens * 0.75)
 
-    wordCount=len(text.split(" "))
-    chunkWordCount=math.ceil(wordCount/factor)
+    semaphore = asyncio.Semaphore(config.summarize_max_concurrency)
+    n_done = 0
 
-    result = list()
-    count = 0
-    for chunk in chunks:
-        logger.info(f"summarizing chunk {count+1}/{len(chunks)} with {t} tokens")
-        count = count + 1
-        promp=f"""
-        Fasse den Text auf maximal {chunkWordCount} Wörter zusammen. Lasse keine wichtigen Informationen weg.
+    async def summarize_chunk(chunk):
+        nonlocal n_done
+        promp = f"""
+        Fasse den Text auf maximal {chunk_word_count} Wörter zusammen. Lasse keine wichtigen Informationen weg.
 
         Text:
 
         {chunk}
         """
-        summary = openai_utils.complete(promp,"",chunkWordCount)
-        result.append(summary)
+        async with semaphore:
+            summary = await chatgpt.complete(promp, "", chunk_max_tokens, user_id=user_id)
+
+        n_done += 1
+        logger.info(f"summarized chunk {n_done}/{len(chunks)}")
+        if progress_callback is not None:
+            await progress_callback(n_done, len(chunks))
+        return summary
+
+    result = " ".join(await asyncio.gather(*[summarize_chunk(chunk) for chunk in chunks]))
 
-    return summarize(" ".join(result),max_tokens)
+    if tokens(result) >= t:  # summaries didn't get shorter, so cut the text instead of looping forever
+        return summarize(result, max_tokens)
+    return await summarize_map_reduce(result, max_tokens, chatgpt, progress_callback=progress_callback, user_id=user_id)
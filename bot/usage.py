@@ -0,0 +1,99 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class UsageAccountant:
+    # buffers last_interaction and token usage in memory and writes them to Mongo in batches
+    def __init__(self, db, flush_interval: float = 10.0, max_pending: int = 1000):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        self._last_interaction = {}  # user_id -> datetime
+        self._n_used_tokens = {}  # user_id -> n_tokens
+        self._usage = {}  # (user_id, model, chat_mode) -> [n_tokens, n_spent_dollars]
+
+        self._flush_task = None
+        self._threshold_flush_task = None
+
+    def touch(self, user_id: int, last_interaction: Optional[datetime] = None):
+        self._last_interaction[user_id] = last_interaction or datetime.now()
+        self._maybe_flush()
+
+    def add_usage(self, user_id: int, n_used_tokens: int, model: str, chat_mode: str, n_spent_dollars: float):
+        self._n_used_tokens[user_id] = self._n_used_tokens.get(user_id, 0) + n_used_tokens
+
+        item = self._usage.setdefault((user_id, model, chat_mode), [0, 0.0])
+        item[0] += n_used_tokens
+        item[1] += n_spent_dollars
+
+        self._maybe_flush()
+
+    def get_pending_n_used_tokens(self, user_id: int):
+        return self._n_used_tokens.get(user_id, 0)
+
+    def get_pending_usage(self, user_id: int):
+        return {
+            (model, chat_mode): tuple(item)
+            for (item_user_id, model, chat_mode), item in self._usage.items()
+            if item_user_id == user_id
+        }
+
+    @property
+    def n_pending(self):
+        return len(self._last_interaction) + len(self._n_used_tokens)
+
+    def _maybe_flush(self):
+        if self.n_pending < self.max_pending:
+            return
+
+        if self._threshold_flush_task is None or self._threshold_flush_task.done():
+            self._threshold_flush_task = asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        if self.n_pending == 0:
+            return
+
+        # swap buffers, so updates made during the write go to the next batch
+        last_interaction, self._last_interaction = self._last_interaction, {}
+        n_used_tokens, self._n_used_tokens = self._n_used_tokens, {}
+        usage, self._usage = self._usage, {}
+
+        try:
+            await self.db.apply_usage(last_interaction, n_used_tokens, usage)
+        except Exception:
+            logger.exception("Failed to flush usage, it will be retried with the next batch")
+
+            # put everything back without losing updates made in the meantime
+            for user_id, value in last_interaction.items():
+                self._last_interaction.setdefault(user_id, value)
+            for user_id, value in n_used_tokens.items():
+                self._n_used_tokens[user_id] = self._n_used_tokens.get(user_id, 0) + value
+            for key, (n_tokens, n_spent_dollars) in usage.items():
+                item = self._usage.setdefault(key, [0, 0.0])
+                item[0] += n_tokens
+                item[1] += n_spent_dollars
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+
+        await self.flush()
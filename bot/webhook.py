@@ -0,0 +1,195 @@
+import asyncio
+import collections
+import hashlib
+import hmac
+import logging
+
+import aiohttp
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+FORWARDED_HEADER = "X-Bot-Forwarded-By"
+
+
+def get_replica(key, replica_ids):
+    # rendezvous hashing: every replica computes the same owner for a key,
+    # and only the keys of a removed replica move when the set of replicas changes
+    return max(replica_ids, key=lambda replica_id: hashlib.sha1(f"{replica_id}:{key}".encode()).digest())
+
+
+class WebhookServer:
+    # receives updates from Telegram and processes up to max_concurrency of them at the same time. Updates of a
+    # chat are processed one after another in their order, updates of other chats don't wait for them.
+    # When max_pending updates are accepted but not processed yet, requests are only answered once there's room
+    # again, which makes Telegram slow down (it keeps at most max_connections requests open).
+    # Requests without the secret token are rejected, so nobody else can send updates to the bot.
+    # With replica_urls ({replica id: webhook URL}) every user's updates are forwarded to the same replica,
+    # so its user cache stays warm and leases rarely change hands
+    def __init__(
+        self,
+        application: Application,
+        host: str,
+        port: int,
+        path: str,
+        secret_token: str,
+        max_concurrency: int = 32,
+        max_pending: int = 1000,
+        replica_id: str = None,
+        replica_urls: dict = None
+    ):
+        if not secret_token:
+            raise ValueError("Webhook mode needs a secret token (webhook_secret_token)")
+        if replica_urls and replica_id not in replica_urls:
+            raise ValueError(f"Replica {replica_id} isn't one of the replicas {list(replica_urls)}")
+
+        self.application = application
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.replica_id = replica_id
+        self.replica_urls = replica_urls or {}
+
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._room = asyncio.Semaphore(max_pending)
+        self._chats = {}  # chat id -> deque of its waiting updates, exists while the chat has updates
+        self._tasks = set()  # one per chat with updates
+        self._runner = None
+        self._session = None
+        self._ready = False
+
+        self.n_pending = 0
+        self.n_updates = 0
+        self.n_rejected = 0
+        self.n_forwarded = 0
+
+    @property
+    def queue_depth(self):
+        return self.n_pending
+
+    async def start(self):
+        if len(self.replica_urls) > 0:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+
+        app = web.Application()
+        app.router.add_post(self.path, self._handle_update)
+        app.router.add_get("/healthz", self._handle_healthz)
+        app.router.add_get("/readyz", self._handle_readyz)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self._ready = True
+
+    async def stop(self):
+        # stops accepting updates and finishes the accepted ones
+        self._ready = False
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+        while self._tasks:
+            await asyncio.wait(self._tasks)
+
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_chat_key(self, update: Update):
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        elif update.effective_user is not None:
+            return update.effective_user.id
+        return ("update", update.update_id)
+
+    def _enqueue(self, update: Update):
+        self.n_pending += 1
+        key = self._get_chat_key(update)
+        updates = self._chats.get(key)
+        if updates is not None:  # processed after the chat's earlier updates
+            updates.append(update)
+            return
+
+        self._chats[key] = collections.deque([update])
+        task = asyncio.ensure_future(self._process_chat(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _handle_update(self, request):
+        if not hmac.compare_digest(request.headers.get(SECRET_TOKEN_HEADER, "").encode(), self.secret_token.encode()):
+            self.n_rejected += 1
+            return web.Response(status=403)
+
+        if not self._ready:
+            return web.Response(status=503)
+
+        try:
+            data = await request.json()
+            update = Update.de_json(data, self.application.bot)
+        except Exception:
+            logger.warning("Received invalid update", exc_info=True)
+            return web.Response(status=400)
+
+        if FORWARDED_HEADER in request.headers:
+            # the forwarding replica answers Telegram, which retries the update if this one is full.
+            # Waiting for room could outlast the forwarder's timeout and the update would be processed twice
+            if self._room.locked():
+                return web.Response(status=503)
+        elif self._session is not None:
+            user = update.effective_user
+            replica_id = get_replica(update.update_id if user is None else user.id, self.replica_urls)
+            if replica_id != self.replica_id:
+                forwarded = await self._forward(replica_id, data)
+                if forwarded is not None:
+                    return web.Response(status=200 if forwarded else 503)
+                # handled here if the replica is down, the user's lease still keeps the answers exclusive
+
+        await self._room.acquire()
+        self._enqueue(update)
+        self.n_updates += 1
+        return web.Response()
+
+    async def _forward(self, replica_id: str, data: dict):
+        # returns True if the replica accepted the update, False if it didn't (or may have, but didn't answer),
+        # so Telegram has to retry it, and None if the replica couldn't be reached, so it didn't get the update
+        headers = {FORWARDED_HEADER: str(self.replica_id), SECRET_TOKEN_HEADER: self.secret_token}
+
+        try:
+            async with self._session.post(self.replica_urls[replica_id], json=data, headers=headers) as response:
+                if response.status == 200:
+                    self.n_forwarded += 1
+                    return True
+                logger.warning(f"Replica {replica_id} answered a forwarded update with {response.status}")
+        except aiohttp.ClientConnectorError:
+            logger.warning(f"Couldn't connect to replica {replica_id}", exc_info=True)
+            return None
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            logger.warning(f"Couldn't forward an update to replica {replica_id}", exc_info=True)
+        return False
+
+    async def _handle_healthz(self, request):
+        return web.Response(text="ok")
+
+    async def _handle_readyz(self, request):
+        if not self._ready or not self.application.running:
+            return web.Response(status=503, text="not ready")
+        return web.Response(text="ok")
+
+    async def _process_chat(self, key):
+        updates = self._chats[key]
+        while updates:
+            update = updates.popleft()
+            try:
+                async with self._slots:
+                    await self.application.process_update(update)
+            except Exception:
+                # errors of handlers go to the application's error handlers, this only catches the rest
+                logger.exception("Error while processing an update")
+            finally:
+                self.n_pending -= 1
+                self._room.release()
+        del self._chats[key]
@@ -0,0 +1,43 @@
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+import yaml
+
+ROOT_DIR = Path(__file__).parent.parent.resolve()
+
+# the bot's modules import each other as top level modules (the bot runs as `python3 bot/bot.py`)
+sys.path.insert(0, str(ROOT_DIR / "bot"))
+
+# config.py reads its files when it's imported, so the test config is written before any test module imports it
+_config_dir = Path(tempfile.mkdtemp(prefix="bot-test-config-"))
+with open(ROOT_DIR / "config" / "config.example.yml") as f:
+    _config_yaml = yaml.safe_load(f)
+_config_yaml.update({
+    "telegram_token": "123:test",
+    "openai_api_key": "sk-test",
+    "metrics_port": None,
+})
+with open(_config_dir / "config.yml", "w") as f:
+    yaml.safe_dump(_config_yaml, f)
+with open(_config_dir / "config.env", "w") as f:
+    f.write("MONGODB_HOST=localhost\nMONGODB_PORT=27017\n")
+shutil.copy(ROOT_DIR / "config" / "chat_modes.yml", _config_dir / "chat_modes.yml")
+os.environ["BOT_CONFIG_DIR"] = str(_config_dir)
+
+
+@pytest.fixture
+def make_db():
+    # Database on an in-memory mongomock client
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    import database
+
+    def make_db(client=None):
+        if client is None:
+            client = mongomock_motor.AsyncMongoMockClient()
+        return database.Database(client=client)
+
+    return make_db
@@ -0,0 +1,117 @@
+import asyncio
+import random
+import time
+
+import audio
+
+
+class FakeSynthesizer:
+    # "synthesizes" a clip after a random delay, so later clips can be done before earlier ones
+    def __init__(self):
+        self.texts = []
+        self.n_running = 0
+        self.max_running = 0
+
+    async def synthesize(self, text):
+        self.texts.append(text)
+        self.n_running += 1
+        self.max_running = max(self.max_running, self.n_running)
+        try:
+            await asyncio.sleep(random.uniform(0, 0.02))
+        finally:
+            self.n_running -= 1
+        return text.encode()
+
+
+def test_clips_are_cut_at_sentence_ends_and_sent_in_order():
+    sentences = [f"Das ist Satz Nummer {i}, er ist ein bisschen länger als nötig. " for i in range(20)]
+    answer = "".join(sentences) + "Und der Rest ohne Punkt"
+
+    async def main():
+        synthesizer = FakeSynthesizer()
+        sent = []
+
+        async def send_voice(data):
+            sent.append(data.decode())
+
+        stream = audio.SpeechStream(synthesizer, send_voice, min_chars=100)
+        for i in range(0, len(answer), 7):
+            stream.append(answer[i:i + 7])
+            await asyncio.sleep(0.001)
+        first_clip_before_the_end = len(sent) > 0
+        await stream.finish()
+        return synthesizer, sent, first_clip_before_the_end
+
+    synthesizer, sent, first_clip_before_the_end = asyncio.run(main())
+
+    assert "".join(sent) == answer
+    assert first_clip_before_the_end  # speaking started while the answer was still streamed
+    assert all(len(clip) >= 100 for clip in sent[:-1])
+    assert all(clip.rstrip().endswith(".") for clip in sent[:-1])
+    assert sent[-1].endswith("Und der Rest ohne Punkt")
+    assert synthesizer.texts == sent  # sent in the order of the answer
+
+
+def test_short_answer_is_one_clip():
+    async def main():
+        sent = []
+
+        async def send_voice(data):
+            sent.append(data.decode())
+
+        stream = audio.SpeechStream(FakeSynthesizer(), send_voice, min_chars=200)
+        stream.append("Hallo! ")
+        stream.append("Wie geht's?")
+        await stream.finish()
+        return sent
+
+    assert asyncio.run(main()) == ["Hallo! Wie geht's?"]
+
+
+def test_cancel_stops_pending_clips():
+    async def main():
+        sent = []
+
+        async def send_voice(data):
+            sent.append(data)
+
+        stream = audio.SpeechStream(FakeSynthesizer(), send_voice, min_chars=10)
+        stream.append("Erster Satz ist hier. Zweiter Satz ist da. ")
+        stream.cancel()
+        await asyncio.sleep(0.05)
+        return sent
+
+    assert asyncio.run(main()) == []
+
+
+class BlockingSynthesizer(audio.SpeechSynthesizer):
+    # blocks its thread like the Azure SDK does
+    def _synthesize(self, text):
+        time.sleep(0.1)
+        return text.encode()
+
+
+def test_concurrent_syntheses_dont_block_the_event_loop():
+    async def main():
+        synthesizer = BlockingSynthesizer("key", "region", max_workers=4)
+        lags = []
+
+        async def monitor(interval=0.005):
+            while True:
+                start_time = time.perf_counter()
+                await asyncio.sleep(interval)
+                lags.append(time.perf_counter() - start_time - interval)
+
+        monitor_task = asyncio.ensure_future(monitor())
+        try:
+            clips = await asyncio.gather(*[synthesizer.synthesize(f"voice message {i}") for i in range(10)])
+        finally:
+            monitor_task.cancel()
+            synthesizer.shutdown()
+        return clips, lags
+
+    clips, lags = asyncio.run(main())
+
+    assert clips == [f"voice message {i}".encode() for i in range(10)]
+    assert len(lags) > 20  # the loop kept running while the 10 clips took 0.3 s
+    assert max(lags) < 0.05
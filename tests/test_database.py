@@ -0,0 +1,145 @@
+import asyncio
+from datetime import datetime
+
+import pymongo
+import pytest
+
+import config
+
+
+def test_start_new_dialog_inserts_dialog_before_pointing_to_it(make_db):
+    async def main():
+        db = make_db()
+        await db.register_user(1, 1)
+
+        dialog_id = await db.start_new_dialog(1)
+        assert (await db.get_user(1))["current_dialog_id"] == dialog_id
+        assert await db.dialog_collection.find_one({"_id": dialog_id}) is not None
+        assert await db.get_dialog_messages(1, dialog_id=dialog_id) == []
+
+    asyncio.run(main())
+
+
+def test_start_new_dialog_of_unknown_user(make_db):
+    async def main():
+        db = make_db()
+        with pytest.raises(ValueError):
+            await db.start_new_dialog(1)
+        assert await db.dialog_collection.count_documents({}) == 0
+
+    asyncio.run(main())
+
+
+def test_missing_dialog_has_no_messages(make_db):
+    async def main():
+        db = make_db()
+        await db.register_user(1, 1)
+        assert await db.get_dialog_messages(1, dialog_id="missing") == []
+
+    asyncio.run(main())
+
+
+def test_operation_budget_of_a_message(make_db):
+    # a message of a known user reads the dialog and appends the answer, everything else comes from the cache
+    async def main():
+        db = make_db()
+        await db.register_user(1, 1)
+        dialog_id = await db.start_new_dialog(1)
+
+        with db.track_operations() as counter:
+            user_dict = await db.register_user(1, 1)
+            await db.get_dialog_messages(1, dialog_id=user_dict["current_dialog_id"])
+            await db.append_dialog_message(1, {"user": "hi", "bot": "hello"}, dialog_id=user_dict["current_dialog_id"])
+        assert counter.n_operations == 2
+
+        with db.track_operations() as counter:
+            await db.start_new_dialog(1)
+        assert counter.n_operations == 2  # insert the dialog, point the user to it
+
+        assert await db.get_dialog_messages(1, dialog_id=dialog_id) == [{"user": "hi", "bot": "hello"}]
+
+    asyncio.run(main())
+
+
+def test_operation_budget_without_cache(make_db):
+    async def main():
+        db = make_db()
+        db.user_cache = None
+        await db.register_user(1, 1)
+        await db.start_new_dialog(1)
+
+        with db.track_operations() as counter:
+            user_dict = await db.register_user(1, 1)
+            await db.get_dialog_messages(1, dialog_id=user_dict["current_dialog_id"])
+            await db.append_dialog_message(1, {"user": "hi", "bot": "hello"}, dialog_id=user_dict["current_dialog_id"])
+        assert counter.n_operations == 3
+
+    asyncio.run(main())
+
+
+def test_changed_summary_cache_ttl_modifies_the_index(make_db, monkeypatch):
+    async def main():
+        db = make_db()
+
+        async def create_index(keys, **kwargs):
+            raise pymongo.errors.OperationFailure("Index already exists with a different expireAfterSeconds", code=85)
+        monkeypatch.setattr(db.summary_cache_collection, "create_index", create_index)
+
+        commands = []
+
+        async def command(*args, **kwargs):
+            commands.append((args, kwargs))
+        monkeypatch.setattr(db.db, "command", command)
+
+        await db.create_indexes()
+        assert commands == [(
+            ("collMod", "summary_cache"),
+            {"index": {"keyPattern": {"created_at": 1}, "expireAfterSeconds": config.summary_cache_ttl}}
+        )]
+
+    asyncio.run(main())
+
+
+def test_cached_summaries_are_stored_in_utc(make_db):
+    async def main():
+        db = make_db()
+        await db.set_cached_summary("key", "summary")
+        summary_dict = await db.summary_cache_collection.find_one({"_id": "key"})
+        assert abs((summary_dict["created_at"] - datetime.utcnow()).total_seconds()) < 5
+        assert await db.get_cached_summary("key") == "summary"
+
+    asyncio.run(main())
+
+
+def test_used_tokens_are_counted_once_if_the_user_is_read_during_the_usage_write(make_db):
+    async def main():
+        db = make_db()
+        await db.register_user(1, 1)
+
+        # the write is applied, but its result arrives later
+        written = asyncio.Event()
+        release = asyncio.Event()
+        bulk_write = db.user_collection.bulk_write
+
+        async def slow_bulk_write(*args, **kwargs):
+            result = await bulk_write(*args, **kwargs)
+            written.set()
+            await release.wait()
+            return result
+
+        db.user_collection.bulk_write = slow_bulk_write
+        task = asyncio.ensure_future(db.apply_usage({}, {1: 10}, {}))
+        await written.wait()
+
+        # already taken from the usage buffer, so the cached user has it
+        assert (await db.register_user(1, 1))["n_used_tokens"] == 10
+
+        db.invalidate_user(1)  # e.g. expired
+        assert (await db.register_user(1, 1))["n_used_tokens"] == 10
+
+        release.set()
+        await task
+        assert (await db.register_user(1, 1))["n_used_tokens"] == 10
+        assert (await db.user_collection.find_one({"_id": 1}))["n_used_tokens"] == 10
+
+    asyncio.run(main())
@@ -0,0 +1,115 @@
+import asyncio
+import os
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+import downloader
+
+DOCUMENT = os.urandom(200_000)
+
+
+async def start_server():
+    # local HTTP server with a normal, a chunked (no Content-Length), a slow and a missing document
+    client_ports = set()
+
+    async def document(request):
+        client_ports.add(request.transport.get_extra_info("peername")[1])
+        return web.Response(body=DOCUMENT)
+
+    async def chunked(request):
+        response = web.StreamResponse()
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        for i in range(0, len(DOCUMENT), 10_000):
+            await response.write(DOCUMENT[i:i + 10_000])
+        await response.write_eof()
+        return response
+
+    async def slow(request):
+        await asyncio.sleep(1)
+        return web.Response(body=DOCUMENT)
+
+    async def slow_head(request):
+        if request.method == "HEAD":
+            await asyncio.sleep(1)
+        return web.Response(body=DOCUMENT)
+
+    app = web.Application()
+    app.router.add_get("/document.pdf", document)
+    app.router.add_get("/chunked.pdf", chunked)
+    app.router.add_get("/slow.pdf", slow)
+    app.router.add_get("/slow-head.pdf", slow_head)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://127.0.0.1:{port}", client_ports
+
+
+def test_fetch_reuses_connections():
+    async def main():
+        runner, url, client_ports = await start_server()
+        client = downloader.Downloader(max_connections=2, timeout=10)
+        try:
+            for _ in range(5):
+                assert await client.fetch(f"{url}/document.pdf") == DOCUMENT
+            assert await client.fetch(f"{url}/chunked.pdf") == DOCUMENT
+        finally:
+            await client.close()
+            await runner.cleanup()
+        return client_ports
+
+    client_ports = asyncio.run(main())
+    assert len(client_ports) == 1  # the HEAD and GET requests of all downloads used the same connection
+
+
+def test_too_large_documents_are_rejected():
+    async def main():
+        runner, url, _ = await start_server()
+        client = downloader.Downloader(timeout=10)
+        try:
+            # known from Content-Length
+            with pytest.raises(ValueError):
+                await client.fetch(f"{url}/document.pdf", max_size=100_000)
+            # only found out while streaming
+            with pytest.raises(ValueError):
+                await client.fetch(f"{url}/chunked.pdf", max_size=100_000)
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    asyncio.run(main())
+
+
+def test_http_errors_are_raised():
+    async def main():
+        runner, url, _ = await start_server()
+        client = downloader.Downloader(timeout=10)
+        try:
+            with pytest.raises(aiohttp.ClientResponseError):
+                await client.fetch(f"{url}/missing.pdf")
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    asyncio.run(main())
+
+
+def test_slow_downloads_time_out():
+    async def main():
+        runner, url, _ = await start_server()
+        client = downloader.Downloader(timeout=0.5, head_timeout=0.1)
+        try:
+            # the size pre-check is skipped
+            assert await client.fetch(f"{url}/slow-head.pdf") == DOCUMENT
+            with pytest.raises(asyncio.TimeoutError):
+                await client.fetch(f"{url}/slow.pdf")
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    asyncio.run(main())
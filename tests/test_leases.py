@@ -0,0 +1,89 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+import locks
+
+
+def test_replicas_never_answer_a_user_concurrently(make_db):
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+
+    async def main():
+        # every replica has its own Database (and user cache) on the same MongoDB
+        client = mongomock_motor.AsyncMongoMockClient()
+        replicas = [locks.UserLeases(make_db(client), f"replica-{i}", ttl=60) for i in range(3)]
+        running = {}
+        max_running = 0
+        n_answered = {replica.owner: 0 for replica in replicas}
+
+        async def answer(user_leases, user_id):
+            nonlocal max_running
+            while True:
+                lease = await user_leases.acquire(user_id)
+                if lease is not None:
+                    break
+                await asyncio.sleep(0.001)  # the user resends the message
+
+            try:
+                running[user_id] = running.get(user_id, 0) + 1
+                max_running = max(max_running, running[user_id])
+                await asyncio.sleep(0.005)  # the completion
+                running[user_id] -= 1
+                n_answered[user_leases.owner] += 1
+            finally:
+                await lease.release()
+
+        await asyncio.gather(*[answer(replicas[i % len(replicas)], i % 2) for i in range(30)])
+
+        assert max_running == 1
+        assert sum(n_answered.values()) == 30
+        assert all(n > 0 for n in n_answered.values())
+        assert sum(replica.n_rejected for replica in replicas) > 0
+        assert sum(replica.n_handovers for replica in replicas) > 0
+
+    asyncio.run(main())
+
+
+def test_lease_is_lost_when_renewing_fails(make_db):
+    async def main():
+        db = make_db()
+        user_leases = locks.UserLeases(db, "replica-0", ttl=0.03)
+        lease = await user_leases.acquire(1)
+        lease.check()
+
+        async def renew_lease(user_id, token, ttl):
+            raise ConnectionError("MongoDB is down")
+
+        db.renew_lease = renew_lease
+        await asyncio.sleep(0.05)
+
+        assert lease.lost
+        assert user_leases.n_lost == 1
+        with pytest.raises(locks.LeaseLost):
+            lease.check()
+        await lease.release()
+
+    asyncio.run(main())
+
+
+def test_lease_is_lost_when_another_replica_took_it(make_db):
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+
+    async def main():
+        client = mongomock_motor.AsyncMongoMockClient()
+        first = locks.UserLeases(make_db(client), "replica-0", ttl=0.03)
+        second = locks.UserLeases(make_db(client), "replica-1", ttl=60)
+        lease = await first.acquire(1)
+
+        # the first replica stalled for longer than the ttl
+        await first.db.lease_collection.update_one({"_id": 1}, {"$set": {"expires_at": datetime(2000, 1, 1)}})
+        assert await second.acquire(1) is not None
+
+        await asyncio.sleep(0.05)
+        assert lease.lost
+        assert first.n_lost == 1
+        with pytest.raises(locks.LeaseLost):
+            lease.check()
+
+    asyncio.run(main())
@@ -0,0 +1,82 @@
+import asyncio
+import gc
+import tracemalloc
+
+import locks
+
+
+def test_messages_of_a_user_are_serialized():
+    async def main():
+        user_locks = locks.UserLockManager(max_queue_depth=2)
+        running = []
+        max_running = 0
+
+        async def handle(user_id):
+            nonlocal max_running
+            async with user_locks.reserve(user_id) as reservation:
+                running.append(user_id)
+                max_running = max(max_running, running.count(user_id))
+                await asyncio.sleep(0.01)
+                running.remove(user_id)
+                return reservation.waited
+
+        waited = await asyncio.gather(*[handle(1) for _ in range(3)], handle(2))
+
+        assert max_running == 1
+        assert waited == [False, True, True, False]
+        assert user_locks.n_acquired == 4
+        assert user_locks.max_wait_time >= 0.01
+        assert user_locks.total_wait_time >= user_locks.max_wait_time
+        assert user_locks.n_active_users == 0
+
+    asyncio.run(main())
+
+
+def test_full_queue_rejects_messages():
+    async def main():
+        user_locks = locks.UserLockManager(max_queue_depth=1)
+        first = user_locks.reserve(1)
+        second = user_locks.reserve(1)
+        assert user_locks.reserve(1) is None
+        assert user_locks.is_full(1)
+        assert user_locks.n_rejected == 1
+
+        async with first:
+            assert user_locks.get_queue_depth(1) == 1
+        async with second:
+            pass
+        assert not user_locks.is_full(1)
+
+    asyncio.run(main())
+
+
+def test_memory_of_100k_users_is_released():
+    # memory depends on the number of users active at the same time, not on all users ever seen
+    async def main():
+        user_locks = locks.UserLockManager()
+
+        async def handle(user_id):
+            async with user_locks.reserve(user_id):
+                await asyncio.sleep(0)
+
+        async def handle_users(start, end, batch_size=10_000):
+            for i in range(start, end, batch_size):
+                await asyncio.gather(*[handle(user_id) for user_id in range(i, i + batch_size)])
+                await asyncio.sleep(0)  # lets the event loop drop the finished tasks
+                gc.collect()
+
+        tracemalloc.start()
+        try:
+            await handle_users(0, 10_000)  # the first batch sizes the dict of locks and the event loop's structures
+            before, _ = tracemalloc.get_traced_memory()
+
+            await handle_users(10_000, 100_000)
+            after, _ = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        assert user_locks.n_active_users == 0
+        assert user_locks.n_acquired == 100_000
+        assert after - before < 64 * 1024
+
+    asyncio.run(main())
@@ -0,0 +1,31 @@
+import cache
+import metrics
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = metrics.Histogram("test_seconds", "Test durations", ["stage"], buckets=(0.1, 1.0))
+    histogram.labels("a").observe(0.05)
+    histogram.labels("a").observe(0.5)
+    histogram.labels("a").observe(5)
+
+    assert histogram.render() == [
+        "# HELP test_seconds Test durations",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{stage="a",le="0.1"} 1',
+        'test_seconds_bucket{stage="a",le="1.0"} 2',
+        'test_seconds_bucket{stage="a",le="+Inf"} 3',
+        'test_seconds_sum{stage="a"} 5.55',
+        'test_seconds_count{stage="a"} 3',
+    ]
+
+
+def test_callback_metric_reads_the_value_when_rendered():
+    user_cache = cache.TTLCache(max_size=10, ttl=60)
+    metric = metrics.CallbackMetric("test_cache_hits_total", "Cache hits", lambda: user_cache.hits, type="counter")
+
+    user_cache.set(1, "user")
+    user_cache.get(1)
+    user_cache.get(2)
+
+    assert metric.render()[-1] == "test_cache_hits_total 1"
+    assert "test_cache_hits_total 1" in metrics.render().splitlines()
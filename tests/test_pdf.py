@@ -0,0 +1,86 @@
+import asyncio
+import concurrent.futures
+import time
+
+import pytest
+
+import config
+import pdf
+
+
+def make_pdf(page_texts):
+    # minimal PDF with one line of text per page
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # pages, filled in below
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    page_ids = []
+    for text in page_texts:
+        content = f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET".encode()
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content))
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % len(objects))
+        page_ids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % i for i in page_ids), len(page_ids))
+
+    data = b"%PDF-1.4\n"
+    offsets = []
+    for i, obj in enumerate(objects, start=1):
+        offsets.append(len(data))
+        data += b"%d 0 obj\n%s\nendobj\n" % (i, obj)
+    xref_offset = len(data)
+    data += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    data += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    data += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref_offset)
+    return data
+
+
+@pytest.fixture(autouse=True)
+def shutdown_executor():
+    yield
+    pdf.shutdown()
+
+
+def test_extract_text_in_page_ranges(monkeypatch):
+    pytest.importorskip("PyPDF2")
+    monkeypatch.setattr(config, "pdf_pages_per_task", 3)
+    monkeypatch.setattr(config, "pdf_max_workers", 2)
+
+    progress = []
+
+    async def progress_callback(n_done, n_total):
+        progress.append((n_done, n_total))
+
+    text = asyncio.run(pdf.extract_text(make_pdf([f"Page{i}" for i in range(10)]), progress_callback=progress_callback))
+
+    assert text == "".join(f"Page{i}" for i in range(10))
+    assert progress == [(3, 10), (6, 10), (9, 10), (10, 10)]
+
+
+def test_reading_the_page_count_times_out(monkeypatch):
+    monkeypatch.setattr(config, "pdf_timeout", 0.05)
+    # threads instead of workers, so they see the slow page count
+    monkeypatch.setattr(pdf, "get_executor", lambda: concurrent.futures.ThreadPoolExecutor(max_workers=1))
+    monkeypatch.setattr(pdf, "_count_pages", lambda path: time.sleep(1))
+
+    start_time = time.monotonic()
+    with pytest.raises(ValueError):
+        asyncio.run(pdf.extract_text(make_pdf(["Page0"])))
+    assert time.monotonic() - start_time < 1
+
+
+def test_workers_parse_a_document_once(tmp_path):
+    pytest.importorskip("PyPDF2")
+    path = tmp_path / "document.pdf"
+    path.write_bytes(make_pdf(["Page0", "Page1"]))
+
+    assert pdf._count_pages(str(path)) == 2
+    reader = pdf._readers[str(path)]
+    path.unlink()  # the reader doesn't need the file anymore
+    assert pdf._extract_pages(str(path), 1, 2).strip() == "Page1"
+    assert pdf._readers[str(path)] is reader
+    pdf._readers.clear()
+
+
+def test_workers_dont_use_fork():
+    assert pdf.get_executor()._mp_context.get_start_method() in ("forkserver", "spawn")
@@ -0,0 +1,144 @@
+import asyncio
+import collections
+import time
+
+import openai_utils
+
+openai = openai_utils.load_openai()
+
+
+class FakeAPI:
+    # answers like OpenAI: more than requests_per_window requests in a sliding window get a 429
+    def __init__(self, requests_per_window, window, latency=0.01):
+        self.requests_per_window = requests_per_window
+        self.window = window
+        self.latency = latency
+
+        self.starts = collections.deque()
+        self.n_running = 0
+        self.max_running = 0
+        self.n_ok = 0
+        self.n_rate_limited = 0
+        self.order = []
+
+    async def request(self, name):
+        now = time.monotonic()
+        while self.starts and self.starts[0] + self.window <= now:
+            self.starts.popleft()
+        if len(self.starts) >= self.requests_per_window:
+            self.n_rate_limited += 1
+            raise openai.error.RateLimitError("Rate limit reached", headers={"retry-after": str(self.window / 4)})
+        self.starts.append(now)
+
+        self.n_running += 1
+        self.max_running = max(self.max_running, self.n_running)
+        self.order.append(name)
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.n_running -= 1
+        self.n_ok += 1
+        return name
+
+
+def make_scheduler(max_concurrency, requests_per_minute=None, tokens_per_minute=None, window=0.5, max_retries=3):
+    scheduler = openai_utils.Scheduler(max_concurrency, requests_per_minute, tokens_per_minute, max_retries=max_retries)
+    scheduler.window = window  # a "minute" of the budgets
+    return scheduler
+
+
+def test_budget_keeps_requests_below_the_rate_limit():
+    async def main():
+        api = FakeAPI(requests_per_window=5, window=0.5)
+        scheduler = make_scheduler(max_concurrency=3, requests_per_minute=5)
+
+        results = await asyncio.gather(*[scheduler.run(lambda i=i: api.request(i), user_id=i % 4) for i in range(15)])
+
+        assert sorted(results) == list(range(15))
+        assert api.n_rate_limited == 0
+        assert api.max_running <= 3
+
+    start_time = time.monotonic()
+    asyncio.run(main())
+    assert time.monotonic() - start_time >= 1.0  # 15 requests at 5 per window need 3 windows
+
+
+def test_rate_limited_requests_are_retried_after_backoff():
+    async def main():
+        api = FakeAPI(requests_per_window=4, window=0.2)
+        scheduler = make_scheduler(max_concurrency=8, max_retries=10)  # no budget, relies on the 429s
+
+        results = await asyncio.gather(*[scheduler.run(lambda i=i: api.request(i)) for i in range(12)])
+
+        assert sorted(results) == list(range(12))
+        assert api.n_rate_limited > 0
+        assert scheduler.n_rate_limited == api.n_rate_limited
+        assert api.n_ok == 12
+
+    asyncio.run(main())
+
+
+def test_interactive_requests_go_first_and_users_take_turns():
+    async def main():
+        api = FakeAPI(requests_per_window=100, window=1.0)
+        scheduler = make_scheduler(max_concurrency=1)
+
+        async def hold():
+            async with scheduler.request():
+                await asyncio.sleep(0.05)
+
+        holder = asyncio.ensure_future(hold())
+        await asyncio.sleep(0)
+
+        requests = [
+            scheduler.run(lambda name=name: api.request(name), user_id=user_id, lane=openai_utils.BACKGROUND)
+            for user_id, name in [("a", "a1"), ("a", "a2"), ("a", "a3"), ("b", "b1")]
+        ]
+        requests.append(scheduler.run(lambda: api.request("c1"), user_id="c", lane=openai_utils.INTERACTIVE))
+        await asyncio.gather(holder, *requests)
+
+        assert api.order == ["c1", "a1", "b1", "a2", "a3"]
+
+    asyncio.run(main())
+
+
+def test_token_budget_delays_requests():
+    async def main():
+        scheduler = make_scheduler(max_concurrency=10, tokens_per_minute=100, window=0.3)
+        start_times = []
+
+        async def request(n_tokens):
+            async with scheduler.request(None, openai_utils.INTERACTIVE, n_tokens):
+                start_times.append(time.monotonic())
+
+        start_time = time.monotonic()
+        await asyncio.gather(request(60), request(60), request(60))
+        return [t - start_time for t in start_times]
+
+    start_times = asyncio.run(main())
+    assert start_times[0] < 0.1
+    assert start_times[1] >= 0.25
+    assert start_times[2] >= 0.55
+
+
+def test_cancelled_request_leaves_the_queue():
+    async def main():
+        scheduler = make_scheduler(max_concurrency=1)
+
+        async def hold(delay):
+            async with scheduler.request():
+                await asyncio.sleep(delay)
+
+        holder = asyncio.ensure_future(hold(0.05))
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(hold(0))
+        await asyncio.sleep(0.01)
+        assert scheduler.get_queue_depth() == 1
+
+        waiter.cancel()
+        await asyncio.sleep(0.01)
+        assert scheduler.get_queue_depth() == 0
+        await holder
+        assert scheduler.n_running == 0
+
+    asyncio.run(main())
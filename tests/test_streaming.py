@@ -0,0 +1,147 @@
+import asyncio
+import statistics
+import time
+
+import telegram
+
+import streaming
+
+
+class FakeBot:
+    # counts the Telegram requests of the streamed answers
+    def __init__(self):
+        self.n_sends = 0
+        self.n_edits = 0
+
+
+class FakeMessage:
+    # records the edits the bot makes to a message, and when each text was shown
+    def __init__(self, chat_id=1, text="", bot=None):
+        self.chat_id = chat_id
+        self.text = text
+        self.bot = bot or FakeBot()
+        self.edits = []
+        self.replies = []
+        self.history = [(time.monotonic(), text)]
+
+    async def edit_text(self, text, parse_mode=None):
+        self.bot.n_edits += 1
+        self.edits.append(text)
+        self.text = text
+        self.history.append((time.monotonic(), text))
+
+    async def reply_text(self, text, parse_mode=None):
+        self.bot.n_sends += 1
+        reply = FakeMessage(self.chat_id, text, self.bot)
+        self.replies.append(reply)
+        return reply
+
+
+def test_streamed_answer_is_coalesced_into_few_edits():
+    async def main():
+        scheduler = streaming.EditScheduler(edits_per_second_per_chat=10, edits_per_second=100)
+        message = FakeMessage()
+        stream = scheduler.stream(message, "HTML")
+
+        deltas = [f"word{i} " for i in range(500)]
+        append_times = []
+        for delta in deltas:
+            stream.append(delta)
+            append_times.append(time.monotonic())
+            await asyncio.sleep(0.001)
+        await stream.finish("".join(deltas))
+        return message, deltas, append_times
+
+    start_time = time.monotonic()
+    message, deltas, append_times = asyncio.run(main())
+    duration = time.monotonic() - start_time
+
+    assert [reply.text for reply in message.replies] == ["".join(deltas)]
+    # one send plus the edits the rate limit allows, instead of one request per delta
+    assert message.bot.n_sends == 1
+    assert message.bot.n_sends + message.bot.n_edits <= duration * 10 + 2
+
+    # a delta is shown by the next edit the rate limit allows (one per 0.1 s), the last ones by finish(),
+    # which waits for the pending edit and then for a slot of its own
+    history = message.replies[0].history
+    latencies = []
+    n_chars = 0
+    for delta, append_time in zip(deltas, append_times):
+        n_chars += len(delta)
+        shown_time = next(shown_time for shown_time, text in history if len(text) >= n_chars)
+        latencies.append(shown_time - append_time)
+    assert statistics.median(latencies) < 0.1
+    assert max(latencies) < 0.3
+
+
+def test_long_answers_continue_in_new_messages():
+    async def main():
+        scheduler = streaming.EditScheduler(edits_per_second_per_chat=100, edits_per_second=100)
+        message = FakeMessage()
+        stream = scheduler.stream(message, None)
+
+        stream.append("a" * 3000)
+        await asyncio.sleep(0.05)
+        await stream.finish("a" * 5000)
+        return message
+
+    message = asyncio.run(main())
+    assert [len(reply.text) for reply in message.replies] == [streaming.TELEGRAM_MESSAGE_LIMIT, 5000 - streaming.TELEGRAM_MESSAGE_LIMIT]
+    assert message.bot.n_edits == 1  # the first message grew from 3000 characters
+
+
+def test_status_message_coalesces_progress_edits():
+    async def main():
+        scheduler = streaming.EditScheduler(edits_per_second_per_chat=20, edits_per_second=100)
+        message = FakeMessage(text="Analyzing pdf...")
+        status_message = scheduler.status(message)
+
+        for i in range(1, 101):
+            status_message.set(f"Summarizing {i}/100...")
+            await asyncio.sleep(0)
+        await asyncio.sleep(0.2)
+
+        assert message.text == "Summarizing 100/100..."
+        assert len(message.edits) <= 5
+        assert scheduler.n_edits == len(message.edits)
+
+    asyncio.run(main())
+
+
+def test_invalid_markup_is_sent_as_plain_text():
+    class StrictMessage(FakeMessage):
+        async def reply_text(self, text, parse_mode=None):
+            if parse_mode is not None and text.count("<b>") != text.count("</b>"):
+                raise telegram.error.BadRequest("Can't parse entities")
+            return await super().reply_text(text, parse_mode)
+
+    async def main():
+        scheduler = streaming.EditScheduler(edits_per_second_per_chat=100, edits_per_second=100)
+        message = StrictMessage()
+        stream = scheduler.stream(message, "HTML")
+        await stream.finish("<b>unfinished")
+        return message
+
+    message = asyncio.run(main())
+    assert [reply.text for reply in message.replies] == ["<b>unfinished"]
+
+
+def test_rate_limiter_counts_retries_after_retry_after_errors():
+    n_calls = 0
+
+    async def send_message():
+        nonlocal n_calls
+        n_calls += 1
+        if n_calls <= 2:
+            raise telegram.error.RetryAfter(0)
+        return True
+
+    async def main():
+        rate_limiter = streaming.RetryCountingRateLimiter(max_retries=5)
+        result = await rate_limiter.process_request(send_message, (), {}, "sendMessage", {"chat_id": 1}, None)
+        return rate_limiter, result
+
+    rate_limiter, result = asyncio.run(main())
+    assert result is True
+    assert n_calls == 3
+    assert rate_limiter.n_retries == 2
@@ -0,0 +1,60 @@
+import asyncio
+import collections
+import types
+
+import config
+import openai_utils
+import tokenizer
+
+openai = openai_utils.load_openai()
+
+
+class FakeEncoding:
+    # a token per word, counts how often each text is tokenized
+    def __init__(self):
+        self.n_encoded = collections.Counter()
+
+    def encode(self, text):
+        self.n_encoded[text] += 1
+        return text.split()
+
+
+class Delta(dict):
+    def __getattr__(self, key):
+        return self[key]
+
+
+def test_message_and_answer_are_tokenized_once(monkeypatch):
+    encoding = FakeEncoding()
+    monkeypatch.setattr(tokenizer, "get_encoding", lambda model=None: encoding)
+
+    async def acreate(**kwargs):
+        async def gen():
+            for content in ["Hello", " there", " friend "]:
+                yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=Delta(content=content))])
+        return gen()
+
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", acreate)
+
+    dialog_messages = [
+        {"user": f"question {i}", "bot": f"answer {i}", "n_user_tokens": 2, "n_bot_tokens": 2} for i in range(10)
+    ]
+
+    async def main():
+        chatgpt = openai_utils.ChatGPT()
+        gen = chatgpt.send_message_stream(
+            "how are you", dialog_messages=dialog_messages, chat_mode=config.default_chat_mode
+        )
+        return [item async for item in gen]
+
+    items = asyncio.run(main())
+
+    status, answer, n_used_tokens, n_first_dialog_messages_removed, n_message_tokens, n_answer_tokens = items[-1]
+    assert status == "finished"
+    assert answer == "Hello there friend"
+    assert (n_message_tokens, n_answer_tokens) == (3, 3)
+    assert n_first_dialog_messages_removed == 0
+    assert encoding.n_encoded["how are you"] == 1
+    assert encoding.n_encoded["Hello there friend"] == 1
+    # stored counts are used for the dialog messages
+    assert not any(text.startswith(("question", "answer")) for text in encoding.n_encoded)
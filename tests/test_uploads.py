@@ -0,0 +1,57 @@
+import asyncio
+import os
+import types
+
+import pytest
+
+import bot
+import config
+
+
+class FakeFile:
+    def __init__(self, data):
+        self.data = data
+
+    async def download_to_memory(self, out):
+        # written in pieces, so concurrent downloads interleave
+        for i in range(0, len(self.data), 1000):
+            out.write(self.data[i:i + 1000])
+            await asyncio.sleep(0)
+
+
+class FakeAttachment:
+    def __init__(self, data, file_size=None):
+        self.data = data
+        self.file_size = len(data) if file_size is None else file_size
+
+    async def get_file(self):
+        await asyncio.sleep(0)
+        return FakeFile(self.data)
+
+
+def make_update(attachment):
+    return types.SimpleNamespace(message=types.SimpleNamespace(effective_attachment=attachment))
+
+
+def test_concurrent_uploads_get_their_own_buffers(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    uploads = [os.urandom(10_000 + i) for i in range(20)]
+
+    async def main():
+        return await asyncio.gather(*[bot.download_attachment(make_update(FakeAttachment(data))) for data in uploads])
+
+    buffers = asyncio.run(main())
+
+    assert [buffer.getvalue() for buffer in buffers] == uploads
+    assert list(tmp_path.iterdir()) == []  # nothing is written to disk
+
+
+def test_too_large_uploads_are_rejected(monkeypatch):
+    monkeypatch.setattr(config, "max_file_size", 1000)
+
+    with pytest.raises(ValueError):
+        asyncio.run(bot.download_attachment(make_update(FakeAttachment(b"x" * 2000))))
+
+    # Telegram doesn't always know the size, so it's checked after the download as well
+    with pytest.raises(ValueError):
+        asyncio.run(bot.download_attachment(make_update(FakeAttachment(b"x" * 2000, file_size=None))))
@@ -0,0 +1,67 @@
+import asyncio
+import types
+
+import bot
+import locks
+
+
+class FakeVoiceFile:
+    async def download_to_memory(self, out):
+        out.write(b"voice")
+
+
+class FakeMessage:
+    def __init__(self, user_id):
+        self.id = 1
+        self.from_user = types.SimpleNamespace(id=user_id)
+        self.voice = types.SimpleNamespace(file_id="voice", duration=30)
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+def test_rejected_voice_messages_arent_transcribed_or_charged(monkeypatch):
+    n_transcribed = 0
+    charged = []
+    answered = []
+
+    async def register_user_if_not_exists(update, context, user):
+        return {"_id": user.id, "current_chat_mode": "assistant"}
+
+    async def prepare_for_transcription(data):
+        return data
+
+    async def transcribe_audio(audio_file, user_id=None):
+        nonlocal n_transcribed
+        n_transcribed += 1
+        await asyncio.sleep(0.01)
+        return "hi"
+
+    async def message_handle(update, context, message=None, reservation=None, **kwargs):
+        assert reservation is not None  # answered under the lock taken before the transcription
+        await asyncio.sleep(0.01)
+        answered.append(message)
+
+    async def get_file(file_id):
+        return FakeVoiceFile()
+
+    monkeypatch.setattr(bot, "register_user_if_not_exists", register_user_if_not_exists)
+    monkeypatch.setattr(bot, "message_handle", message_handle)
+    monkeypatch.setattr(bot, "user_locks", locks.UserLockManager(max_queue_depth=0))
+    monkeypatch.setattr(bot.audio, "prepare_for_transcription", prepare_for_transcription)
+    monkeypatch.setattr(bot, "chatgpt_instance", types.SimpleNamespace(transcribe_audio=transcribe_audio))
+    monkeypatch.setattr(bot, "usage_accountant", types.SimpleNamespace(add_usage=lambda *args: charged.append(args)))
+
+    context = types.SimpleNamespace(bot=types.SimpleNamespace(get_file=get_file))
+    updates = [types.SimpleNamespace(message=FakeMessage(1)) for _ in range(2)]
+
+    async def main():
+        await asyncio.gather(*[bot.voice_message_handle(update, context) for update in updates])
+
+    asyncio.run(main())
+
+    assert n_transcribed == 1
+    assert len(charged) == 1
+    assert answered == ["hi"]
+    assert "wait" in updates[1].message.replies[0]
@@ -0,0 +1,243 @@
+import asyncio
+import socket
+
+import aiohttp
+import pytest
+
+import webhook
+
+SECRET_TOKEN = "secret"
+
+
+class FakeApplication:
+    # records the order of processed updates, updates of blocked chats wait until they're released
+    def __init__(self):
+        self.bot = None
+        self.running = True
+        self.processed = []
+        self.blocked_chats = {}
+
+    async def process_update(self, update):
+        chat_id = update.effective_chat.id
+        if chat_id in self.blocked_chats:
+            await self.blocked_chats[chat_id].wait()
+        self.processed.append((chat_id, update.message.text))
+
+
+class FakeRequest:
+    def __init__(self, data, secret_token=SECRET_TOKEN):
+        self.data = data
+        self.headers = {} if secret_token is None else {webhook.SECRET_TOKEN_HEADER: secret_token}
+
+    async def json(self):
+        return self.data
+
+
+def make_update(update_id, chat_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "User"},
+            "text": text,
+        },
+    }
+
+
+def make_server(application, **kwargs):
+    server = webhook.WebhookServer(application, "127.0.0.1", 0, "/telegram", SECRET_TOKEN, **kwargs)
+    server._ready = True  # accepts updates without listening
+    return server
+
+
+def test_secret_token_is_required():
+    with pytest.raises(ValueError):
+        webhook.WebhookServer(FakeApplication(), "127.0.0.1", 0, "/telegram", None)
+    with pytest.raises(ValueError):
+        webhook.WebhookServer(FakeApplication(), "127.0.0.1", 0, "/telegram", "")
+
+
+def test_requests_without_the_secret_token_are_rejected():
+    async def main():
+        application = FakeApplication()
+        server = make_server(application)
+
+        for secret_token in [None, "wrong", "sécret"]:
+            response = await server._handle_update(FakeRequest(make_update(1, 1, "hi"), secret_token))
+            assert response.status == 403
+
+        response = await server._handle_update(FakeRequest(make_update(2, 1, "hi")))
+        assert response.status == 200
+        await server.stop()
+        return application, server
+
+    application, server = asyncio.run(main())
+    assert application.processed == [(1, "hi")]
+    assert server.n_rejected == 3
+
+
+def test_server_accepts_posted_updates():
+    async def main():
+        application = FakeApplication()
+        server = webhook.WebhookServer(application, "127.0.0.1", 0, "/telegram", SECRET_TOKEN)
+        await server.start()
+        host, port = server._runner.addresses[0][:2]
+        url = f"http://{host}:{port}"
+
+        statuses = {}
+        async with aiohttp.ClientSession() as session:
+            for name, path, update, headers in [
+                ("without secret", "/telegram", make_update(1, 1, "a1"), {}),
+                ("wrong secret", "/telegram", make_update(2, 1, "a2"), {webhook.SECRET_TOKEN_HEADER: "wrong"}),
+                ("with secret", "/telegram", make_update(3, 1, "a3"), {webhook.SECRET_TOKEN_HEADER: SECRET_TOKEN}),
+                ("other path", "/other", make_update(4, 1, "a4"), {webhook.SECRET_TOKEN_HEADER: SECRET_TOKEN}),
+            ]:
+                async with session.post(url + path, json=update, headers=headers) as response:
+                    statuses[name] = response.status
+
+            async with session.post(url + "/telegram", data=b"{", headers={webhook.SECRET_TOKEN_HEADER: SECRET_TOKEN}) as response:
+                statuses["invalid json"] = response.status
+
+            for path in ["/healthz", "/readyz"]:
+                async with session.get(url + path) as response:
+                    statuses[path] = response.status
+            application.running = False
+            async with session.get(url + "/readyz") as response:
+                statuses["/readyz of a stopped application"] = response.status
+
+        await server.stop()
+        return application, server, statuses
+
+    application, server, statuses = asyncio.run(main())
+    assert statuses == {
+        "without secret": 403,
+        "wrong secret": 403,
+        "with secret": 200,
+        "other path": 404,
+        "invalid json": 400,
+        "/healthz": 200,
+        "/readyz": 200,
+        "/readyz of a stopped application": 503,
+    }
+    assert application.processed == [(1, "a3")]
+    assert server.n_rejected == 2
+
+
+def test_a_busy_chat_doesnt_block_other_chats():
+    async def main():
+        application = FakeApplication()
+        application.blocked_chats[1] = asyncio.Event()
+        server = make_server(application, max_concurrency=4)
+
+        for i, (chat_id, text) in enumerate([(1, "a1"), (1, "a2"), (2, "b1"), (3, "c1"), (1, "a3"), (2, "b2")]):
+            await server._handle_update(FakeRequest(make_update(i, chat_id, text)))
+        await asyncio.sleep(0.01)
+
+        # chat 1 waits for its first update, the others are done
+        assert sorted(application.processed) == [(2, "b1"), (2, "b2"), (3, "c1")]
+        assert server.queue_depth == 3
+
+        application.blocked_chats[1].set()
+        await server.stop()
+        return application, server
+
+    application, server = asyncio.run(main())
+    assert [text for chat_id, text in application.processed if chat_id == 1] == ["a1", "a2", "a3"]
+    assert server.queue_depth == 0
+    assert server._chats == {}
+
+
+def test_full_server_slows_down_telegram():
+    async def main():
+        application = FakeApplication()
+        application.blocked_chats[1] = asyncio.Event()
+        server = make_server(application, max_pending=2)
+
+        await server._handle_update(FakeRequest(make_update(1, 1, "a1")))
+        await server._handle_update(FakeRequest(make_update(2, 1, "a2")))
+        third = asyncio.ensure_future(server._handle_update(FakeRequest(make_update(3, 2, "b1"))))
+        await asyncio.sleep(0.01)
+        assert not third.done()  # answered once there's room
+
+        application.blocked_chats[1].set()
+        assert (await third).status == 200
+        await server.stop()
+        return application
+
+    application = asyncio.run(main())
+    assert sorted(application.processed) == [(1, "a1"), (1, "a2"), (2, "b1")]
+
+
+def test_replica_id_must_be_one_of_the_replicas():
+    with pytest.raises(ValueError):
+        webhook.WebhookServer(
+            FakeApplication(), "127.0.0.1", 0, "/telegram", SECRET_TOKEN,
+            replica_id="c", replica_urls={"a": "http://a/telegram", "b": "http://b/telegram"}
+        )
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_full_replica_doesnt_get_forwarded_updates_twice():
+    async def main():
+        ports = {"a": get_free_port(), "b": get_free_port()}
+        replica_urls = {replica_id: f"http://127.0.0.1:{port}/telegram" for replica_id, port in ports.items()}
+        applications = {replica_id: FakeApplication() for replica_id in ports}
+        servers = {
+            replica_id: webhook.WebhookServer(
+                applications[replica_id], "127.0.0.1", port, "/telegram", SECRET_TOKEN,
+                max_pending=1, replica_id=replica_id, replica_urls=replica_urls
+            )
+            for replica_id, port in ports.items()
+        }
+        for server in servers.values():
+            await server.start()
+
+        # a user owned by replica b, whose only slot is taken by a blocked chat of another user
+        user_id = next(user_id for user_id in range(100, 1000) if webhook.get_replica(user_id, ports) == "b")
+        blocked_chat_id = next(chat_id for chat_id in range(100, 1000) if webhook.get_replica(chat_id, ports) == "b")
+        applications["b"].blocked_chats[blocked_chat_id] = asyncio.Event()
+        assert (await servers["b"]._handle_update(FakeRequest(make_update(1, blocked_chat_id, "blocked")))).status == 200
+
+        # replica a gets the update from Telegram, b is full, so Telegram has to retry it
+        response = await servers["a"]._handle_update(FakeRequest(make_update(2, user_id, "hi")))
+        assert response.status == 503
+
+        applications["b"].blocked_chats[blocked_chat_id].set()
+        await asyncio.sleep(0.01)
+        response = await servers["a"]._handle_update(FakeRequest(make_update(2, user_id, "hi")))  # the retry
+        assert response.status == 200
+
+        for server in servers.values():
+            await server.stop()
+        return applications
+
+    applications = asyncio.run(main())
+    assert applications["a"].processed == []
+    assert [text for chat_id, text in applications["b"].processed] == ["blocked", "hi"]
+
+
+def test_update_of_a_replica_that_is_down_is_handled_locally():
+    async def main():
+        replica_urls = {"a": "http://127.0.0.1:1/telegram", "b": f"http://127.0.0.1:{get_free_port()}/telegram"}
+        application = FakeApplication()
+        server = webhook.WebhookServer(
+            application, "127.0.0.1", 0, "/telegram", SECRET_TOKEN, replica_id="a", replica_urls=replica_urls
+        )
+        await server.start()
+
+        user_id = next(user_id for user_id in range(100, 1000) if webhook.get_replica(user_id, replica_urls) == "b")
+        response = await server._handle_update(FakeRequest(make_update(1, user_id, "hi")))
+        assert response.status == 200
+
+        await server.stop()
+        return application, user_id
+
+    application, user_id = asyncio.run(main())
+    assert application.processed == [(user_id, "hi")]
@@ -0,0 +1,70 @@
+import asyncio
+import json
+from pathlib import Path
+
+import pytest
+
+import tools
+
+FIXTURES_DIR = Path(__file__).parent / "fixtures"
+
+
+class FakeDownloader:
+    def __init__(self, page):
+        self.page = page
+        self.urls = []
+
+    async def fetch(self, url):
+        self.urls.append(url)
+        return self.page
+
+
+@pytest.fixture
+def transcript_api(monkeypatch):
+    with open(FIXTURES_DIR / "youtube_transcript.json") as f:
+        transcript = json.load(f)
+
+    calls = []
+
+    def get_transcript(video_id, languages=None):
+        calls.append((video_id, languages))
+        return transcript
+
+    monkeypatch.setattr(tools, "_get_transcript", get_transcript)
+    tools.yt_cache.clear()
+    yield calls
+    tools.yt_cache.clear()
+
+
+@pytest.mark.parametrize("url", [
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ&t=42s",
+    "https://youtu.be/dQw4w9WgXcQ",
+])
+def test_get_youtube_video_id(url):
+    assert tools.get_youtube_video_id(url) == "dQw4w9WgXcQ"
+
+
+def test_yt_extracts_description_and_transcript(transcript_api):
+    downloader = FakeDownloader((FIXTURES_DIR / "youtube_watch.html").read_bytes())
+    url = "https://www.youtube.com/watch?v=dQw4w9WgXcQ"
+
+    description, transcript = asyncio.run(tools.yt(url, downloader))
+
+    assert description == "In diesem Video zeigen wir,\nwie man Kaffee kocht.\n\nZutaten: Wasser \\ Bohnen"
+    assert transcript == "Hallo und willkommen\nheute kochen wir Kaffee\n[Musik]\n"
+    assert transcript_api == [("dQw4w9WgXcQ", ["de", "en"])]
+
+    # the same video again comes from the cache
+    assert asyncio.run(tools.yt("https://youtu.be/dQw4w9WgXcQ", downloader)) == (description, transcript)
+    assert downloader.urls == [url]
+    assert len(transcript_api) == 1
+
+
+def test_yt_without_player_response(transcript_api):
+    downloader = FakeDownloader(b"<html><body>consent page</body></html>")
+
+    description, transcript = asyncio.run(tools.yt("https://youtu.be/abc", downloader))
+
+    assert description == ""
+    assert transcript.startswith("Hallo und willkommen\n")